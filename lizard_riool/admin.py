@@ -1,8 +1,127 @@
+from collections import defaultdict
+
 from django.contrib import admin
+from django.core.urlresolvers import reverse
 from models import Upload
+from models import UploadBatch
+from models import UploadStageTiming
+from progress import STAGES
+import tasks
+
+# Shown in the change list of stage timings, over all uploads.
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    "Return the p-th percentile (nearest rank) of a sorted list."
+    if not values:
+        return None
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class UploadStageTimingInline(admin.TabularInline):
+    model = UploadStageTiming
+    fields = readonly_fields = [
+        'stage', 'wall_time', 'cpu_time', 'peak_rss', 'rows']
+    extra = 0
+    can_delete = False
 
 
 class UploadAdmin(admin.ModelAdmin):
-    readonly_fields = ['the_file', 'the_time']
+    list_display = ['__unicode__', 'the_time', 'status', 'profile']
+    readonly_fields = ['the_file', 'the_time', 'profile_reports']
+    inlines = [UploadStageTimingInline]
+    actions = ['profile_processing']
+
+    def profile_reports(self, upload):
+        return ", ".join(
+            '<a href="{url}">{filename}</a>'.format(
+                url=reverse('lizard_riool_upload_profile', kwargs={
+                        'upload_id': upload.id, 'filename': filename}),
+                filename=filename)
+            for filename in upload.profile_files()) or "-"
+    profile_reports.allow_tags = True
+
+    def profile_processing(self, request, queryset):
+        """Profile processing of the selected uploads. Uploads that are
+        waiting are profiled when their turn comes; RMB files that were
+        rejected are processed again, with their RIB, right away."""
+        queryset.update(profile=True)
+
+        reprocessed = 0
+        for upload in queryset.filter(status=Upload.UNSUCCESSFUL):
+            if upload.suffix.lower() != '.rmb':
+                continue
+
+            name = upload.filename.lower()[:-4]
+            for other in Upload.objects.filter(status=Upload.UNSUCCESSFUL):
+                if other.filename.lower()[:-4] == name:
+                    other.reset()
+            upload = Upload.objects.get(pk=upload.pk)
+            tasks.process_uploaded_file.delay(upload)
+            reprocessed += 1
+
+        self.message_user(request, (
+                "{0} upload(s) worden geprofileerd, {1} daarvan worden "
+                "opnieuw verwerkt.").format(queryset.count(), reprocessed))
+    profile_processing.short_description = (
+        "Verwerking profileren (afgekeurde RMB's opnieuw verwerken)")
+
+
+class UploadStageTimingAdmin(admin.ModelAdmin):
+    list_display = [
+        'upload', 'stage', 'wall_time', 'cpu_time', 'peak_rss', 'rows']
+    list_filter = ['stage']
+    readonly_fields = [
+        'upload', 'stage', 'wall_time', 'cpu_time', 'peak_rss', 'rows']
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['percentiles'] = PERCENTILES
+        extra_context['stage_statistics'] = self.stage_statistics()
+        return super(UploadStageTimingAdmin, self).changelist_view(
+            request, extra_context=extra_context)
+
+    def stage_statistics(self):
+        """Return, per stage, the number of uploads and percentiles of
+        wall time, CPU time, peak RSS and seconds per 1000 rows."""
+        values = defaultdict(lambda: defaultdict(list))
+        for stage, wall_time, cpu_time, peak_rss, rows in (
+            UploadStageTiming.objects.values_list(
+                'stage', 'wall_time', 'cpu_time', 'peak_rss', 'rows')):
+            values[stage]['wall_time'].append(wall_time)
+            values[stage]['cpu_time'].append(cpu_time)
+            if peak_rss is not None:
+                values[stage]['peak_rss'].append(peak_rss)
+            if rows:
+                values[stage]['per_1000_rows'].append(
+                    1000 * wall_time / rows)
+
+        statistics = []
+        for stage, label in STAGES:
+            if stage not in values:
+                continue
+            row = {'stage': label, 'count': len(values[stage]['wall_time'])}
+            for key in ('wall_time', 'cpu_time', 'peak_rss',
+                        'per_1000_rows'):
+                sorted_values = sorted(values[stage][key])
+                row[key] = [percentile(sorted_values, p)
+                            for p in PERCENTILES]
+            statistics.append(row)
+        return statistics
+
+
+class UploadBatchAdmin(admin.ModelAdmin):
+    list_display = ['__unicode__', 'the_time', 'status', 'upload_counts']
+    readonly_fields = ['error_message']
+
+    def upload_counts(self, obj):
+        return ", ".join(
+            "{0}: {1}".format(status, count)
+            for status, count in sorted(obj.status_counts().iteritems()))
+    upload_counts.short_description = "Uploads"
 
 admin.site.register(Upload, UploadAdmin)
+admin.site.register(UploadBatch, UploadBatchAdmin)
+admin.site.register(UploadStageTiming, UploadStageTimingAdmin)
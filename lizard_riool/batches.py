@@ -0,0 +1,95 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""ZIP files with many RIB/RMB pairs, uploaded as one UploadBatch.
+
+The RIB and RMB members are streamed out of the ZIP file straight into
+the directories of new Uploads, so each file is written to disk only
+once, and hashed on the way (see Upload.content_hash); the ZIP file
+itself is removed afterwards. Members are paired by name like
+Upload.find_relevant_rib does, but only within the batch, and each pair
+is processed by its own Celery task (see tasks.process_batch).
+"""
+
+from contextlib import closing
+import logging
+import os
+import zipfile
+
+from lizard_riool import models
+
+logger = logging.getLogger(__name__)
+
+SUFFIXES = ('.rib', '.rmb')
+
+# Members are copied in blocks of this size (bytes).
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_batch(filename):
+    return filename.lower().endswith('.zip')
+
+
+def extract(batch):
+    """Extract the RIB and RMB files in the ZIP file of a batch into new
+    Uploads of the batch, which are returned. Other members, and
+    members with the name of an earlier one, are skipped. Raises
+    zipfile.BadZipfile if it isn't a ZIP file; if extracting fails
+    halfway, the Uploads made so far are left being processed."""
+    uploads = []
+    seen = set()
+
+    with closing(zipfile.ZipFile(batch.zip_path)) as archive:
+        for info in archive.infolist():
+            filename = os.path.basename(info.filename)
+            if (info.filename.startswith('__MACOSX/') or
+                os.path.splitext(filename)[1].lower() not in SUFFIXES):
+                continue
+            if filename.lower() in seen:
+                logger.warn("Skipped %s in %s, the name occurs twice",
+                            info.filename, batch)
+                continue
+            seen.add(filename.lower())
+
+            upload = models.Upload(
+                batch=batch, status=models.Upload.BEING_PROCESSED)
+            upload.save()
+            if not os.path.exists(upload.directory):
+                os.makedirs(upload.directory)
+            path = os.path.join(upload.directory, filename)
+            hasher = models.content_hasher()
+            with closing(archive.open(info)) as source:
+                with open(path, 'wb') as target:
+                    for block in iter(
+                        lambda: source.read(CHUNK_SIZE), ''):
+                        target.write(block)
+                        hasher.update(block)
+            upload.the_file = path
+            upload.content_hash = hasher.hexdigest()
+            upload.save()
+            uploads.append(upload)
+
+    os.remove(batch.zip_path)
+    return uploads
+
+
+def pair(uploads):
+    """Return a list of (rib, rmb) pairs of uploads with the same name.
+    Uploads without a partner are rejected."""
+    by_name = {}
+    for upload in uploads:
+        name = os.path.splitext(upload.filename)[0].lower()
+        by_name.setdefault(name, {})[upload.suffix.lower()] = upload
+
+    pairs = []
+    for name, files in sorted(by_name.iteritems()):
+        if '.rib' in files and '.rmb' in files:
+            pairs.append((files['.rib'], files['.rmb']))
+        elif '.rmb' in files:
+            files['.rmb'].record_error(
+                "Bijbehorende RIB file niet gevonden in het ZIP bestand.")
+            files['.rmb'].set_unsuccessful()
+        else:
+            files['.rib'].record_error(
+                "Bijbehorende RMB file niet gevonden in het ZIP bestand.")
+            files['.rib'].set_unsuccessful()
+    return pairs
@@ -0,0 +1,163 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Benchmarks of processing the sample RIB/RMB pairs in data/.
+
+Each pair is processed like an upload (see tasks.process_uploaded_file),
+in a transaction that is rolled back afterwards, on copies of the files.
+The resources used per stage are those measured by progress.Progress.
+Results can be stored as a baseline (JSON) and later runs compared with
+it, see the benchmark_processing management command.
+"""
+
+from collections import defaultdict
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from django.db import transaction
+
+from lizard_riool import models
+from lizard_riool import progress
+from lizard_riool import save_uploaded_data
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+# Sewerage names get this prefix, so they can't clash with real ones.
+NAME_PREFIX = 'benchmark_'
+
+# A stage has regressed if it got slower (or used more memory) by more
+# than the tolerance, and by more than these absolute amounts; small
+# stages are too noisy to compare relatively.
+MIN_WALL_TIME_DIFFERENCE = 0.1  # Seconds
+MIN_PEAK_RSS_DIFFERENCE = 10 * 1024  # kB
+
+
+def sample_pairs(directory=DATA_DIR):
+    """Return a sorted list of (name, rib path, rmb path) of all RIB/RMB
+    pairs in directory. Like Upload.find_relevant_rib, names are
+    matched case insensitively; a pair gets the name of its RMB file,
+    which is what its sewerage is called."""
+    files = defaultdict(dict)
+    for filename in sorted(os.listdir(directory)):
+        name, suffix = os.path.splitext(filename)
+        if suffix.lower() in ('.rib', '.rmb'):
+            files[name.lower()][suffix.lower()] = (
+                name, os.path.join(directory, filename))
+
+    return sorted(
+        (paths['.rmb'][0], paths['.rib'][1], paths['.rmb'][1])
+        for paths in files.itervalues()
+        if '.rib' in paths and '.rmb' in paths)
+
+
+@transaction.commit_manually
+def process_pair(name, rib_path, rmb_path):
+    """Process a RIB/RMB pair and roll everything back. Returns the
+    list of timings of progress.Progress and a list of error messages,
+    empty if processing was successful. Files that are rejected are
+    still useful: the stages up to validation were measured. An
+    exception is reported as an error too."""
+    temp_dir = tempfile.mkdtemp()
+    upload_progress = progress.Progress()
+
+    try:
+        uploads = []
+        for path in (rib_path, rmb_path):
+            copy = os.path.join(
+                temp_dir, NAME_PREFIX + name + os.path.splitext(path)[1])
+            shutil.copy(path, copy)
+            uploads.append(models.Upload.objects.create(the_file=copy))
+        rib_upload, rmb_upload = uploads
+
+        save_uploaded_data.protected_file_processing(
+            rib_upload, rmb_upload, upload_progress)
+        upload_progress.finish()
+
+        errors = []
+        if rmb_upload.status != models.Upload.SUCCESSFUL:
+            errors = [
+                error.message() for error in
+                models.UploadedFileError.objects.filter(
+                    uploaded_file__in=uploads)]
+
+        return upload_progress.timings, errors
+    except Exception as e:
+        logger.exception("Could not process %s", name)
+        upload_progress.finish()
+        return upload_progress.timings, ["Exception: {0}".format(e)]
+    finally:
+        transaction.rollback()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        # The files may have been moved to the directory of a new
+        # sewerage, also if processing failed later on. Find them by
+        # name; after an error the database can't be asked.
+        for path in glob.glob(os.path.join(
+                models.Sewerage.BASE_PATH, '*', NAME_PREFIX + name + '.*')):
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def run(pairs, repeat=1):
+    """Benchmark pairs, return {name: {stage: timing}} and a dictionary
+    {name: error messages} of pairs that were rejected. With repeat > 1,
+    each stage gets the run with the lowest wall time."""
+    results = {}
+    failures = {}
+    for name, rib_path, rmb_path in pairs:
+        best = {}
+        for _ in xrange(repeat):
+            timings, errors = process_pair(name, rib_path, rmb_path)
+            if errors:
+                failures[name] = errors
+            for timing in timings:
+                stage = timing['stage']
+                if (stage not in best or
+                    timing['wall_time'] < best[stage]['wall_time']):
+                    best[stage] = timing
+        results[name] = best
+        logger.info("Benchmarked %s", name)
+    return results, failures
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def regressions(results, baseline, tolerance):
+    """Return a list of descriptions of the stages in results that are
+    slower or use more memory than in baseline."""
+    found = []
+
+    def worse(current, base, min_difference):
+        return (current is not None and base is not None and
+                current > base * (1 + tolerance) and
+                current - base > min_difference)
+
+    for name, stages in sorted(results.iteritems()):
+        for stage, timing in sorted(stages.iteritems()):
+            base = baseline.get(name, {}).get(stage)
+            if base is None:
+                continue
+            if worse(timing['wall_time'], base['wall_time'],
+                     MIN_WALL_TIME_DIFFERENCE):
+                found.append("{0}, {1}: {2:.2f} s, was {3:.2f} s".format(
+                        name, stage, timing['wall_time'],
+                        base['wall_time']))
+            if worse(timing['peak_rss'], base['peak_rss'],
+                     MIN_PEAK_RSS_DIFFERENCE):
+                found.append("{0}, {1}: peak {2} kB, was {3} kB".format(
+                        name, stage, timing['peak_rss'], base['peak_rss']))
+    return found
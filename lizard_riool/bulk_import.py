@@ -0,0 +1,115 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Importing many RIB/RMB pairs at once.
+
+When a municipality is onboarded, hundreds of pairs arrive together.
+Instead of uploading them one by one, the import_sewerages management
+command finds the pairs in a directory and processes them in a pool of
+worker processes. Each pair becomes a pair of Uploads, processed by
+tasks.process_upload_pair like an upload through the site, so errors
+and stage timings show up on the upload pages as usual.
+"""
+
+from itertools import imap
+import logging
+import multiprocessing
+import time
+
+from django.db import connections
+
+from lizard_riool import benchmark
+from lizard_riool import models
+from lizard_riool import tasks
+
+logger = logging.getLogger(__name__)
+
+# Workers are replaced after this many pairs, so that memory left
+# behind by big networks is given back.
+PAIRS_PER_WORKER = 10
+
+
+def find_pairs(directory):
+    """Return a sorted list of (name, rib path, rmb path) in directory,
+    matched like Upload.find_relevant_rib does: case insensitively,
+    named after the RMB file."""
+    return benchmark.sample_pairs(directory)
+
+
+def existing_names(pairs):
+    """Return the names of pairs that already have a sewerage. Names
+    are compared case insensitively, like files are paired."""
+    sewerage_names = set(
+        name.lower() for name in
+        models.Sewerage.objects.values_list('name', flat=True))
+    return set(name for name, _, _ in pairs
+               if name.lower() in sewerage_names)
+
+
+def close_connections():
+    """Close the database connections of this process. A forked worker
+    must not use the connections of its parent; Django opens new ones
+    when needed."""
+    for connection in connections.all():
+        connection.close()
+
+
+def import_pair(pair):
+    """Import a RIB/RMB pair, copying the files into new Uploads.
+    Returns a dictionary with the name, whether it was successful, the
+    seconds it took, the stage timings and the error messages."""
+    name, rib_path, rmb_path = pair
+    started = time.time()
+    timings = []
+
+    try:
+        uploads = []
+        for path in (rib_path, rmb_path):
+            upload = models.Upload(status=models.Upload.BEING_PROCESSED)
+            upload.move_file(path, copy=True)
+            uploads.append(upload)
+        rib, rmb = uploads
+
+        if tasks.check_upload_pair(rib, rmb):
+            timings = tasks.process_upload_pair(rib, rmb).timings
+
+        successful = rmb.status == models.Upload.SUCCESSFUL
+        errors = [] if successful else [
+            error.message() for error in
+            models.UploadedFileError.objects.filter(
+                uploaded_file__in=uploads)]
+    except Exception as e:
+        # Don't let one pair stop the others
+        logger.exception("Could not import %s", name)
+        successful = False
+        errors = ["Exception: {0}".format(e)]
+
+    return {
+        'name': name,
+        'successful': successful,
+        'seconds': time.time() - started,
+        'timings': timings,
+        'errors': errors,
+        }
+
+
+def run(pairs, processes=None):
+    """Import pairs in `processes` worker processes (default: one per
+    CPU), yielding the results of import_pair as pairs are done. With
+    processes=1 everything runs in this process."""
+    if processes == 1:
+        for result in imap(import_pair, pairs):
+            yield result
+        return
+
+    close_connections()  # Don't hand them down to the workers
+    pool = multiprocessing.Pool(
+        processes, initializer=close_connections,
+        maxtasksperchild=PAIRS_PER_WORKER)
+    try:
+        for result in pool.imap_unordered(import_pair, pairs):
+            logger.info("Imported %s", result['name'])
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,126 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""A size-bounded cache of files on disk.
+
+Entries are files in a directory tree; the key of an entry is the list
+of path components leading to it, e.g. (sewerage_id, zoom, x, y). When
+the total size of the tree grows beyond its maximum, the least recently
+used entries are removed. Reading an entry touches it, so that it counts
+as recently used.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Eviction leaves the tree at this fraction of its maximum size, so that
+# the next writes don't walk it again right away.
+EVICT_TO = 0.9
+
+
+class DiskCache(object):
+
+    def __init__(self, directory, max_size, suffix=''):
+        self.directory = directory
+        self.max_size = max_size  # In bytes
+        self.suffix = suffix
+        # Walking the tree on every write would be too slow, so the
+        # total size is kept up to date by adding the bytes written
+        # and only walked for eviction. None until the first walk.
+        # Writes by other processes are only seen at the next walk.
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        "Return the path of the file for key."
+        parts = [str(part) for part in key]
+        parts[-1] += self.suffix
+        return os.path.join(self.directory, *parts)
+
+    def get(self, key):
+        "Return the contents stored under key, or None."
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass  # Evicted in the meantime, no problem.
+
+        return data
+
+    def put(self, key, data):
+        """Store data under key. Writing to a temporary file and renaming
+        it makes sure readers never see a half written file."""
+        path = self.path(key)
+        directory = os.path.dirname(path)
+
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Created by another process.
+
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data)
+            check = self.size is None or self.size > self.max_size
+        if check:
+            self.evict()
+
+    def invalidate(self, key_prefix=()):
+        "Remove all entries whose key starts with key_prefix."
+        path = os.path.join(
+            self.directory, *[str(part) for part in key_prefix])
+        shutil.rmtree(path, ignore_errors=True)
+
+    def evict(self):
+        """If the total size is above max_size, remove least recently
+        used entries until it is below EVICT_TO of it. Remembers the
+        size that is left."""
+        entries = []
+        total_size = 0
+
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+                total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            with self.lock:
+                self.size = total_size
+            return
+
+        target_size = self.max_size * EVICT_TO
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            if total_size <= target_size:
+                break
+
+        with self.lock:
+            self.size = total_size
+        logger.debug("Evicted entries from %s, %d bytes left",
+                     self.directory, total_size)
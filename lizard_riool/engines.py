@@ -0,0 +1,220 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Comparing engines that compute water levels.
+
+An engine is a function (G, sink_nodes) that sets the 'waterlevel' of
+the nodes in a graph made by lost_capacity.create_graph. Before a
+faster engine replaces compute_water_level, it should give the same
+water levels, and the same flooded percentages of the measurements,
+on the sample files and on random synthetic networks. `compare` runs
+all engines on a network and reports the differences and timings, see
+also the compare_engines management command.
+
+Networks are built from the files in memory, with unsaved model
+instances, the same way save_uploaded_data.save_into_database does.
+"""
+
+from collections import OrderedDict
+import shutil
+import tempfile
+import time
+
+from django.contrib.gis.geos import LineString
+from django.contrib.gis.geos import Point
+
+from lizard_riool import lost_capacity
+from lizard_riool import models
+from lizard_riool import parse_cache
+from lizard_riool import save_uploaded_data
+from lizard_riool import synthetic
+
+# The first engine is the reference the others are compared with.
+ENGINES = OrderedDict([
+    ('networkx', lost_capacity.compute_water_level),
+    ('priority_flood', lost_capacity.priority_flood),
+])
+
+# Water levels and flooded percentages may differ this much.
+TOLERANCE = 1e-9
+
+# Number of differences listed per engine.
+MAX_EXAMPLES = 5
+
+
+def unsaved_network(rib_path, rmb_path):
+    """Return (puts, sewers, measurements_dict) like save_into_database
+    passes to compute_lost_capacity, without touching the database.
+    Raises ValueError if the files have errors."""
+    ribinstance, riberrors = parse_cache.parse(rib_path)
+    rmbinstance, rmberrors = parse_cache.parse(rmb_path)
+    if not ribinstance or not rmbinstance:
+        raise ValueError("Could not parse {0} and {1}".format(
+                rib_path, rmb_path))
+
+    putdict = save_uploaded_data.get_puts(ribinstance, riberrors)
+    sewerdict = save_uploaded_data.get_sewers(
+        ribinstance, putdict, riberrors)
+    lines = save_uploaded_data.mrio_lines_by_sewer_id(rmbinstance)
+    for sewerinfo in sewerdict.itervalues():
+        sewerinfo['measurements'] = save_uploaded_data.get_mrio(
+            lines, putdict, sewerinfo, rmberrors)
+
+    errors = riberrors + rmberrors
+    if not putdict or not sewerdict:
+        raise ValueError("No manholes or sewers in {0}".format(rib_path))
+    if errors:
+        raise ValueError("{0} errors, first: line {1}: {2}".format(
+                len(errors), errors[0].line_number, errors[0].message))
+
+    puts = dict(
+        (put_id, models.Manhole(
+                code=put_id,
+                sink=int(putinfo['is_sink']),
+                ground_level=putinfo['surface_level'],
+                the_geom=Point(*putinfo['coordinate']),
+                the_geom_rd=Point(*putinfo['rd_coordinate'],
+                                  srid=models.RDNEW)))
+        for put_id, putinfo in putdict.iteritems())
+
+    sewers = {}
+    measurements_dict = {}
+    for sewer_id, sewerinfo in sewerdict.iteritems():
+        manhole1 = puts[sewerinfo['manhole_code_1']]
+        manhole2 = puts[sewerinfo['manhole_code_2']]
+        sewer_line_rd = LineString(
+            manhole1.the_geom_rd, manhole2.the_geom_rd, srid=models.RDNEW)
+        sewer = models.Sewer(
+            code=sewer_id,
+            quality=models.Sewer.QUALITY_UNKNOWN,
+            diameter=sewerinfo['diameter'],
+            manhole1=manhole1,
+            manhole2=manhole2,
+            bob1=sewerinfo['bob_1'],
+            bob2=sewerinfo['bob_2'],
+            the_geom=LineString(manhole1.the_geom, manhole2.the_geom),
+            the_geom_rd=sewer_line_rd,
+            the_geom_length=sewer_line_rd.length)
+        sewers[sewer_id] = sewer
+        measurements_dict[sewer_id] = (
+            save_uploaded_data.build_sewer_measurements(
+                sewer, sewerinfo['measurements']))
+
+    return puts, sewers, measurements_dict
+
+
+def synthetic_network(pipes, seed, **kwargs):
+    """Return an unsaved network of a random synthetic sewerage, see
+    synthetic.generate for the keyword arguments."""
+    directory = tempfile.mkdtemp()
+    try:
+        rib_path, rmb_path, _ = synthetic.generate(
+            directory, 'synthetic_{0}'.format(seed), pipes, seed=seed,
+            **kwargs)
+        return unsaved_network(rib_path, rmb_path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def close(value1, value2):
+    if value1 is None or value2 is None:
+        return value1 is value2
+    return abs(value1 - value2) <= TOLERANCE
+
+
+def differences(reference, other):
+    "Return the sorted keys whose values differ in two dictionaries."
+    return sorted(
+        key for key in set(reference) | set(other)
+        if not close(reference.get(key), other.get(key)))
+
+
+def compare(puts, sewers, measurements_dict, engines=ENGINES):
+    """Run all engines on a network. Returns a dictionary with the
+    number of nodes, the seconds each engine took and, per engine other
+    than the first, the nodes and measurements (sewer id, dist) whose
+    water level or flooded percentage differs from the first."""
+    levels = {}
+    flooded = {}
+    seconds = {}
+
+    for name, engine in engines.iteritems():
+        G, sink_nodes = lost_capacity.create_graph(
+            puts, sewers, measurements_dict)
+
+        started = time.time()
+        engine(G, sink_nodes)
+        seconds[name] = time.time() - started
+
+        lost_capacity.add_lost_capacity(measurements_dict, sewers, G)
+        levels[name] = dict(
+            (node, data['waterlevel'])
+            for node, data in G.nodes_iter(data=True))
+        flooded[name] = dict(
+            ((sewer_id, measurement.dist), measurement.flooded_pct)
+            for sewer_id, measurements in measurements_dict.iteritems()
+            for measurement in measurements)
+
+    reference = engines.keys()[0]
+    return {
+        'nodes': len(levels[reference]),
+        'seconds': seconds,
+        'level_differences': dict(
+            (name, differences(levels[reference], levels[name]))
+            for name in engines if name != reference),
+        'flooded_differences': dict(
+            (name, differences(flooded[reference], flooded[name]))
+            for name in engines if name != reference),
+        }
+
+
+def sample_networks(pairs):
+    """Yield (name, network) of sample RIB/RMB pairs (see
+    benchmark.sample_pairs). Pairs with errors yield the ValueError
+    instead of a network."""
+    for name, rib_path, rmb_path in pairs:
+        try:
+            yield name, unsaved_network(rib_path, rmb_path)
+        except ValueError as e:
+            yield name, e
+
+
+def synthetic_networks(count, pipes, seed=0):
+    """Yield (name, network) of `count` random synthetic networks of
+    `pipes` sewers, alternately trees and looped networks."""
+    for n in xrange(count):
+        topology = ('tree', 'looped')[n % 2]
+        name = 'synthetic {0} {1} {2}'.format(topology, pipes, seed + n)
+        yield name, synthetic_network(
+            pipes, seed + n, topology=topology,
+            spacing=(0.5, 1.0, 2.0)[n % 3])
+
+
+def describe(name, comparison, engines=ENGINES):
+    "Return lines describing a comparison."
+    reference = engines.keys()[0]
+    lines = ["{0}: {1} nodes, {2} {3:.3f} s".format(
+            name, comparison['nodes'], reference,
+            comparison['seconds'][reference])]
+
+    for engine in engines:
+        if engine == reference:
+            continue
+        seconds = comparison['seconds'][engine]
+        speedup = (comparison['seconds'][reference] / seconds
+                   if seconds else float('inf'))
+        level_differences = comparison['level_differences'][engine]
+        flooded_differences = comparison['flooded_differences'][engine]
+        lines.append(
+            "  {0}: {1:.3f} s ({2:.1f}x), {3} water levels and {4} "
+            "flooded percentages differ".format(
+                engine, seconds, speedup, len(level_differences),
+                len(flooded_differences)))
+        for key in (level_differences[:MAX_EXAMPLES] +
+                    flooded_differences[:MAX_EXAMPLES]):
+            lines.append("    {0!r}".format(key))
+    return lines
+
+
+def has_differences(comparison):
+    return any(comparison['level_differences'].values() +
+               comparison['flooded_differences'].values())
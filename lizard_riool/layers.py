@@ -1,9 +1,8 @@
+import functools
 import logging
 import os
 
 from django.conf import settings
-from django.contrib.gis import geos
-from django.contrib.gis.geos import fromstr
 from staticfiles import finders
 import mapnik
 
@@ -11,10 +10,15 @@ from lizard_map.models import ICON_ORIGINALS
 from lizard_map.symbol_manager import SymbolManager
 from lizard_map.workspace import WorkspaceItemAdapter
 
+from lizard_riool.models import LostCapacitySegment
 from lizard_riool.models import Manhole
 from lizard_riool.models import Sewer
+from lizard_riool.models import Sewerage
 from lizard_riool.models import SewerMeasurement
 from lizard_riool.models import CLASSES
+from lizard_riool.models import UNKNOWN_CLASS
+from lizard_riool.models import get_class_boundaries
+from lizard_riool import spatial_index
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +30,14 @@ SYMBOL_MANAGER = SymbolManager(ICON_ORIGINALS, GENERATED_ICONS)
 RIOOL_ICON = 'pixel2.png'
 RIOOL_ICON_LARGE = 'pixel16.png'
 
+# Scale denominators at which lost capacity is drawn differently. Up to
+# POINTS_MAX_SCALE every measurement is drawn, up to SEGMENTS_MAX_SCALE
+# the stretches of sewer with equal class, and beyond that whole sewers
+# in the color of their worst class.
+POINTS_MAX_SCALE = 5000
+SEGMENTS_MAX_SCALE = 25000
+SEWERS_MAX_SCALE = 500000
+
 DATABASE = settings.DATABASES['default']
 PARAMS = {
     'host': DATABASE['HOST'],
@@ -43,12 +55,273 @@ def html_to_mapnik(color):
     return rr / 255.0, gg / 255.0, bb / 255.0, 1.0
 
 
+def memoize_on_classes(function):
+    """Cache the result of function per process, by its arguments and the
+    contents of CLASSES. Used for Mapnik styles and legend entries, that
+    would otherwise be built again for every tile."""
+    cache = {}
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        key = (CLASSES, args, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = function(*args, **kwargs)
+        return cache[key]
+
+    return wrapper
+
+
+@memoize_on_classes
+def class_line_style(field, min_scale=None):
+    """Return a style that draws lines in the color of the lost capacity
+    class in field."""
+    style = mapnik.Style()
+
+    for klasse, _, _, _, color in CLASSES:
+        rule = mapnik.Rule()
+        if min_scale is not None:
+            rule.min_scale = min_scale
+        rule.filter = mapnik.Filter(str("[%s] = '%s'" % (field, klasse)))
+        symbol = mapnik.LineSymbolizer(mapnik.Color(str('#' + color)), 2.0)
+        rule.symbols.append(symbol)
+        style.rules.append(rule)
+
+    return style
+
+
+@memoize_on_classes
+def legend_entries():
+    "Return the entries of the legend of the sewerage layer."
+    legend = []
+
+    # Lost capacity classes
+
+    for name, description, _, _, color in CLASSES:
+        r, g, b, a = html_to_mapnik(color)
+        icon = SYMBOL_MANAGER.get_symbol_transformed(
+            RIOOL_ICON_LARGE, color=(r, g, b, a)
+        )
+        legend.append({
+            'img_url': os.path.join(MEDIA_URL, 'generated_icons', icon),
+            'description': "klasse {0} ({1})".format(name, description),
+        })
+
+    # Insufficient measurements
+
+    legend.append({
+        'img_url': os.path.join(
+            STATIC_URL, 'lizard_riool/sewer-label-red.png'
+         ),
+        'description': 'Onvoldoende metingen'
+    })
+
+    # Sufficient measurements
+
+    legend.append({
+        'img_url': os.path.join(
+            STATIC_URL, 'lizard_riool/sewer-label-green.png'
+         ),
+        'description': 'Voldoende metingen'
+    })
+
+    # No measurements
+
+    legend.append({
+        'img_url': os.path.join(
+            STATIC_URL, 'lizard_riool/sewer-label-blue.png'
+         ),
+        'description': 'Geen metingen'
+    })
+
+    return legend
+
+
+@memoize_on_classes
+def measurement_style():
+    "Return the style of the measurement layer."
+    style = mapnik.Style()
+
+    for klasse, _, _, _, color in CLASSES:
+
+        r, g, b, a = html_to_mapnik(color)
+
+        icon = SYMBOL_MANAGER.get_symbol_transformed(
+            RIOOL_ICON, color=(r, g, b, a)
+        )
+
+        rule = mapnik.Rule()
+        rule.filter = mapnik.Filter(str("[klasse] = '%s'" % klasse))
+        symbol = mapnik.PointSymbolizer(
+            os.path.join(GENERATED_ICONS, icon), "png", 16, 16
+        )
+        symbol.allow_overlap = True
+        rule.symbols.append(symbol)
+        style.rules.append(rule)
+
+    return style
+
+
+@memoize_on_classes
+def sewer_style():
+    "Return the style of the sewer labels."
+    style = mapnik.Style()
+
+    # QUALITY_UNKNOWN
+
+    rule = mapnik.Rule()
+    rule.filter = mapnik.Filter(
+        "[quality] = {}".format(Sewer.QUALITY_UNKNOWN)
+    )
+    rule.max_scale = 1700
+    symbol = mapnik.TextSymbolizer(
+        'code', 'DejaVu Sans Book', 10, mapnik.Color('blue')
+    )
+    symbol.allow_overlap = True
+#   symbol.label_placement = mapnik.label_placement.LINE_PLACEMENT
+    rule.symbols.append(symbol)
+    style.rules.append(rule)
+
+    # QUALITY_RELIABLE
+
+    rule = mapnik.Rule()
+    rule.filter = mapnik.Filter(
+        "[quality] = {}".format(Sewer.QUALITY_RELIABLE)
+    )
+    rule.max_scale = 1700
+    symbol = mapnik.TextSymbolizer(
+        'code', 'DejaVu Sans Book', 10, mapnik.Color('green')
+    )
+    symbol.allow_overlap = True
+#   symbol.label_placement = mapnik.label_placement.LINE_PLACEMENT
+    symbol.allow_overlap = True
+    symbol.opacity = 1.0
+    rule.symbols.append(symbol)
+    style.rules.append(rule)
+
+    # QUALITY_UNRELIABLE
+
+    rule = mapnik.Rule()
+    rule.filter = mapnik.Filter(
+        "[quality] = {}".format(Sewer.QUALITY_UNRELIABLE)
+    )
+    rule.max_scale = 1700
+    symbol = mapnik.TextSymbolizer(
+        'code', 'DejaVu Sans Book', 10, mapnik.Color('red')
+    )
+    symbol.allow_overlap = True
+#   symbol.label_placement = mapnik.label_placement.LINE_PLACEMENT
+#   symbol.displacement(16, 16)  # slightly above
+    rule.symbols.append(symbol)
+    style.rules.append(rule)
+
+    return style
+
+
+@memoize_on_classes
+def manhole_style():
+    "Return the style of the manhole layer."
+    style = mapnik.Style()
+
+    # Style the `normal` manholes.
+
+    rule = mapnik.Rule()
+    rule.filter = mapnik.Filter("[sink] != 1")
+    symbol = mapnik.PointSymbolizer()
+    symbol.allow_overlap = True
+    rule.symbols.append(symbol)
+    style.rules.append(rule)
+
+    # Style the sink.
+
+    rule = mapnik.Rule()
+    rule.filter = mapnik.Filter("[sink] = 1")
+    symbol = mapnik.PointSymbolizer(
+        str(finders.find("lizard_riool/sink.png")), "png", 8, 8
+    )
+    symbol.allow_overlap = True
+    rule.symbols.append(symbol)
+    style.rules.append(rule)
+
+    # Add labels.
+
+    rule = mapnik.Rule()
+    rule.max_scale = 1700
+    symbol = mapnik.TextSymbolizer(
+        'code', 'DejaVu Sans Book', 10, mapnik.Color('black')
+    )
+    symbol.allow_overlap = True
+    symbol.label_placement = mapnik.label_placement.POINT_PLACEMENT
+    symbol.vertical_alignment = mapnik.vertical_alignment.TOP
+    symbol.displacement(0, -5)  # slightly above
+    rule.symbols.append(symbol)
+    style.rules.append(rule)
+
+    return style
+
+
+@memoize_on_classes
+def sewerage_style():
+    "Return the style of the per-sewerage points of the overview layer."
+    style = mapnik.Style()
+
+    rule = mapnik.Rule()
+    symbol = mapnik.PointSymbolizer()
+    symbol.allow_overlap = True
+    rule.symbols.append(symbol)
+    symbol = mapnik.TextSymbolizer(
+        'name', 'DejaVu Sans Book', 10, mapnik.Color('black')
+    )
+    symbol.label_placement = mapnik.label_placement.POINT_PLACEMENT
+    symbol.vertical_alignment = mapnik.vertical_alignment.TOP
+    symbol.displacement(0, -5)  # slightly above
+    rule.symbols.append(symbol)
+    style.rules.append(rule)
+
+    return style
+
+
 def default_database_params():
     """Get default database params. Use a copy of the dictionary
     because it is mutated by the functions that use it."""
     return PARAMS.copy()
 
 
+def class_sql(column):
+    """Return an SQL expression for the lost capacity class of a fraction
+    in column, equivalent to get_class_boundaries()."""
+    whens = ' '.join(
+        "WHEN {0} >= {1} AND {0} < {2} THEN '{3}'".format(
+            column, min_pct, max_pct, klasse)
+        for klasse, _, min_pct, max_pct, _ in CLASSES
+        if klasse != UNKNOWN_CLASS[0])
+    return "CASE {0} ELSE '{1}' END".format(whens, UNKNOWN_CLASS[0])
+
+
+def postgis_datasource(sql):
+    """Return a Mapnik PostGIS datasource for a query. The query selects
+    only the columns the styles need and should restrict itself to
+    `the_geom && !bbox!`, which Mapnik replaces by the extent of the
+    tile being rendered."""
+    params = default_database_params()
+    params['table'] = "({0}) data".format(sql)
+    params['geometry_field'] = 'the_geom'
+    return mapnik.PostGIS(**params)
+
+
+def google_extent(extents):
+    """Return the combined extent of some stored Sewerage.extent_google
+    polygons as a dictionary, or None if there are none."""
+    extents = [extent.extent for extent in extents if extent is not None]
+    if not extents:
+        return None
+    return {
+        'west': min(extent[0] for extent in extents),
+        'south': min(extent[1] for extent in extents),
+        'east': max(extent[2] for extent in extents),
+        'north': max(extent[3] for extent in extents),
+    }
+
+
 class SewerageAdapter(WorkspaceItemAdapter):
 
     def __init__(self, *args, **kwargs):
@@ -56,21 +329,20 @@ class SewerageAdapter(WorkspaceItemAdapter):
         self.id = int(self.layer_arguments['id'])
         logger.debug("Sewerage.pk=%d", self.id)
 
+    def sewerage_condition(self, column):
+        "Return an SQL condition on column that selects our sewerage."
+        return "{0} = {1}".format(column, self.id)
+
     def extent(self, identifiers=None):
         "Return the sewerage extent in Google projection."
 
-        qs = Manhole.objects.filter(sewerage__pk=self.id)
+        extents = (
+            Sewerage.objects.filter(pk=self.id).
+            values_list('extent_google', flat=True)
+        )
 
-        if qs.count() < 1:
-            return super(SewerageAdapter, self).extent(identifiers)
-        else:
-            box = fromstr('MULTIPOINT (%s %s, %s %s)' % qs.extent())
-            box.set_srid(qs[0].the_geom.srid)
-            box.transform(3857)  # aka 900913
-            return {
-                'west': box[0].x, 'south': box[0].y,  # xmin, ymin
-                'east': box[1].x, 'north': box[1].y,  # xmax, ymax
-            }
+        return google_extent(extents) or super(
+            SewerageAdapter, self).extent(identifiers)
 
     def search(self, x, y, radius=None):
         """Find the nearest SewerMeasurement.
@@ -79,279 +351,230 @@ class SewerageAdapter(WorkspaceItemAdapter):
         the minimal amount of information necessary to show
         the so-called `lost capacity`.
 
-        """
-        pnt = geos.Point(x, y, srid=3857)  # aka 900913
+        The lookup is answered from an in-memory index of the
+        sewerage, see spatial_index.py.
 
-        qs = (
-            SewerMeasurement.objects.
-            filter(sewer__sewerage__pk=self.id).
-            filter(the_geom__distance_lte=(pnt, radius)).
-            distance(pnt).order_by('distance')
-        )
+        """
+        return self.search_result(
+            spatial_index.nearest_measurement(self.id, x, y, radius))
 
-        try:
-            m = qs[0]  # SELECT ... LIMIT 1;
-        except:
+    def search_result(self, found):
+        """Turn the result of spatial_index.nearest_measurement() into
+        search results."""
+        if found is None:
             return []
 
+        distance, (pk, flooded_pct, sewer_code) = found
+        klasse = get_class_boundaries(flooded_pct)[0]
+
+        if flooded_pct is None:
+            name = 'Streng {0}: verloren berging onbekend'.format(sewer_code)
+        else:
+            name = 'Streng {0}: {1:.0%} verloren berging (klasse {2})'.format(
+                sewer_code, flooded_pct, klasse)
+
         return [{
-            'name': '{:.0%} verloren berging'.format(m.flooded_pct),
-            'distance': m.distance.m,
-            'stored_graph_id': m.pk,
+            'name': name,
+            'distance': distance,
+            'stored_graph_id': pk,
+            'sewer': sewer_code,
+            'klasse': klasse,
         }]
 
     def legend(self, updates=None):
         """Return a legend describing the different classes of lost capacity.
 
-        A `legend` is simply a list of dictionaries.
+        A `legend` is simply a list of dictionaries. The entries are
+        built once per process, so return copies.
 
         """
-        legend = []
-
-        # Lost capacity classes
-
-        for name, description, _, _, color in CLASSES:
-            r, g, b, a = html_to_mapnik(color)
-            icon = SYMBOL_MANAGER.get_symbol_transformed(
-                RIOOL_ICON_LARGE, color=(r, g, b, a)
-            )
-            legend.append({
-                'img_url': os.path.join(MEDIA_URL, 'generated_icons', icon),
-                'description': "klasse {0} ({1})".format(name, description),
-            })
-
-        # Insufficient measurements
-
-        legend.append({
-            'img_url': os.path.join(
-                STATIC_URL, 'lizard_riool/sewer-label-red.png'
-             ),
-            'description': 'Onvoldoende metingen'
-        })
-
-        # Sufficient measurements
-
-        legend.append({
-            'img_url': os.path.join(
-                STATIC_URL, 'lizard_riool/sewer-label-green.png'
-             ),
-            'description': 'Voldoende metingen'
-        })
-
-        # No measurements
-
-        legend.append({
-            'img_url': os.path.join(
-                STATIC_URL, 'lizard_riool/sewer-label-blue.png'
-             ),
-            'description': 'Geen metingen'
-        })
-
-        return legend
+        return [dict(entry) for entry in legend_entries()]
 
     def layer(self, layer_ids=None, request=None):
-        "Return Mapnik layers and styles."
+        """Return Mapnik layers and styles. If the WMS request is for
+        the resolution of a tile zoom level, the cached tiles are drawn
+        (see tiles.raster_layers), otherwise the data itself."""
+        # tiles renders its tiles with this adapter
+        from lizard_riool import tiles
+
+        bbox = request and request.GET.get('BBOX')
+        width = request and request.GET.get('WIDTH')
+        if bbox and width:
+            try:
+                found = tiles.raster_layers(
+                    self.id, [float(value) for value in bbox.split(',')],
+                    int(width))
+            except ValueError:
+                found = None
+            if found is not None:
+                return found
+        return self.vector_layers()
+
+    def vector_layers(self):
+        "Return Mapnik layers and styles that draw the data itself."
         layers, styles = [], {}
         self.__add_sewers(layers, styles)
+        self.__add_segments(layers, styles)
         self.__add_manholes(layers, styles)
         self.__add_measurements(layers, styles)
         return layers, styles
 
     def __add_measurements(self, layers, styles):
-        "Docstring."
-
-        measurements = SewerMeasurement.objects.filter(
-            sewer__sewerage__pk=self.id
-        )
-
-        style = mapnik.Style()
-
-        for _, _, min_pct, max_pct, color in CLASSES:
-
-            r, g, b, a = html_to_mapnik(color)
-
-            icon = SYMBOL_MANAGER.get_symbol_transformed(
-                RIOOL_ICON, color=(r, g, b, a)
-            )
-
-            rule = mapnik.Rule()
-            rule.filter = mapnik.Filter(
-                str("[flooded_pct] >= %s and [flooded_pct] < %s"
-                % (min_pct, max_pct))
-            )
-            symbol = mapnik.PointSymbolizer(
-                os.path.join(GENERATED_ICONS, icon), "png", 16, 16
-            )
-            symbol.allow_overlap = True
-            rule.symbols.append(symbol)
-            style.rules.append(rule)
-
-        # Style else rule.
+        "Add measurement layer and styles."
 
-        r, g, b, a = html_to_mapnik('00000')
+        # Setup datasource. The class is computed by the database, so
+        # the rules of the style are simple string comparisons.
 
-        icon = SYMBOL_MANAGER.get_symbol_transformed(
-            RIOOL_ICON, color=(r, g, b, a)
-        )
-
-        rule = mapnik.Rule()
-        rule.set_else(True)
-        symbol = mapnik.PointSymbolizer(
-            os.path.join(GENERATED_ICONS, icon), "png", 16, 16
-        )
-        symbol.allow_overlap = True
-        rule.symbols.append(symbol)
-        style.rules.append(rule)
-
-        # Setup datasource.
-
-        params = default_database_params()
-        params['table'] = "({}) data".format(measurements.query)
-        datasource = mapnik.PostGIS(**params)
-        params = default_database_params()
+        datasource = postgis_datasource(
+            "SELECT {klasse} AS klasse, m.the_geom "
+            "FROM {measurement} m JOIN {sewer} s ON m.sewer_id = s.id "
+            "WHERE {sewerages} AND m.the_geom && !bbox!".format(
+                klasse=class_sql('m.flooded_pct'),
+                measurement=SewerMeasurement._meta.db_table,
+                sewer=Sewer._meta.db_table,
+                sewerages=self.sewerage_condition('s.sewerage_id')))
 
         # Define layer.
 
         layer = mapnik.Layer('measurementLayer')
         layer.datasource = datasource
-        layer.maxzoom = 35000
+        layer.maxzoom = POINTS_MAX_SCALE
         layer.styles.append('measurementStyle')
 
         layers.append(layer)
-        styles['measurementStyle'] = style
+        styles['measurementStyle'] = measurement_style()
 
     def __add_sewers(self, layers, styles):
         "Add sewer layer and styles."
 
-        # Get all sewer pipes that constitute to this sewerage.
+        # Setup datasource.
 
-        sewers = Sewer.objects.filter(sewerage__pk=self.id)
+        datasource = postgis_datasource(
+            "SELECT code, quality, worst_class, the_geom FROM {sewer} "
+            "WHERE {sewerages} AND the_geom && !bbox!".format(
+                sewer=Sewer._meta.db_table,
+                sewerages=self.sewerage_condition('sewerage_id')))
 
-        # Define a style.
+        # Define layer.
 
-        style = mapnik.Style()
+        layer = mapnik.Layer('sewerLayer')
+        layer.datasource = datasource
+        layer.maxzoom = SEWERS_MAX_SCALE
+        layer.styles.append('sewerStyle')
+        layer.styles.append('sewerClassStyle')
 
-        # QUALITY_UNKNOWN
+        layers.append(layer)
+        styles['sewerStyle'] = sewer_style()
 
-        rule = mapnik.Rule()
-        rule.filter = mapnik.Filter(
-            "[quality] = {}".format(Sewer.QUALITY_UNKNOWN)
-        )
-        rule.max_scale = 1700
-        symbol = mapnik.TextSymbolizer(
-            'code', 'DejaVu Sans Book', 10, mapnik.Color('blue')
-        )
-        symbol.allow_overlap = True
-#       symbol.label_placement = mapnik.label_placement.LINE_PLACEMENT
-        rule.symbols.append(symbol)
-        style.rules.append(rule)
+        # At coarse scales, draw whole sewers in their worst class.
 
-        # QUALITY_RELIABLE
+        styles['sewerClassStyle'] = class_line_style(
+            'worst_class', min_scale=SEGMENTS_MAX_SCALE)
 
-        rule = mapnik.Rule()
-        rule.filter = mapnik.Filter(
-            "[quality] = {}".format(Sewer.QUALITY_RELIABLE)
-        )
-        rule.max_scale = 1700
-        symbol = mapnik.TextSymbolizer(
-            'code', 'DejaVu Sans Book', 10, mapnik.Color('green')
-        )
-        symbol.allow_overlap = True
-#       symbol.label_placement = mapnik.label_placement.LINE_PLACEMENT
-        symbol.allow_overlap = True
-        symbol.opacity = 1.0
-        rule.symbols.append(symbol)
-        style.rules.append(rule)
+    def __add_segments(self, layers, styles):
+        "Add a layer of stretches of equal lost capacity, for medium scales."
 
-        # QUALITY_UNRELIABLE
+        datasource = postgis_datasource(
+            "SELECT g.klasse, g.the_geom "
+            "FROM {segment} g JOIN {sewer} s ON g.sewer_id = s.id "
+            "WHERE {sewerages} AND g.the_geom && !bbox!".format(
+                segment=LostCapacitySegment._meta.db_table,
+                sewer=Sewer._meta.db_table,
+                sewerages=self.sewerage_condition('s.sewerage_id')))
 
-        rule = mapnik.Rule()
-        rule.filter = mapnik.Filter(
-            "[quality] = {}".format(Sewer.QUALITY_UNRELIABLE)
-        )
-        rule.max_scale = 1700
-        symbol = mapnik.TextSymbolizer(
-            'code', 'DejaVu Sans Book', 10, mapnik.Color('red')
-        )
-        symbol.allow_overlap = True
-#       symbol.label_placement = mapnik.label_placement.LINE_PLACEMENT
-#       symbol.displacement(16, 16)  # slightly above
-        rule.symbols.append(symbol)
-        style.rules.append(rule)
+        layer = mapnik.Layer('segmentLayer')
+        layer.datasource = datasource
+        layer.minzoom = POINTS_MAX_SCALE
+        layer.maxzoom = SEGMENTS_MAX_SCALE
+        layer.styles.append('segmentStyle')
+
+        layers.append(layer)
+        styles['segmentStyle'] = class_line_style('klasse')
+
+    def __add_manholes(self, layers, styles):
+        "Add manhole layer and styles."
 
         # Setup datasource.
 
-        params = default_database_params()
-        params['table'] = "({}) data".format(sewers.query)
-        datasource = mapnik.PostGIS(**params)
+        datasource = postgis_datasource(
+            "SELECT code, sink, the_geom FROM {manhole} "
+            "WHERE {sewerages} AND the_geom && !bbox!".format(
+                manhole=Manhole._meta.db_table,
+                sewerages=self.sewerage_condition('sewerage_id')))
 
         # Define layer.
 
-        layer = mapnik.Layer('sewerLayer')
+        layer = mapnik.Layer('manholeLayer')
         layer.datasource = datasource
         layer.maxzoom = 35000
-        layer.styles.append('sewerStyle')
+        layer.styles.append('manholeStyle')
 
         layers.append(layer)
-        styles['sewerStyle'] = style
+        styles['manholeStyle'] = manhole_style()
 
-    def __add_manholes(self, layers, styles):
-        "Add manhole layer and styles."
-
-        # Select the manholes that are part of this sewerage.
 
-        manholes = Manhole.objects.filter(sewerage__pk=self.id)
+class SewerageOverviewAdapter(SewerageAdapter):
+    """All active sewerages in one set of layers.
 
-        # Define a style.
+    Showing many sewerages with a SewerageAdapter each costs a set of
+    layers and datasources per sewerage. This adapter uses one query per
+    layer type for all of them. When zoomed out beyond the sewer lines,
+    each sewerage is drawn as a single labelled point in the middle of
+    its stored extent.
 
-        style = mapnik.Style()
+    """
 
-        # Style the `normal` manholes.
+    def __init__(self, *args, **kwargs):
+        # Skip SewerageAdapter.__init__, there is no single sewerage id.
+        super(SewerageAdapter, self).__init__(*args, **kwargs)
+        self.id = None
 
-        rule = mapnik.Rule()
-        rule.filter = mapnik.Filter("[sink] != 1")
-        symbol = mapnik.PointSymbolizer()
-        symbol.allow_overlap = True
-        rule.symbols.append(symbol)
-        style.rules.append(rule)
+    def sewerage_condition(self, column):
+        "Return an SQL condition on column that selects active sewerages."
+        return "{0} IN (SELECT id FROM {sewerage} WHERE active)".format(
+            column, sewerage=Sewerage._meta.db_table)
 
-        # Style the sink.
+    def extent(self, identifiers=None):
+        "Return the extent of all active sewerages in Google projection."
 
-        rule = mapnik.Rule()
-        rule.filter = mapnik.Filter("[sink] = 1")
-        symbol = mapnik.PointSymbolizer(
-            str(finders.find("lizard_riool/sink.png")), "png", 8, 8
+        extents = (
+            Sewerage.objects.filter(active=True).
+            values_list('extent_google', flat=True)
         )
-        symbol.allow_overlap = True
-        rule.symbols.append(symbol)
-        style.rules.append(rule)
 
-        # Add labels.
+        return google_extent(extents) or super(
+            SewerageAdapter, self).extent(identifiers)
 
-        rule = mapnik.Rule()
-        rule.max_scale = 1700
-        symbol = mapnik.TextSymbolizer(
-            'code', 'DejaVu Sans Book', 10, mapnik.Color('black')
-        )
-        symbol.allow_overlap = True
-        symbol.label_placement = mapnik.label_placement.POINT_PLACEMENT
-        symbol.vertical_alignment = mapnik.vertical_alignment.TOP
-        symbol.displacement(0, -5)  # slightly above
-        rule.symbols.append(symbol)
-        style.rules.append(rule)
+    def search(self, x, y, radius=None):
+        "Find the nearest SewerMeasurement in any active sewerage."
+        nearest = None
+        for sewerage_id in spatial_index.sewerages_near(
+            Sewerage.objects.filter(active=True),
+            x, y, spatial_index.GOOGLE, radius):
+            found = spatial_index.nearest_measurement(
+                sewerage_id, x, y, radius)
+            if found is not None and (nearest is None or found < nearest):
+                nearest = found
+        return self.search_result(nearest)
 
-        # Setup datasource.
+    def layer(self, layer_ids=None, request=None):
+        "Return Mapnik layers and styles."
+        layers, styles = self.vector_layers()
+        self.__add_sewerages(layers, styles)
+        return layers, styles
 
-        params = default_database_params()
-        params['table'] = "({}) data".format(manholes.query)
-        datasource = mapnik.PostGIS(**params)
+    def __add_sewerages(self, layers, styles):
+        "Add a layer with a labelled point per sewerage, for coarse scales."
 
-        # Define layer.
+        datasource = postgis_datasource(
+            "SELECT name, ST_Centroid(extent) AS the_geom FROM {sewerage} "
+            "WHERE active AND extent && !bbox!".format(
+                sewerage=Sewerage._meta.db_table))
 
-        layer = mapnik.Layer('manholeLayer')
+        layer = mapnik.Layer('sewerageLayer')
         layer.datasource = datasource
-        layer.maxzoom = 35000
-        layer.styles.append('manholeStyle')
+        layer.minzoom = SEWERS_MAX_SCALE
+        layer.styles.append('sewerageStyle')
 
         layers.append(layer)
-        styles['manholeStyle'] = style
+        styles['sewerageStyle'] = sewerage_style()
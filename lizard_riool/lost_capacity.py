@@ -19,9 +19,9 @@ logger = logging.getLogger(__name__)
 
 
 def compute_lost_capacity(saved_puts, saved_sewers, measurements_dict):
-    G, sink_node = create_graph(
+    G, sink_nodes = create_graph(
         saved_puts, saved_sewers, measurements_dict)
-    compute_water_level(G, sink_node)
+    priority_flood(G, sink_nodes)
     add_lost_capacity(measurements_dict, saved_sewers, G)
 
 
@@ -51,6 +51,9 @@ def create_graph(saved_puts, saved_sewers, measurements_dict):
     has a low level (the minimum of all the BOBs connected to it) and
     for each sewer, a record is added with its level equal to the BOB
     of the sewer connecting to it.
+
+    Returns the graph and a list of the nodes of the sinks, lowest
+    first; (None, []) if there are no sinks.
     """
 
     G = nx.Graph()
@@ -72,7 +75,9 @@ def create_graph(saved_puts, saved_sewers, measurements_dict):
         #  ("measurement", sewer_id, distance) for measurements
         #
         # For each node in the graph, we store the bob as the 'bob' attribute,
-        # and the 'waterlevel' attribute which starts out as "None".
+        # and the 'waterlevel' attribute which starts out as "None". The
+        # 'sink' attribute is the sink whose water reaches the node (see
+        # priority_flood).
         for (location, bob) in chain(
             [(("put", manhole1), manhole_bobs[manhole1]),
              (("sewer_end", sewer_id, "1"), saved_sewer.bob1)],
@@ -84,53 +89,40 @@ def create_graph(saved_puts, saved_sewers, measurements_dict):
             [(("sewer_end", sewer_id, "2"), saved_sewer.bob2),
              (("put", manhole2), manhole_bobs[manhole2])]
                 ):
-            G.add_node(location, bob=bob, waterlevel=None)
+            G.add_node(location, bob=bob, waterlevel=None, sink=None)
             if previous is not None:
                 G.add_edge(previous, location)
             previous = location
 
     # Find the put ids that are sinks
-    sink_ids = [manhole_id for manhole_id, manhole in saved_puts.iteritems()
-                if manhole.is_sink]
-    if len(sink_ids) == 0:
+    sink_nodes = [("put", manhole_id)
+                  for manhole_id, manhole in saved_puts.iteritems()
+                  if manhole.is_sink and ("put", manhole_id) in G]
+    if not sink_nodes:
         # ! Should never happen
-        return None, None
-    elif len(sink_ids) == 1:
-        sink_id = sink_ids[0]
-    else:
-        # There are multiple sinks. Our algorithm just uses one. We
-        # use a trick: we find the lowest sink, then connect the other
-        # ones to it in the graph, and return the id of the
-        # lowest. This acts as if there's a secret extra pipe between
-        # the different sinks.
-        sink_id = min(
-            sink_ids,
-            key=lambda sink: G.node[("put", sink)]['bob'])
-
-        for higher_sink_id in sink_ids:
-            if higher_sink_id == sink_id:
-                continue  # Itself
-            G.add_edge(("put", sink_id), ("put", higher_sink_id))
-
-    return G, ("put", sink_id)
-
-
-def compute_water_level(G, sink_node):
-    """Compute the lost capacity in graph G. sink must be a put-id of some
-    put in the graph.
-
-    From the sink, go up until we reach "peaks", places where the
+        return None, []
+
+    return G, sorted(sink_nodes, key=lambda node: G.node[node]['bob'])
+
+
+def compute_water_level(G, sink_nodes):
+    """Compute the lost capacity in graph G. sink_nodes must be a list
+    of put nodes in the graph.
+
+    From the sinks, go up until we reach "peaks", places where the
     water level goes down. From there, fill the network with water to a level
     equal to the peak, then continue up and add to the todo list the following
     level turning points.
 
     Straight translation of the code by Mario Frasca to new data structures,
-    see the history on Git of parsers.py."""
+    see the history on Git of parsers.py. Each sink starts out at its
+    own bob, as if the sinks were connected by an extra pipe."""
 
     todo = []  # A priority queue, guarantees that the lowest level stays first
     done = set()  # Keeping track of explored nodes
 
-    heappush(todo, (G.node[sink_node]['bob'], sink_node))
+    for sink_node in sink_nodes:
+        heappush(todo, (G.node[sink_node]['bob'], sink_node))
 
     while todo:
         ## pour water in the nodes at level lower than `water_level`
@@ -179,6 +171,185 @@ def compute_water_level(G, sink_node):
     # them as being 100% underwater.
 
 
+def priority_flood(G, sink_nodes, sink_levels=None):
+    """Alternative to compute_water_level, with the same result.
+
+    Water from a sink reaches a node at the lowest level at which
+    there is a path to it: the highest bob along the way, or the bob
+    of the node itself if that is higher. Nodes are visited in order
+    of that level, each node once, so this takes O(n log n) time
+    instead of copying the set of done nodes at every turning point.
+    Nodes that can't be reached keep a waterlevel of None.
+
+    All sinks are flooded together, each from its own level: its bob,
+    or its level in the dictionary sink_levels if that is higher (e.g.
+    the level a pump keeps). A node gets the level of the sink that
+    reaches it lowest, and that sink becomes its 'sink' attribute.
+
+    See lizard_riool.engines for a harness comparing the two."""
+    sink_levels = sink_levels or {}
+    todo = []
+    for sink_node in sink_nodes:
+        bob = G.node[sink_node]['bob']
+        heappush(todo, (
+                max(bob, sink_levels.get(sink_node, bob)),
+                sink_node, sink_node))
+    done = set()
+
+    while todo:
+        water_level, node, sink_node = heappop(todo)
+        if node in done:
+            continue  # Already reached at a lower level
+        done.add(node)
+        G.node[node]['waterlevel'] = water_level
+        G.node[node]['sink'] = sink_node
+
+        for neighbour in G[node]:
+            if neighbour not in done:
+                heappush(todo, (
+                        max(water_level, G.node[neighbour]['bob']),
+                        neighbour, sink_node))
+
+
+def restore_water_level(G, saved_puts, measurements_dict):
+    """Set the waterlevel of the nodes of G from the saved measurements
+    in measurements_dict, as far as it is known exactly. Returns the set
+    of nodes whose level isn't known.
+
+    Saved water levels are clipped to the obb, so a measurement at its
+    obb may have had any level above it. Sewer ends get the level of
+    the neighbouring measurement with the same bob (they can't differ),
+    manholes the lowest level of their sewer ends, sinks their bob.
+    Unsaved measurements (pk None) are unknown. The 'sink' of a node is
+    restored along with its level."""
+    unknown = set()
+
+    for sewer_id, measurements in measurements_dict.iteritems():
+        for measurement in measurements:
+            node = ("measurement", sewer_id, measurement.dist)
+            if (measurement.pk is None or (
+                    measurement.water_level is not None and
+                    measurement.water_level >= measurement.obb)):
+                unknown.add(node)
+            else:
+                G.node[node]['waterlevel'] = measurement.water_level
+                if measurement.sink_code:
+                    G.node[node]['sink'] = ("put", measurement.sink_code)
+
+    sewer_ends = [node for node in G if node[0] == "sewer_end"]
+    for node in sewer_ends:
+        neighbours = [
+            neighbour for neighbour in G[node]
+            if neighbour[0] == "measurement" and
+            G.node[neighbour]['bob'] == G.node[node]['bob'] and
+            neighbour not in unknown]
+        if neighbours:
+            G.node[node]['waterlevel'] = G.node[neighbours[0]]['waterlevel']
+            G.node[node]['sink'] = G.node[neighbours[0]]['sink']
+        else:
+            unknown.add(node)
+
+    for put_id, put in saved_puts.iteritems():
+        node = ("put", put_id)
+        if node not in G:
+            continue
+        if put.is_sink:
+            G.node[node]['waterlevel'] = G.node[node]['bob']
+            G.node[node]['sink'] = node
+            continue
+        neighbours = [neighbour for neighbour in G[node]
+                      if neighbour[0] == "sewer_end"]
+        if any(neighbour in unknown for neighbour in neighbours):
+            unknown.add(node)
+            continue
+        levels = [(G.node[neighbour]['waterlevel'], neighbour)
+                  for neighbour in neighbours]
+        # Unreachable through some sewer, but maybe not through all
+        levels = [(level, neighbour) for level, neighbour in levels
+                  if level is not None]
+        if levels:
+            level, neighbour = min(levels)
+            G.node[node]['waterlevel'] = level
+            G.node[node]['sink'] = G.node[neighbour]['sink']
+        else:
+            G.node[node]['waterlevel'] = None
+
+    return unknown
+
+
+def update_water_level(G, sink_nodes, changed, unknown=(), level=None):
+    """Recompute the water levels in G after a local change, instead of
+    flooding the whole graph again.
+
+    `changed` are the nodes whose bob changed, or that are new; `level`
+    is the lowest bob any of them had before or has now. Other nodes
+    must have their previous waterlevel, or be in `unknown`.
+
+    The level of a node is the lowest level at which there is a path to
+    it from a sink (see priority_flood). A node that was below `level`
+    reached the sink without passing a changed node, and can't get
+    lower by passing one now, so it keeps its level. Nodes at or above
+    `level` (or unknown) can only change if they are connected to a
+    changed node through such nodes. Only those are flooded again,
+    starting from the levels of the unchanged nodes around them, whose
+    'sink' they get.
+
+    Returns the set of nodes that were recomputed."""
+    changed = set(changed)
+    if level is None:
+        level = min(G.node[node]['bob'] for node in changed)
+
+    affected = changed | set(unknown)
+    for node, data in G.nodes_iter(data=True):
+        if data['waterlevel'] is None or data['waterlevel'] >= level:
+            affected.add(node)
+
+    # The parts of the affected nodes that contain a changed node
+    region = set()
+    for start in changed:
+        if start in region:
+            continue
+        region.add(start)
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for neighbour in G[node]:
+                if neighbour in affected and neighbour not in region:
+                    region.add(neighbour)
+                    stack.append(neighbour)
+
+    # Neighbours outside the region keep their level, flood from them
+    sink_nodes = set(sink_nodes)
+    todo = []
+    for node in region:
+        G.node[node]['waterlevel'] = None
+        bob = G.node[node]['bob']
+        if node in sink_nodes:
+            heappush(todo, (bob, node, node))
+        for neighbour in G[node]:
+            if neighbour not in region:
+                heappush(todo, (
+                        max(G.node[neighbour]['waterlevel'], bob), node,
+                        G.node[neighbour].get('sink')))
+
+    done = set()
+    while todo:
+        water_level, node, sink_node = heappop(todo)
+        if node in done:
+            continue
+        done.add(node)
+        G.node[node]['waterlevel'] = water_level
+        G.node[node]['sink'] = sink_node
+
+        for neighbour in G[node]:
+            if neighbour in region and neighbour not in done:
+                heappush(todo, (
+                        max(water_level, G.node[neighbour]['bob']),
+                        neighbour, sink_node))
+
+    return region
+
+
 def neighbouring_nodes_satisfying_condition(G, start, visited, condition):
     """Produce nodes in a depth-first-search pre-ordering starting at
     source and skipping the already visited nodes and do so only while
@@ -217,6 +388,13 @@ def neighbouring_nodes_satisfying_condition(G, start, visited, condition):
                        if c not in set(satisfied)]
 
 
+def sink_code(G, node):
+    """Return the code of the sink manhole whose water reaches a node,
+    or '' if it isn't known."""
+    sink_node = G.node[node].get('sink')
+    return sink_node[1] if sink_node else ''
+
+
 def add_lost_capacity(measurements_dict, sewerdict, G):
     for sewer_id, measurements in measurements_dict.iteritems():
         sewer = sewerdict[sewer_id]
@@ -226,3 +404,4 @@ def add_lost_capacity(measurements_dict, sewerdict, G):
             node = ("measurement", sewer_id, measurement.dist)
             measurement.set_water_level(G.node[node]['waterlevel'])
             measurement.compute_flooded_pct(use_sewer=sewer)
+            measurement.sink_code = sink_code(G, node)
@@ -0,0 +1,96 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+from optparse import make_option
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_riool import benchmark
+from lizard_riool import parse_cache
+from lizard_riool.progress import STAGES
+
+DEFAULT_BASELINE = getattr(
+    settings, 'LIZARD_RIOOL_BENCHMARK_BASELINE',
+    os.path.join(settings.BUILDOUT_DIR, 'var', 'lizard_riool',
+                 'benchmark_baseline.json'))
+
+
+class Command(BaseCommand):
+    args = '[name ...]'
+    help = ("Process the sample RIB/RMB pairs (or only those named), "
+            "report the time and memory used per stage and compare "
+            "them with a baseline. Nothing is stored in the database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--directory', default=benchmark.DATA_DIR,
+                    help="Directory with RIB/RMB pairs"),
+        make_option('--baseline', default=DEFAULT_BASELINE,
+                    help="JSON file with baseline results"),
+        make_option('--save-baseline', action='store_true', default=False,
+                    help="Store the results as the new baseline"),
+        make_option('--repeat', type='int', default=1,
+                    help="Process each pair this many times, keep the "
+                    "fastest run of each stage"),
+        make_option('--tolerance', type='float', default=0.25,
+                    help="Allowed relative increase compared to the "
+                    "baseline"),
+        make_option('--parse-cache', action='store_true', default=False,
+                    help="Use parses cached by earlier runs"),
+        )
+
+    def handle(self, *names, **options):
+        pairs = benchmark.sample_pairs(options['directory'])
+        if names:
+            pairs = [pair for pair in pairs if pair[0] in names]
+        if not pairs:
+            raise CommandError("No RIB/RMB pairs found.")
+
+        # Otherwise, all but the first run would measure the cache
+        parse_cache.ENABLED = options['parse_cache']
+
+        results, failures = benchmark.run(pairs, repeat=options['repeat'])
+        self.report(results)
+        for name, errors in sorted(failures.iteritems()):
+            self.stdout.write(
+                "{0} was rejected ({1} errors), first: {2}\n".format(
+                    name, len(errors), errors[0]))
+
+        baseline_path = options['baseline']
+        if options['save_baseline']:
+            benchmark.save(results, baseline_path)
+            self.stdout.write("Baseline saved to {0}\n".format(
+                    baseline_path))
+            return
+
+        if not os.path.exists(baseline_path):
+            self.stdout.write(
+                "No baseline at {0}, use --save-baseline to store one.\n"
+                .format(baseline_path))
+            return
+
+        regressions = benchmark.regressions(
+            results, benchmark.load(baseline_path), options['tolerance'])
+        if regressions:
+            raise CommandError(
+                "Performance regressions:\n" + "\n".join(regressions))
+        self.stdout.write("No regressions compared to {0}\n".format(
+                baseline_path))
+
+    def report(self, results):
+        line = "{0:<28} {1:<15} {2:>9} {3:>9} {4:>11} {5:>9}\n"
+        self.stdout.write(line.format(
+                "Pair", "Stage", "Wall (s)", "CPU (s)", "Peak (kB)",
+                "Rows"))
+        for name, stages in sorted(results.iteritems()):
+            for stage, _ in STAGES:
+                timing = stages.get(stage)
+                if timing is None:
+                    continue
+                self.stdout.write(line.format(
+                        name[:28], stage,
+                        "{0:.2f}".format(timing['wall_time']),
+                        "{0:.2f}".format(timing['cpu_time']),
+                        timing['peak_rss'] or "-",
+                        timing['rows'] or "-"))
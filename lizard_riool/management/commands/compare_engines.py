@@ -0,0 +1,55 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_riool import benchmark
+from lizard_riool import engines
+
+
+class Command(BaseCommand):
+    args = '[name ...]'
+    help = ("Compute water levels of the sample RIB/RMB pairs (or only "
+            "those named) and of random synthetic networks with each "
+            "lost capacity engine, and check that the results are the "
+            "same. Nothing is stored in the database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--directory', default=benchmark.DATA_DIR,
+                    help="Directory with RIB/RMB pairs"),
+        make_option('--synthetic', type='int', default=4,
+                    help="Number of synthetic networks"),
+        make_option('--pipes', type='int', default=500,
+                    help="Number of sewers per synthetic network"),
+        make_option('--seed', type='int', default=0,
+                    help="Seed of the first synthetic network"),
+        )
+
+    def handle(self, *names, **options):
+        pairs = benchmark.sample_pairs(options['directory'])
+        if names:
+            pairs = [pair for pair in pairs if pair[0] in names]
+
+        networks = list(engines.sample_networks(pairs))
+        networks.extend(engines.synthetic_networks(
+                options['synthetic'], options['pipes'], options['seed']))
+        if not networks:
+            raise CommandError("No networks to compare.")
+
+        different = []
+        for name, network in networks:
+            if isinstance(network, ValueError):
+                self.stdout.write("{0}: skipped, {1}\n".format(name, network))
+                continue
+            comparison = engines.compare(*network)
+            for line in engines.describe(name, comparison):
+                self.stdout.write(line + "\n")
+            if engines.has_differences(comparison):
+                different.append(name)
+
+        if different:
+            raise CommandError(
+                "Engines give different results for: " +
+                ", ".join(different))
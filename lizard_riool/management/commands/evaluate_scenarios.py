@@ -0,0 +1,109 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+from optparse import make_option
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_riool import models
+from lizard_riool import scenarios
+
+
+def codes(value):
+    return [code.strip() for code in value.split(',') if code.strip()]
+
+
+def sink_level(value):
+    """A level for all sinks, or comma separated code=level pairs with
+    the levels of some sinks."""
+    try:
+        if '=' not in value:
+            return float(value)
+        return dict((code.strip(), float(level)) for code, level in (
+                pair.split('=', 1) for pair in codes(value)))
+    except ValueError:
+        raise CommandError("Invalid sink level: {0}".format(value))
+
+
+class Command(BaseCommand):
+    args = '<sewerage name>'
+    help = ("Compute the lost volume of a sewerage in what-if scenarios: "
+            "other sink levels, and sewers cleaned or relined. Each "
+            "--sink-level, --clean and --reline is a scenario. Nothing "
+            "is saved.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sink-level', action='append',
+                    dest='sink_levels', default=[],
+                    help=("Water level at the sinks (m NAP), or comma "
+                          "separated manhole code=level pairs")),
+        make_option('--clean', action='append', dest='cleaned',
+                    default=[],
+                    help="Comma separated sewer codes to clean"),
+        make_option('--reline', action='append', dest='relined',
+                    default=[],
+                    help="Comma separated sewer codes to reline"),
+        make_option('--liner-thickness', type='float', default=0.01,
+                    help="Thickness of liners (m, default 0.01)"),
+        make_option('--processes', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help="Number of worker processes"),
+        make_option('--top', type='int', default=5,
+                    help="Number of sewers with most lost volume to show"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the name of a sewerage.")
+        try:
+            sewerage = models.Sewerage.objects.get(name=args[0])
+        except models.Sewerage.DoesNotExist:
+            raise CommandError("No sewerage named {0}.".format(args[0]))
+
+        scenario_list = [scenarios.Scenario("current")]
+        for value in options['sink_levels']:
+            scenario_list.append(scenarios.Scenario(
+                    "sink at {0}".format(value),
+                    sink_level=sink_level(value)))
+        for value in options['cleaned']:
+            scenario_list.append(scenarios.Scenario(
+                    "clean {0}".format(value), cleaned=codes(value)))
+        for value in options['relined']:
+            scenario_list.append(scenarios.Scenario(
+                    "reline {0}".format(value), relined=dict(
+                        (code, options['liner_thickness'])
+                        for code in codes(value))))
+
+        started = time.time()
+        try:
+            network = scenarios.Network.from_sewerage(sewerage)
+            self.stdout.write("Built the network in {0:.1f} s\n".format(
+                    time.time() - started))
+            volumes = scenarios.evaluate(
+                network, scenario_list, options['processes'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Evaluated {0} scenarios in {1:.1f} s\n\n".format(
+                len(scenario_list), time.time() - started))
+
+        current = total(volumes["current"])
+        for name, sewer_volumes in volumes.iteritems():
+            volume = total(sewer_volumes)
+            unreached = sum(
+                1 for value in sewer_volumes.itervalues() if value is None)
+            self.stdout.write(
+                "{0:<30} {1:>10.1f} m3 ({2:+.1f}), {3} sewers not "
+                "reached\n".format(name, volume, volume - current, unreached))
+            worst = sorted(
+                ((value, code) for code, value in sewer_volumes.iteritems()
+                 if value is not None), reverse=True)[:options['top']]
+            for value, code in worst:
+                self.stdout.write("    {0:<26} {1:>10.2f} m3\n".format(
+                        code, value))
+
+
+def total(sewer_volumes):
+    return sum(value for value in sewer_volumes.itervalues()
+               if value is not None)
@@ -0,0 +1,53 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_riool import synthetic
+
+
+class Command(BaseCommand):
+    args = '<name>'
+    help = ("Write a synthetic RIB/RMB pair <name>.RIB and <name>.RMB. "
+            "The number of measurements is about pipes * {0:.0f} / "
+            "spacing.".format(synthetic.PIPE_LENGTH))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--directory', default='.',
+                    help="Where to write the files"),
+        make_option('--pipes', type='int', default=1000,
+                    help="Number of sewers"),
+        make_option('--spacing', type='float', default=1.0,
+                    help="Distance between measurements (m)"),
+        make_option('--topology', choices=('tree', 'looped'),
+                    default='tree'),
+        make_option('--loops', type='float', default=0.1,
+                    help="Fraction of extra sewers in a looped network"),
+        make_option('--sinks', type='int', default=1,
+                    help="Number of manholes marked as sink"),
+        make_option('--variants', default=','.join(synthetic.VARIANTS),
+                    help="Comma separated ZYR+ZYS combinations to use"),
+        make_option('--seed', type='int', default=None),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the name of the sewerage.")
+
+        variants = [variant.strip().upper()
+                    for variant in options['variants'].split(',')]
+        for variant in variants:
+            if variant not in synthetic.VARIANTS:
+                raise CommandError("Unknown variant {0}, use {1}.".format(
+                        variant, ", ".join(synthetic.VARIANTS)))
+
+        rib_path, rmb_path, measurements = synthetic.generate(
+            options['directory'], args[0], options['pipes'],
+            spacing=options['spacing'], topology=options['topology'],
+            loops=options['loops'], sinks=options['sinks'],
+            variants=variants, seed=options['seed'])
+
+        self.stdout.write("Wrote {0} and {1}, {2} measurements.\n".format(
+                rib_path, rmb_path, measurements))
@@ -0,0 +1,74 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+from collections import defaultdict
+from optparse import make_option
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_riool import bulk_import
+from lizard_riool.progress import STAGES
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = ("Import all RIB/RMB pairs in a directory as sewerages, in "
+            "parallel worker processes, and report timings and "
+            "failures. Pairs whose sewerage already exists are skipped.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help="Number of worker processes"),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only list the pairs that would be imported"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the directory with RIB/RMB pairs.")
+
+        pairs = bulk_import.find_pairs(args[0])
+        existing = bulk_import.existing_names(pairs)
+        for name in sorted(existing):
+            self.stdout.write("{0}: skipped, sewerage exists\n".format(name))
+        pairs = [pair for pair in pairs if pair[0] not in existing]
+        if not pairs:
+            raise CommandError("No new RIB/RMB pairs found.")
+
+        if options['dry_run']:
+            for name, rib_path, rmb_path in pairs:
+                self.stdout.write("{0}: {1}, {2}\n".format(
+                        name, rib_path, rmb_path))
+            return
+
+        started = time.time()
+        failures = []
+        stage_times = defaultdict(float)
+        for n, result in enumerate(bulk_import.run(
+                pairs, options['processes']), 1):
+            self.stdout.write("[{0}/{1}] {2}: {3} in {4:.1f} s\n".format(
+                    n, len(pairs), result['name'],
+                    "ok" if result['successful'] else "rejected",
+                    result['seconds']))
+            for timing in result['timings']:
+                stage_times[timing['stage']] += timing['wall_time']
+            if not result['successful']:
+                failures.append(result)
+
+        self.stdout.write(
+            "\n{0} pairs in {1:.1f} s, {2} rejected\n".format(
+                len(pairs), time.time() - started, len(failures)))
+        self.stdout.write("Time per stage, summed over all pairs:\n")
+        for stage, _ in STAGES:
+            if stage in stage_times:
+                self.stdout.write("  {0:<15} {1:>9.1f} s\n".format(
+                        stage, stage_times[stage]))
+
+        for result in sorted(failures, key=lambda result: result['name']):
+            errors = result['errors']
+            self.stdout.write("{0}: {1} errors, first: {2}\n".format(
+                    result['name'], len(errors),
+                    errors[0] if errors else "-"))
@@ -72,15 +72,25 @@ $(function () {
 var beheer_functions = beheer_functions || (function () {
     var refresh_url = $("#uploaded_file_lists").attr("data-refresh-url");
 
-    /* The refresh url will give a bit of JSON data. This is an array
-       of objects, of the form:
+    /* The refresh url will give a bit of JSON data, of the form:
        {
-           id: a unique id string
-           name: filename
-           status: One of "not_being_processed_yet", "being_processed", "with_errors", "successful"
+           cursor: pass this as "since" next time, to get only the
+                   files that changed after this request
+           uploads: an array of objects, of the form:
+               {
+               id: a unique id string
+               name: filename
+               status: One of "not_being_processed_yet", "being_processed", "with_errors", "successful"
+               }
            }
+       If nothing changed, the server answers 304 Not Modified.
     */
 
+    var statuses = ["not_being_processed_yet", "being_processed",
+                    "with_errors", "successful"];
+
+    var cursor = null;
+
     var id_present_in = function (status, id) {
         var result = false;
         $("#uploaded_files_" + status + " ul li").each(function (i, item) {
@@ -93,11 +103,83 @@ var beheer_functions = beheer_functions || (function () {
         return result;
     };
 
-    var remove_ids = function (status, ids_to_keep) {
-        $("#uploaded_files_" + status + " ul li").each(function (i, item) {
-            item = $(item);
-            if (!(item.attr("data-file-id") in (ids_to_keep[status] || {}))) {
-                item.remove();
+    var remove_from_other_lists = function (status, id) {
+        // A file whose status changed moves to another list.
+        $.each(statuses, function (i, other_status) {
+            if (other_status === status) {
+                return;
+            }
+            $("#uploaded_files_" + other_status + " ul li").each(function (j, item) {
+                item = $(item);
+                if (item.attr("data-file-id") === id) {
+                    item.remove();
+                }
+            });
+        });
+    };
+
+    // Milliseconds between requests for the progress of a file.
+    var progress_interval = 2000;
+
+    var watch_progress = function (li, url, version) {
+        // Ask for the progress every few seconds, stop once the file
+        // left this list.
+        $.getJSON(url, function (data) {
+            var text;
+
+            if (li.closest("#uploaded_files_being_processed").length === 0 ||
+                    data.finished) {
+                return;
+            }
+
+            if (data.label && data.version !== version) {
+                text = " (" + data.label;
+                if (data.total) {
+                    text += ", " + data.done + " van " + data.total;
+                }
+                text += ")";
+                li.children(".progress").text(text);
+            }
+
+            setTimeout(function () {
+                watch_progress(li, url, data.version);
+            }, progress_interval);
+        });
+    };
+
+    var batch_text = function (data) {
+        // E.g. "stelsels.zip: Uitgepakt, 3 van 10 goedgekeurd, 1 afgekeurd"
+        var text = data.name + ": " + data.status;
+        var uploads = data.uploads;
+
+        if (data.error) {
+            text += " (" + data.error + ")";
+        }
+        if (data.total) {
+            text += ", " + (uploads.successful || 0) + " van " +
+                data.total + " goedgekeurd";
+            if (uploads.with_errors) {
+                text += ", " + uploads.with_errors + " afgekeurd";
+            }
+        }
+        return text;
+    };
+
+    var watch_batch = function (url, li) {
+        // Show the status of an uploaded ZIP file until all its files
+        // are done.
+        if (li === undefined) {
+            li = $("<li>");
+            $("#uploaded_batches ul").append(li);
+        }
+
+        $.getJSON(url, function (data) {
+            li.text(batch_text(data));
+
+            if (!data.finished) {
+                setTimeout(function () {
+                    watch_batch(url, li);
+                }, progress_interval);
             }
         });
     };
@@ -137,6 +219,11 @@ var beheer_functions = beheer_functions || (function () {
             li = li.append(sprite_remove).append(sprite_errors);
         }
 
+        if (status === "being_processed") {
+            li = li.append($("<span>").attr("class", "progress"));
+            watch_progress(li, uploaded_file.progress_url, 0);
+        }
+
         if (status === "successful") {
             var sprite = ($("<span>")
                           .attr("class", "remove ss_sprite ss_accept")
@@ -150,11 +237,6 @@ var beheer_functions = beheer_functions || (function () {
         $("#uploaded_files_" + status + " ul").append(li);
     };
 
-    var record_id_to_keep = function (ids_to_keep, status, id) {
-        ids_to_keep[status] = ids_to_keep[status] || {};
-        ids_to_keep[status][id] = true;
-    };
-
     var repeat_update_file_list = true;
 
     var reupdate_file_list = function () {
@@ -175,34 +257,37 @@ var beheer_functions = beheer_functions || (function () {
     }
 
     var update_file_list = function () {
-        $.getJSON(refresh_url, function(data) {
-            var ids_to_keep = {};
-
-            // Sync the lists to the file ids in the data
-            // First go through all the data, add the files to the right
-            // lists, adding all ids to ids_to_keep.
-            // Then go through all the lists and remove the files we haven't
-            // seen this way.
-            $.each(data, function (i, uploaded_file) {
-                var id = uploaded_file.id;
-                var status = uploaded_file.status;
-
-                record_id_to_keep(ids_to_keep, status, id);
-
-                if (!id_present_in(status, id)) {
-                    add_to_list(uploaded_file);
+        // The first request asks for all files, after that only for
+        // the files that changed since the previous request.
+        var params = (cursor === null) ? {all: 1} : {since: cursor};
+
+        $.ajax({
+            url: refresh_url,
+            data: params,
+            dataType: "json",
+            ifModified: true,
+            success: function (data) {
+                // data is undefined if nothing changed (304)
+                if (data !== undefined) {
+                    cursor = data.cursor;
+
+                    $.each(data.uploads, function (i, uploaded_file) {
+                        var id = uploaded_file.id;
+                        var status = uploaded_file.status;
+
+                        remove_from_other_lists(status, id);
+
+                        if (!id_present_in(status, id)) {
+                            add_to_list(uploaded_file);
+                        }
+                    });
                 }
-            });
 
-            remove_ids("not_being_processed_yet", ids_to_keep);
-            remove_ids("being_processed", ids_to_keep);
-            remove_ids("with_errors", ids_to_keep);
-            remove_ids("successful", ids_to_keep);
-
-            if (($("#uploaded_files_not_being_processed_yet ul li").length !== 0) ||
-                ($("#uploaded_files_being_processed ul li").length !== 0)) {
-                // Keep refreshing until these tables are empty
-                repeat_update_file_list = true;
+                if (($("#uploaded_files_not_being_processed_yet ul li").length !== 0) ||
+                    ($("#uploaded_files_being_processed ul li").length !== 0)) {
+                    // Keep refreshing until these tables are empty
+                    repeat_update_file_list = true;
+                }
             }
         });
     };
@@ -234,6 +319,7 @@ var beheer_functions = beheer_functions || (function () {
 
     return {
         schedule_update_file_list: schedule_update_file_list,
+        watch_batch: watch_batch,
         open_error_page: open_error_page,
         delete_uploaded_file: delete_uploaded_file
     };
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from django.contrib.gis.geos import GEOSGeometry
+
+# Copied from lizard_map.coordinates as it was when this migration was
+# written. The definition of RD in the database lacks towgs84, so it
+# can't do the transformation itself.
+RD = ("+proj=sterea +lat_0=52.15616055555555 +lon_0=5.38763888888889 "
+      "+k=0.999908 +x_0=155000 +y_0=463000 +ellps=bessel "
+      "+towgs84=565.237,50.0087,465.658,-0.406857,0.350733,-1.87035,4.0812 "
+      "+units=m +no_defs")
+
+# Manholes are updated this many at a time.
+BATCH_SIZE = 1000
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Fill the RD geometries of existing manholes and sewers."
+        manhole_table = orm['lizard_riool.Manhole']._meta.db_table
+        sewer_table = orm['lizard_riool.Sewer']._meta.db_table
+
+        # Without a GeoManager, geometries are the EWKB of the database
+        manholes = orm['lizard_riool.Manhole'].objects.values_list(
+            'pk', 'the_geom')
+        batch = []
+        for pk, the_geom in manholes.iterator():
+            the_geom_rd = GEOSGeometry(the_geom)
+            the_geom_rd.transform(RD)
+            batch.append((pk, the_geom_rd.wkt))
+            if len(batch) == BATCH_SIZE:
+                self.update_manholes(manhole_table, batch)
+                batch = []
+        if batch:
+            self.update_manholes(manhole_table, batch)
+
+        # A sewer is the line between its manholes
+        db.execute(
+            "UPDATE {sewer} SET the_geom_rd = ST_MakeLine("
+            "m1.the_geom_rd, m2.the_geom_rd) "
+            "FROM {manhole} m1, {manhole} m2 "
+            "WHERE {sewer}.manhole1_id = m1.id "
+            "AND {sewer}.manhole2_id = m2.id".format(
+                sewer=sewer_table, manhole=manhole_table))
+
+    def update_manholes(self, manhole_table, batch):
+        "Set the RD geometries of a batch of (pk, WKT) in one statement."
+        db.execute(
+            "UPDATE {manhole} SET the_geom_rd = "
+            "ST_GeomFromText(v.wkt, 28992) "
+            "FROM (VALUES {values}) AS v(id, wkt) "
+            "WHERE {manhole}.id = v.id".format(
+                manhole=manhole_table,
+                values=", ".join(["(%s, %s)"] * len(batch))),
+            [value for row in batch for value in row])
+
+    def backwards(self, orm):
+        "Nothing to do, the columns are dropped by the previous migration."
+
+    models = {
+        'lizard_riool.manhole': {
+            'Meta': {'object_name': 'Manhole'},
+            'code': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'ground_level': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sewerage': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lizard_riool.Sewerage']"}),
+            'sink': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'the_geom': ('django.contrib.gis.db.models.fields.PointField', [], {}),
+            'the_geom_rd': ('django.contrib.gis.db.models.fields.PointField', [], {'srid': '28992', 'null': 'True'})
+        },
+        'lizard_riool.sewer': {
+            'Meta': {'object_name': 'Sewer'},
+            'bob1': ('django.db.models.fields.FloatField', [], {}),
+            'bob2': ('django.db.models.fields.FloatField', [], {}),
+            'code': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'diameter': ('django.db.models.fields.FloatField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'manhole1': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['lizard_riool.Manhole']"}),
+            'manhole2': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['lizard_riool.Manhole']"}),
+            'quality': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'sewerage': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lizard_riool.Sewerage']"}),
+            'shape': ('django.db.models.fields.CharField', [], {'default': "'A'", 'max_length': '1'}),
+            'the_geom': ('django.contrib.gis.db.models.fields.LineStringField', [], {}),
+            'the_geom_length': ('django.db.models.fields.FloatField', [], {}),
+            'the_geom_rd': ('django.contrib.gis.db.models.fields.LineStringField', [], {'srid': '28992', 'null': 'True'})
+        },
+        'lizard_riool.sewerage': {
+            'Meta': {'object_name': 'Sewerage'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'generated_rib': ('django.db.models.fields.FilePathField', [], {'max_length': '400', 'null': 'True', 'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/sewerages'"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'rib': ('django.db.models.fields.FilePathField', [], {'max_length': '400', 'null': 'True', 'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/sewerages'"}),
+            'rmb': ('django.db.models.fields.FilePathField', [], {'max_length': '400', 'null': 'True', 'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/sewerages'"})
+        },
+        'lizard_riool.sewermeasurement': {
+            'Meta': {'object_name': 'SewerMeasurement'},
+            'bob': ('django.db.models.fields.FloatField', [], {}),
+            'dist': ('django.db.models.fields.FloatField', [], {}),
+            'flooded_pct': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'obb': ('django.db.models.fields.FloatField', [], {}),
+            'sewer': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'measurements'", 'to': "orm['lizard_riool.Sewer']"}),
+            'the_geom': ('django.contrib.gis.db.models.fields.PointField', [], {}),
+            'virtual': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'water_level': ('django.db.models.fields.FloatField', [], {'null': 'True'})
+        },
+        'lizard_riool.upload': {
+            'Meta': {'object_name': 'Upload'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1', 'null': 'True'}),
+            'the_file': ('django.db.models.fields.FilePathField', [], {'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/uploads'", 'max_length': '400'}),
+            'the_time': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        'lizard_riool.uploadedfileerror': {
+            'Meta': {'ordering': "('uploaded_file', 'line')", 'object_name': 'UploadedFileError'},
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '300'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'line': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'uploaded_file': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lizard_riool.Upload']"})
+        }
+    }
+
+    complete_apps = ['lizard_riool']
\ No newline at end of file
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from itertools import groupby
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import LineString
+
+# Copied from lizard_riool.models as they were when this migration was
+# written, so that later changes there don't change what it does.
+CLASSES = (
+    ('A', 0.00, 0.10),
+    ('B', 0.10, 0.25),
+    ('C', 0.25, 0.50),
+    ('D', 0.50, 0.75),
+    ('E', 0.75, 1.01),
+)
+UNKNOWN = '?'
+
+# Segments are inserted, and sewers updated, this many at a time.
+BATCH_SIZE = 1000
+
+
+def klasse(pct):
+    for name, min_pct, max_pct in CLASSES:
+        if pct >= min_pct and pct < max_pct:
+            return name
+    return UNKNOWN
+
+
+def worst_class(klasses):
+    order = [name for name, _, _ in CLASSES]
+    known = [name for name in klasses if name != UNKNOWN]
+    if not known:
+        return UNKNOWN
+    return max(known, key=order.index)
+
+
+def stretches(measurements):
+    "Measurements are (flooded_pct, the_geom) tuples, sorted by dist."
+    result = []
+    for flooded_pct, the_geom in measurements:
+        name = klasse(flooded_pct)
+        if result and result[-1][0] == name:
+            result[-1][1].append(the_geom)
+        else:
+            if result:
+                result[-1][1].append(the_geom)
+            result.append((name, [the_geom]))
+    return [(name, points) for name, points in result if len(points) >= 2]
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Summarize the lost capacity of existing sewers."
+        Segment = orm['lizard_riool.LostCapacitySegment']
+        measurements = (
+            orm['lizard_riool.SewerMeasurement'].objects.
+            order_by('sewer', 'dist').
+            values_list('sewer_id', 'flooded_pct', 'the_geom'))
+
+        segments = []
+        sewers_by_class = {}
+        for sewer_id, rows in groupby(
+            measurements.iterator(), key=lambda row: row[0]):
+            # Without a GeoManager, geometries are the EWKB of the database
+            rows = [(flooded_pct, GEOSGeometry(the_geom))
+                    for _, flooded_pct, the_geom in rows]
+            for name, points in stretches(rows):
+                segments.append(Segment(
+                        sewer_id=sewer_id, klasse=name,
+                        the_geom=LineString(points)))
+            sewers_by_class.setdefault(worst_class(
+                    [klasse(flooded_pct) for flooded_pct, _ in rows]),
+                []).append(sewer_id)
+
+            if len(segments) >= BATCH_SIZE:
+                Segment.objects.bulk_create(segments)
+                segments = []
+        Segment.objects.bulk_create(segments)
+
+        # Sewers without measurements keep the default, unknown class
+        for name, sewer_ids in sewers_by_class.iteritems():
+            for i in range(0, len(sewer_ids), BATCH_SIZE):
+                orm['lizard_riool.Sewer'].objects.filter(
+                    pk__in=sewer_ids[i:i + BATCH_SIZE]).update(
+                    worst_class=name)
+
+    def backwards(self, orm):
+        orm['lizard_riool.LostCapacitySegment'].objects.all().delete()
+
+    models = {
+        'lizard_riool.lostcapacitysegment': {
+            'Meta': {'object_name': 'LostCapacitySegment'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'klasse': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'sewer': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'segments'", 'to': "orm['lizard_riool.Sewer']"}),
+            'the_geom': ('django.contrib.gis.db.models.fields.LineStringField', [], {})
+        },
+        'lizard_riool.manhole': {
+            'Meta': {'object_name': 'Manhole'},
+            'code': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'ground_level': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sewerage': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lizard_riool.Sewerage']"}),
+            'sink': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'the_geom': ('django.contrib.gis.db.models.fields.PointField', [], {}),
+            'the_geom_rd': ('django.contrib.gis.db.models.fields.PointField', [], {'srid': '28992', 'null': 'True'})
+        },
+        'lizard_riool.sewer': {
+            'Meta': {'object_name': 'Sewer'},
+            'bob1': ('django.db.models.fields.FloatField', [], {}),
+            'bob2': ('django.db.models.fields.FloatField', [], {}),
+            'code': ('django.db.models.fields.CharField', [], {'max_length': '30'}),
+            'diameter': ('django.db.models.fields.FloatField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'manhole1': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['lizard_riool.Manhole']"}),
+            'manhole2': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['lizard_riool.Manhole']"}),
+            'quality': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'sewerage': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lizard_riool.Sewerage']"}),
+            'shape': ('django.db.models.fields.CharField', [], {'default': "'A'", 'max_length': '1'}),
+            'the_geom': ('django.contrib.gis.db.models.fields.LineStringField', [], {}),
+            'the_geom_length': ('django.db.models.fields.FloatField', [], {}),
+            'the_geom_rd': ('django.contrib.gis.db.models.fields.LineStringField', [], {'srid': '28992', 'null': 'True'}),
+            'worst_class': ('django.db.models.fields.CharField', [], {'default': "'?'", 'max_length': '1'})
+        },
+        'lizard_riool.sewerage': {
+            'Meta': {'object_name': 'Sewerage'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'generated_rib': ('django.db.models.fields.FilePathField', [], {'max_length': '400', 'null': 'True', 'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/sewerages'"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'rib': ('django.db.models.fields.FilePathField', [], {'max_length': '400', 'null': 'True', 'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/sewerages'"}),
+            'rmb': ('django.db.models.fields.FilePathField', [], {'max_length': '400', 'null': 'True', 'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/sewerages'"})
+        },
+        'lizard_riool.sewermeasurement': {
+            'Meta': {'object_name': 'SewerMeasurement'},
+            'bob': ('django.db.models.fields.FloatField', [], {}),
+            'dist': ('django.db.models.fields.FloatField', [], {}),
+            'flooded_pct': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'obb': ('django.db.models.fields.FloatField', [], {}),
+            'sewer': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'measurements'", 'to': "orm['lizard_riool.Sewer']"}),
+            'the_geom': ('django.contrib.gis.db.models.fields.PointField', [], {}),
+            'virtual': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'water_level': ('django.db.models.fields.FloatField', [], {'null': 'True'})
+        },
+        'lizard_riool.upload': {
+            'Meta': {'object_name': 'Upload'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1', 'null': 'True'}),
+            'the_file': ('django.db.models.fields.FilePathField', [], {'path': "'/home/remcogerlich/src/git/almere-site/var/lizard_riool/uploads'", 'max_length': '400'}),
+            'the_time': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        'lizard_riool.uploadedfileerror': {
+            'Meta': {'ordering': "('uploaded_file', 'line')", 'object_name': 'UploadedFileError'},
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '300'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'line': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'uploaded_file': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['lizard_riool.Upload']"})
+        }
+    }
+
+    complete_apps = ['lizard_riool']
\ No newline at end of file
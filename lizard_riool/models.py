@@ -24,21 +24,26 @@ This serves as a long usage message.
 """
 
 from os.path import basename, splitext
+import hashlib
 import logging
 import math
 import os
 import shutil
 
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import LineString
+from django.contrib.gis.geos import Polygon
 from django.conf import settings
 
 from sufriblib.parsers import enumerate_file
 
+from lizard_riool.progress import STAGES
 from lizard_riool.waar import WAAR
 
 
 RDNEW = 28992
 SRID = RDNEW
+GOOGLE = 3857  # aka 900913
 
 logger = logging.getLogger(__name__)
 
@@ -74,6 +79,61 @@ def get_class_boundaries(pct):
     return UNKNOWN_CLASS[0], UNKNOWN_CLASS[2], UNKNOWN_CLASS[3]
 
 
+def bounding_box(coordinates, srid):
+    "Return the bounding box of (x, y) tuples as a Polygon."
+    xs = [x for x, _ in coordinates]
+    ys = [y for _, y in coordinates]
+    box = Polygon.from_bbox((min(xs), min(ys), max(xs), max(ys)))
+    box.srid = srid
+    return box
+
+
+def worst_class(klasses):
+    """Return the worst of some lost capacity classes. The unknown class
+    only counts if none of the others occur."""
+    order = [klasse for klasse, _, _, _, _ in CLASSES]
+    known = [klasse for klasse in klasses if klasse != UNKNOWN_CLASS[0]]
+    if not known:
+        return UNKNOWN_CLASS[0]
+    return max(known, key=order.index)
+
+
+def lost_capacity_stretches(measurements):
+    """Split a sewer into stretches of equal lost capacity class.
+
+    Measurements need a dist, flooded_pct and the_geom. Returns a list
+    of (klasse, points) tuples, ordered along the sewer. Each stretch
+    runs up to the first point of the next, so that together they
+    cover the whole sewer."""
+    stretches = []
+    for measurement in sorted(measurements, key=lambda m: m.dist):
+        klasse = get_class_boundaries(measurement.flooded_pct)[0]
+        if stretches and stretches[-1][0] == klasse:
+            stretches[-1][1].append(measurement.the_geom)
+        else:
+            if stretches:
+                stretches[-1][1].append(measurement.the_geom)
+            stretches.append((klasse, [measurement.the_geom]))
+    # A single point at the very end has no length.
+    return [(klasse, points) for klasse, points in stretches
+            if len(points) >= 2]
+
+
+def content_hasher():
+    """Return a new hash object for the contents of uploaded files, see
+    Upload.content_hash."""
+    return hashlib.sha256()
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    "Return the content hash of a file, as a hex string."
+    hasher = content_hasher()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), ''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
 def circular_surface(obj):
     """return section surface of obj with diam
     """
@@ -95,6 +155,80 @@ def failure_function(*argv, **kwargs):
     logger.warn("invoking failure function!")
 
 
+class UploadBatch(models.Model):
+    """A ZIP file with many RIB/RMB pairs, uploaded at once. Its RIB
+    and RMB files are extracted into Uploads of the batch (see
+    batches.py), whose pairs are then processed in parallel."""
+    EXTRACTING = 1
+    EXTRACTED = 2
+    UNSUCCESSFUL = 3
+
+    STATUS_CHOICES = (
+        (EXTRACTING, "Wordt uitgepakt"),
+        (EXTRACTED, "Uitgepakt"),
+        (UNSUCCESSFUL, "Afgekeurd"))
+
+    BASE_PATH = os.path.join(
+        settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'batches')
+
+    filename = models.CharField(max_length=200)
+    the_time = models.DateTimeField(auto_now_add=True, verbose_name='Time')
+    status = models.IntegerField(choices=STATUS_CHOICES, default=EXTRACTING)
+    error_message = models.CharField(max_length=300, blank=True)
+
+    class Meta:
+        ordering = ('-the_time',)
+
+    @property
+    def directory(self):
+        return os.path.join(UploadBatch.BASE_PATH, str(self.id))
+
+    @property
+    def zip_path(self):
+        return os.path.join(self.directory, self.filename)
+
+    def move_file(self, path):
+        """Move the uploaded ZIP file into the directory of this batch.
+        Saves this object first, its directory is named after its id."""
+        self.filename = os.path.basename(path)
+        self.save()
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        shutil.move(path, self.zip_path)
+
+    def delete(self):
+        """Delete this batch and what is left of the ZIP file. The
+        uploads extracted from it are kept."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+        return super(UploadBatch, self).delete()
+
+    def set_unsuccessful(self, error_message):
+        self.status = UploadBatch.UNSUCCESSFUL
+        self.error_message = error_message[:300]
+        self.save()
+
+    def status_counts(self):
+        """Return the number of uploads of this batch per status, as a
+        dictionary {Upload.status_string(): count}."""
+        return dict(
+            (Upload.STATUS_STRINGS.get(row['status'], "unknown"),
+             row['count'])
+            for row in self.uploads.values('status').annotate(
+                count=models.Count('pk')))
+
+    def finished(self):
+        "Return True if nothing of this batch needs to be done anymore."
+        if self.status == UploadBatch.EXTRACTING:
+            return False
+        return not self.uploads.filter(status__in=(
+                Upload.NOT_PROCESSED_YET, Upload.BEING_PROCESSED)).exists()
+
+    def __unicode__(self):
+        return self.filename
+
+
 class Upload(models.Model):
     NOT_PROCESSED_YET = 1
     BEING_PROCESSED = 2
@@ -110,6 +244,14 @@ class Upload(models.Model):
     BASE_PATH = os.path.join(
         settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'uploads')
 
+    # Reports of a profiled processing run (see profiling.py), stored
+    # in the directory of the upload: the cProfile data, a text summary
+    # of it and the top memory allocations.
+    PROFILE_FILES = (
+        'processing.prof',
+        'processing_profile.txt',
+        'processing_allocations.txt')
+
     "An uploaded file"
     objects = models.GeoManager()
     the_file = models.FilePathField(
@@ -118,24 +260,44 @@ class Upload(models.Model):
                          # really really don't want to run into the
                          # limit
     
-    the_time = models.DateTimeField(auto_now=True, verbose_name='Time')
+    # Updated on every save, so it also serves as the time of the last
+    # status change (see views.uploaded_file_list).
+    the_time = models.DateTimeField(
+        auto_now=True, verbose_name='Time', db_index=True)
 
     status = models.IntegerField(
         choices=STATUS_CHOICES, default=1, null=True)
 
+    # Profile the processing of this upload? See profiling.py.
+    profile = models.BooleanField(default=False)
+
+    # Hash of the contents of the file (see content_hasher), to
+    # recognize files that were processed before.
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+
+    # The ZIP file this upload was extracted from, if any.
+    batch = models.ForeignKey(
+        UploadBatch, null=True, blank=True, related_name='uploads',
+        on_delete=models.SET_NULL)
+
+    # For use in Javascript (beheer.js)
+    STATUS_STRINGS = {
+        NOT_PROCESSED_YET: "not_being_processed_yet",
+        BEING_PROCESSED: "being_processed",
+        UNSUCCESSFUL: "with_errors",
+        SUCCESSFUL: "successful"}
+
     def status_string(self):
         """For use in Javascript (beheer.js)"""
-        return {
-            1: "not_being_processed_yet",
-            2: "being_processed",
-            3: "with_errors",
-            4: "successful"
-            }.get(self.status, "unknown")
+        return Upload.STATUS_STRINGS.get(self.status, "unknown")
 
-    def move_file(self, path):
+    def move_file(self, path, copy=False):
         """Move file to a nice place to stay, where there won't be
         other files with accidentally identical names. Saves this
-        object. Twice, if it doesn't have an id yet."""
+        object. Twice, if it doesn't have an id yet. With copy=True,
+        the original file is left in place.
+
+        If the content hash isn't known yet, it is computed here."""
         if not self.id:
             self.save()
 
@@ -146,18 +308,37 @@ class Upload(models.Model):
 
         newpath = os.path.join(directory, os.path.basename(path))
 
-        shutil.move(path, newpath)
+        if copy:
+            shutil.copy(path, newpath)
+        else:
+            shutil.move(path, newpath)
         self.the_file = newpath
+        if not self.content_hash:
+            self.content_hash = file_hash(newpath)
         self.save()
 
     def delete(self):
         """Delete this Upload including the file and directory"""
-        shutil.rmtree(
-            os.path.join(Upload.BASE_PATH, str(self.id)),
-            ignore_errors=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
 
         return super(Upload, self).delete()
 
+    @property
+    def directory(self):
+        return os.path.join(Upload.BASE_PATH, str(self.id))
+
+    def profile_files(self):
+        "Return the names of the profiling reports of this upload."
+        return [filename for filename in Upload.PROFILE_FILES
+                if os.path.exists(os.path.join(self.directory, filename))]
+
+    def reset(self):
+        """Forget the outcome of processing this upload, so that it can
+        be processed again."""
+        UploadedFileError.objects.filter(uploaded_file=self).delete()
+        self.status = Upload.NOT_PROCESSED_YET
+        self.save()
+
     @property
     def full_path(self):
         return str(self.the_file)
@@ -207,20 +388,27 @@ class Upload(models.Model):
         for e in errorlist:
             self.record_error(e.message, e.line_number)
 
-    def error_description(self):
+    def error_description(self, error_count=None):
+        """Describe the errors of an unsuccessful upload. If the number
+        of errors is already known (e.g. from an annotation), pass it
+        as error_count; then only the first error is loaded."""
         if self.status != Upload.UNSUCCESSFUL:
             return None
 
-        errors = list(UploadedFileError.objects.filter(
-                uploaded_file=self))
+        errors = UploadedFileError.objects.filter(uploaded_file=self)
+        if error_count is None:
+            errors = list(errors)
+            error_count = len(errors)
+        elif error_count:
+            errors = errors[:1]
 
-        if not errors:
+        if not error_count:
             return None
-        if len(errors) == 1:
+        if error_count == 1:
             return errors[0].message()
         else:
             return ("{0} fouten, eerste is: {1}"
-                    .format(len(errors), errors[0].message()))
+                    .format(error_count, errors[0].message()))
 
     def set_being_processed(self):
         self.status = Upload.BEING_PROCESSED
@@ -258,6 +446,24 @@ class UploadedFileError(models.Model):
             message=self.message())
 
 
+class UploadStageTiming(models.Model):
+    """Resources used by one stage of processing an upload, as measured
+    by progress.Progress. Recorded for the RMB of a RIB/RMB pair."""
+    upload = models.ForeignKey(Upload, related_name='stage_timings')
+    stage = models.CharField(max_length=20, choices=STAGES)
+    wall_time = models.FloatField(help_text="seconds")
+    cpu_time = models.FloatField(help_text="seconds")
+    peak_rss = models.IntegerField(null=True, help_text="kB")
+    rows = models.IntegerField(null=True)
+
+    class Meta:
+        ordering = ('upload', 'id')
+
+    def __unicode__(self):
+        return "{upload}: {stage}".format(
+            upload=self.upload, stage=self.stage)
+
+
 class Sewerage(models.Model):
     """A system of sewers.
 
@@ -288,6 +494,28 @@ class Sewerage(models.Model):
 
     active = models.BooleanField(default=True)
 
+    # Content hashes of the uploaded files (see Upload.content_hash), so
+    # that an identical pair isn't processed again.
+    rib_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    rmb_hash = models.CharField(max_length=64, blank=True, db_index=True)
+
+    # Bounding box of the manholes, stored at ingest so that zooming
+    # to a sewerage doesn't need an aggregate query.
+    extent = models.PolygonField(null=True)
+    extent_rd = models.PolygonField(srid=RDNEW, null=True)
+    extent_google = models.PolygonField(srid=GOOGLE, null=True)
+
+    objects = models.GeoManager()
+
+    def set_extent(self, points, rd_points):
+        """Set the extent fields from the WGS84 and RD (x, y) coordinates
+        of the manholes. Doesn't save."""
+        self.extent = bounding_box(points, 4326)
+        self.extent_rd = bounding_box(rd_points, RDNEW)
+        # Spherical mercator preserves the order of x and y, so the
+        # transformed box is still a bounding box.
+        self.extent_google = self.extent.transform(GOOGLE, clone=True)
+
     def move_files(self, rib_path, rmb_path):
         """Move file to a nice place to stay, where there won't be
         other files with accidentally identical names. Saves this
@@ -310,11 +538,12 @@ class Sewerage(models.Model):
 
         self.save()
 
-    def generate_rib(self):
+    def generate_rib(self, directory=None):
         """When everything is saved and moved, a "result" RIB file is
-        generated."""
+        generated, next to the RIB file unless another directory is
+        given."""
         self.generated_rib = os.path.join(
-            os.path.dirname(self.rib),
+            directory or os.path.dirname(self.rib),
             os.path.splitext(os.path.basename(self.rmb))[0] + '_results.rib')
 
         with open(self.generated_rib, 'w') as rib:
@@ -373,6 +602,7 @@ class Manhole(models.Model):
     sink = models.IntegerField(default=0)
     ground_level = models.FloatField(blank=True, null=True)
     the_geom = models.PointField()
+    the_geom_rd = models.PointField(srid=RDNEW, null=True)
     objects = models.GeoManager()
 
     @property
@@ -425,6 +655,10 @@ class Sewer(models.Model):
     bob2 = models.FloatField()
     the_geom_length = models.FloatField()  # in meters
     the_geom = models.LineStringField()
+    the_geom_rd = models.LineStringField(srid=RDNEW, null=True)
+    # Worst lost capacity class of all measurements, used for drawing
+    # the sewer at coarse scales.
+    worst_class = models.CharField(max_length=1, default=UNKNOWN_CLASS[0])
     objects = models.GeoManager()
 
     @property
@@ -463,6 +697,18 @@ class Sewer(models.Model):
         else:
             self.quality = Sewer.QUALITY_UNRELIABLE
 
+    def summarize_lost_capacity(self, measurements):
+        """Set worst_class from measurements with a computed flooded_pct
+        and return unsaved LostCapacitySegments for them. Doesn't save
+        this sewer."""
+        stretches = lost_capacity_stretches(measurements)
+        self.worst_class = worst_class(
+            [get_class_boundaries(m.flooded_pct)[0] for m in measurements])
+        return [
+            LostCapacitySegment(
+                sewer=self, klasse=klasse, the_geom=LineString(points))
+            for klasse, points in stretches]
+
     def generate_waar_lines(self):
         """Construct and return *WAAR records for in a RIB file.
 
@@ -500,6 +746,8 @@ class SewerMeasurement(models.Model):
     flooded_pct = models.FloatField(null=True)
     bob = models.FloatField()   # bob <= water_level <= obb
     obb = models.FloatField()
+    # Code of the sink manhole whose water reaches this measurement
+    sink_code = models.CharField(max_length=30, blank=True, default='')
     the_geom = models.PointField()
     objects = models.GeoManager()
 
@@ -517,37 +765,20 @@ class SewerMeasurement(models.Model):
             self.flooded_pct = None
             return
 
-        depth = self.water_level - self.bob
-
-        if depth <= 0.0:
-            self.flooded_pct = 0
-            return
-
-        diameter = self.obb - self.bob
-
-        if depth >= diameter:
-            self.flooded_pct = 1
-            return
-
         # Sewer to use can be passed as an argument for speed
         sewer = use_sewer or self.sewer
-        if sewer.is_rectangular:
-            self.flooded_pct = depth / diameter
-            return
+        self.flooded_pct = flooded_fraction(
+            self.water_level, self.bob, self.obb, sewer.is_rectangular)
 
-        # Assume circular
-        area = math.pi * ((diameter / 2) ** 2)
-        if depth == diameter / 2:
-            percentage = 0.5
-        elif depth < diameter / 2:
-            percentage = disc_segment(
-                radius=diameter / 2, height=depth) / area
-        else:
-            percentage = (area - disc_segment(
-                    radius=diameter / 2,
-                    height=diameter - depth)) / area
 
-        self.flooded_pct = percentage
+class LostCapacitySegment(models.Model):
+    """A stretch of a sewer in which all measurements have the same
+    lost capacity class. Used for drawing at medium scales, where
+    individual measurements would be too many."""
+    sewer = models.ForeignKey(Sewer, related_name="segments")
+    klasse = models.CharField(max_length=1)
+    the_geom = models.LineStringField()
+    objects = models.GeoManager()
 
 
 def disc_segment(radius, height):
@@ -570,3 +801,34 @@ def disc_segment(radius, height):
     area = ((radius ** 2) / 2) * (angle - math.sin(angle))
 
     return area
+
+
+def flooded_fraction(water_level, bob, obb, rectangular=False):
+    """Return the part of the cross section of a sewer, with bob and
+    obb at some point, that is below water_level; None if the water
+    level is unknown. Sewers that aren't rectangular are circular."""
+    if water_level is None:
+        return None
+
+    depth = water_level - bob
+
+    if depth <= 0.0:
+        return 0
+
+    diameter = obb - bob
+
+    if depth >= diameter:
+        return 1
+
+    if rectangular:
+        return depth / diameter
+
+    # Assume circular
+    area = math.pi * ((diameter / 2) ** 2)
+    if depth == diameter / 2:
+        return 0.5
+    elif depth < diameter / 2:
+        return disc_segment(radius=diameter / 2, height=depth) / area
+    else:
+        return (area - disc_segment(
+                radius=diameter / 2, height=diameter - depth)) / area
@@ -0,0 +1,86 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""A cache of parsed SUFRIB files, keyed by their content hash.
+
+Parsing a large RIB or RMB file takes a good part of processing it, and
+the same files are parsed again when an upload is reprocessed, profiled
+or benchmarked. `parse` is a drop-in replacement for
+sufriblib.parsers.parse that stores its result (the parsed records with
+their line numbers, and the errors) pickled and compressed in a
+size-bounded DiskCache.
+
+Since entries are keyed by content, they never need to be invalidated.
+Change FORMAT_VERSION when sufriblib's parse results change, so old
+entries are no longer used.
+"""
+
+import cPickle as pickle
+import logging
+import os
+import zlib
+
+from django.conf import settings
+
+from sufriblib import parsers
+
+from lizard_riool import models
+from lizard_riool.disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# Set to False to always parse, e.g. when benchmarking parsing.
+ENABLED = getattr(settings, 'LIZARD_RIOOL_PARSE_CACHE', True)
+
+PARSE_CACHE = DiskCache(
+    directory=getattr(
+        settings, 'LIZARD_RIOOL_PARSE_CACHE_DIR',
+        os.path.join(settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'parsed')),
+    max_size=getattr(
+        settings, 'LIZARD_RIOOL_PARSE_CACHE_SIZE', 200 * 1024 * 1024),
+    suffix='.pickle.z')
+
+# zlib level; parsed files compress well already at low levels.
+COMPRESSION_LEVEL = 1
+
+
+def cache_key(path, content_hash):
+    # sufriblib decides how to parse a file by its suffix, so a RIB file
+    # renamed to .RMB must not find the parsed RIB.
+    suffix = os.path.splitext(path)[1].lower().lstrip('.')
+    return (FORMAT_VERSION, suffix, content_hash[:2], content_hash)
+
+
+def parse(path, content_hash=None):
+    """Return (instance, errors) like sufriblib.parsers.parse, from the
+    cache if this content was parsed before. Pass the content hash if it
+    is known (Upload.content_hash), otherwise the file is hashed."""
+    if not ENABLED:
+        return parsers.parse(path)
+
+    if not content_hash:
+        content_hash = models.file_hash(path)
+    key = cache_key(path, content_hash)
+
+    data = PARSE_CACHE.get(key)
+    if data is not None:
+        try:
+            return pickle.loads(zlib.decompress(data))
+        except Exception:
+            # E.g. written by a different version of sufriblib
+            logger.warn("Could not load the parse of %s from the cache",
+                        path, exc_info=True)
+
+    result = parsers.parse(path)
+
+    try:
+        PARSE_CACHE.put(key, zlib.compress(
+                pickle.dumps(result, pickle.HIGHEST_PROTOCOL),
+                COMPRESSION_LEVEL))
+    except (pickle.PicklingError, TypeError, IOError, OSError):
+        # Never let the cache break parsing
+        logger.warn("Could not store the parse of %s in the cache",
+                    path, exc_info=True)
+
+    return result
@@ -0,0 +1,110 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Profiling the processing of a single upload in production.
+
+If an upload is marked for profiling (Upload.profile, set with an admin
+action) or its filename matches one of LIZARD_RIOOL_PROFILE_UPLOADS
+(fnmatch patterns, case insensitive), its processing runs under cProfile
+and, if available, tracemalloc. The reports are stored in the directory
+of the upload, see Upload.PROFILE_FILES.
+
+tracemalloc is part of Python 3.4 and later; on Python 2.7 it needs the
+patched interpreter of the pytracemalloc project. Without it only the
+cProfile reports are written.
+"""
+
+import cProfile
+import fnmatch
+import logging
+import os
+import pstats
+
+from django.conf import settings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_UPLOADS = getattr(settings, 'LIZARD_RIOOL_PROFILE_UPLOADS', ())
+
+# Number of functions and allocation sites in the text reports.
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 50
+
+# Number of frames tracemalloc stores per allocation.
+TRACEBACK_FRAMES = 10
+
+
+def should_profile(*uploads):
+    "Return True if processing of these uploads should be profiled."
+    for upload in uploads:
+        if upload.profile:
+            return True
+        filename = upload.filename.lower()
+        if any(fnmatch.fnmatch(filename, pattern.lower())
+               for pattern in PROFILE_UPLOADS):
+            return True
+    return False
+
+
+def profiled_call(upload, function, *args, **kwargs):
+    """Call function, storing profiling reports in the directory of
+    upload. The reports are written even if function raises."""
+    profile = cProfile.Profile()
+    if tracemalloc is not None:
+        tracemalloc.start(TRACEBACK_FRAMES)
+
+    try:
+        return profile.runcall(function, *args, **kwargs)
+    finally:
+        snapshot = traced_memory = None
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            traced_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        try:
+            write_reports(upload, profile, snapshot, traced_memory)
+        except Exception:
+            # Never let profiling break processing
+            logger.exception("Could not write profile of %s", upload)
+
+
+def write_reports(upload, profile, snapshot, traced_memory):
+    directory = upload.directory
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    profile_path, report_path, allocations_path = [
+        os.path.join(directory, filename)
+        for filename in upload.PROFILE_FILES]
+
+    profile.dump_stats(profile_path)
+
+    with open(report_path, 'w') as f:
+        stats = pstats.Stats(profile, stream=f)
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        stats.sort_stats('time').print_stats(TOP_FUNCTIONS)
+
+    with open(allocations_path, 'w') as f:
+        if snapshot is None:
+            f.write("tracemalloc is not available in this Python.\n")
+            return
+
+        current, peak = traced_memory
+        f.write("Traced memory at the end: {0} kB, peak: {1} kB\n\n".format(
+                current // 1024, peak // 1024))
+
+        f.write("Top {0} allocation sites:\n".format(TOP_ALLOCATIONS))
+        for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+            f.write("{0}\n".format(statistic))
+
+        f.write("\nLargest allocation, traceback:\n")
+        largest = snapshot.statistics('traceback')[:1]
+        for statistic in largest:
+            f.write("{0}\n".format(statistic))
+            for line in statistic.traceback.format():
+                f.write("{0}\n".format(line))
@@ -0,0 +1,163 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Progress of uploads that are being processed.
+
+Processing a large RIB/RMB pair takes minutes. While it runs, the task
+publishes the current stage and how many items of it are done to the
+Django cache, under the ids of both uploads. Readers (see
+views.upload_progress_view) read that entry instead of the database;
+the upload page asks for it every few seconds.
+
+Processing runs in a Celery worker and the page is served by the web
+processes, so they must share the cache backend (e.g. memcached, as
+for the task locks, see README.rst). With the default local memory
+cache, each process only sees its own entries and no progress is
+shown.
+
+The same object measures the resources used by each stage (wall time,
+CPU time, peak memory), which tasks.py stores as UploadStageTiming.
+"""
+
+import os
+import time
+
+from django.core.cache import cache
+
+# Processing stages, in order, with the labels shown to users.
+STAGES = (
+    ('parsing', "Bestanden inlezen"),
+    ('validation', "Gegevens controleren"),
+    ('geometry', "Geometrie bepalen"),
+    ('lost_capacity', "Verloren berging berekenen"),
+    ('saving', "Opslaan"),
+    ('rib_generation', "RIB genereren"),
+)
+STAGE_LABELS = dict(STAGES)
+
+# Don't write counts to the cache more often than this (seconds).
+REPORT_INTERVAL = 0.5
+
+# How long progress is kept after the last update (seconds).
+TIMEOUT = 24 * 60 * 60
+
+
+def cpu_time():
+    "User plus system time used by this process, in seconds."
+    times = os.times()
+    return times[0] + times[1]
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process, so that it can
+    be measured per stage. Only works on Linux 4.0 and later; elsewhere
+    the peak is that of the process so far."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def peak_rss():
+    "Return the peak resident set size of this process in kB, or None."
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def cache_key(upload_id):
+    return 'lizard_riool_upload_progress_{0}'.format(upload_id)
+
+
+def get(upload_id):
+    "Return the progress of an upload as a dictionary, or None."
+    return cache.get(cache_key(upload_id))
+
+
+class Progress(object):
+    """Publishes the progress of processing some uploads.
+
+    Call `stage` when a stage starts, `advance` after each item of it
+    and `finish` at the end. Without upload ids nothing is published,
+    which is convenient when processing outside of an upload.
+
+    `timings` is a list with a dictionary per finished stage, with
+    keys stage, wall_time, cpu_time, peak_rss and rows (the number of
+    items done).
+    """
+
+    def __init__(self, *upload_ids):
+        self.upload_ids = upload_ids
+        self.state = {
+            'version': 0,
+            'stage': None,
+            'label': None,
+            'done': 0,
+            'total': None,
+            'finished': False,
+            # Seconds spent in each finished stage
+            'durations': {},
+            }
+        self.stage_started = None
+        self.stage_cpu_time = None
+        self.last_report = 0
+        self.timings = []
+
+    def stage(self, stage, total=None):
+        "Start a new stage of `total` items."
+        self._end_stage()
+        reset_peak_rss()
+        self.stage_started = time.time()
+        self.stage_cpu_time = cpu_time()
+        self.state.update(
+            stage=stage, label=STAGE_LABELS[stage], done=0, total=total)
+        self._report()
+
+    def set_total(self, total):
+        "Set the number of items of the current stage, once it is known."
+        self.state['total'] = total
+        self._report()
+
+    def advance(self, count=1):
+        "Record that `count` more items of the current stage are done."
+        self.state['done'] += count
+        if (self.state['done'] == self.state['total'] or
+            time.time() - self.last_report >= REPORT_INTERVAL):
+            self._report()
+
+    def finish(self):
+        "Record that processing has ended, successfully or not."
+        self._end_stage()
+        self.state.update(finished=True)
+        self._report()
+
+    def _end_stage(self):
+        if self.stage_started is None:
+            return
+
+        wall_time = time.time() - self.stage_started
+        self.state['durations'][self.state['stage']] = wall_time
+        self.timings.append({
+                'stage': self.state['stage'],
+                'wall_time': wall_time,
+                'cpu_time': cpu_time() - self.stage_cpu_time,
+                'peak_rss': peak_rss(),
+                'rows': self.state['done'] or None,
+                })
+        self.stage_started = None
+
+    def _report(self):
+        if not self.upload_ids:
+            return
+        self.state['version'] += 1
+        self.state['updated'] = time.time()
+        cache.set_many(
+            dict((cache_key(upload_id), self.state)
+                 for upload_id in self.upload_ids),
+            TIMEOUT)
+        self.last_report = time.time()
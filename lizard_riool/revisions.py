@@ -0,0 +1,285 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Revised RMB files for existing sewerages.
+
+Inspection contractors often send a corrected RMB file for a sewerage
+that was already processed. An RMB upload without a RIB, whose name is
+that of an existing sewerage, is treated as a revision (see
+tasks.process_uploaded_file). Instead of processing everything again:
+
+- the new RMB is compared with the stored one per sewer, by the
+  measurements get_mrio makes of them;
+- only the measurements of sewers that changed are replaced;
+- water levels are recomputed only where they can have changed, and
+  of the other sewers only the measurements whose results changed are
+  written;
+- lost capacity summaries are redone for the affected sewers and the
+  generated RIB is regenerated.
+
+The stored RIB file is used as is, so a revision can't change manholes
+or sewers. The new RMB file and generated RIB are written to a new
+directory of the sewerage, so that a revision that is rolled back
+leaves the stored files alone. After the transaction, the replaced
+files (or, if it failed, the new ones) must be removed with
+remove_files, and map caches must be invalidated, see
+invalidate_caches.
+"""
+
+from itertools import chain
+import logging
+import os
+import shutil
+
+from sufriblib.errors import Error
+
+from lizard_riool import lost_capacity
+from lizard_riool import models
+from lizard_riool import parse_cache
+from lizard_riool import save_uploaded_data
+from lizard_riool import spatial_index
+from lizard_riool import tiles
+from lizard_riool import vector_tiles
+from lizard_riool.progress import Progress
+
+logger = logging.getLogger(__name__)
+
+REVISION_PREFIX = 'revision_'
+
+
+def revised_sewerage(rmb_upload):
+    """Return the sewerage an RMB upload is a revision of, or None."""
+    sewerage_name = os.path.splitext(rmb_upload.filename)[0]
+    sewerages = models.Sewerage.objects.filter(name=sewerage_name)
+    return sewerages[0] if sewerages else None
+
+
+def revision_directory(sewerage, rmb_upload):
+    "Return the directory for the files of a revision of a sewerage."
+    return os.path.join(
+        os.path.dirname(sewerage.rib),
+        REVISION_PREFIX + str(rmb_upload.pk))
+
+
+def changed_mrios(ribinstance, old_rmbinstance, new_rmbinstance, rmberrors):
+    """Return the putdict and sewerdict of the stored RIB, and a
+    dictionary {sewer_id: MRIO measurements} of the sewers whose
+    measurements in the new RMB differ from those in the stored one.
+    Errors in the new RMB are appended to rmberrors."""
+    putdict = save_uploaded_data.get_puts(ribinstance, [])
+    sewerdict = save_uploaded_data.get_sewers(ribinstance, putdict, [])
+    old_lines = save_uploaded_data.mrio_lines_by_sewer_id(old_rmbinstance)
+    new_lines = save_uploaded_data.mrio_lines_by_sewer_id(new_rmbinstance)
+
+    changed = {}
+    for sewer_id, sewerinfo in sewerdict.iteritems():
+        new_mrios = save_uploaded_data.get_mrio(
+            new_lines, putdict, sewerinfo, rmberrors)
+        old_mrios = save_uploaded_data.get_mrio(
+            old_lines, putdict, sewerinfo, [])
+        if new_mrios != old_mrios:
+            changed[sewer_id] = new_mrios
+
+    for sewer_id in sorted(set(new_lines) - set(sewerdict)):
+        rmberrors.append(Error(
+                line_number=new_lines[sewer_id][0].line_number,
+                message=("Streng {sewer_id} komt niet voor in het RIB "
+                         "bestand van dit stelsel.").format(
+                    sewer_id=sewer_id)))
+
+    return putdict, sewerdict, changed
+
+
+def load_network(sewerage):
+    """Return the saved manholes, sewers and measurements of a sewerage
+    as dictionaries keyed by code, like save_into_database has them."""
+    manholes = dict(
+        (manhole.pk, manhole)
+        for manhole in models.Manhole.objects.filter(sewerage=sewerage))
+    saved_puts = dict(
+        (manhole.code, manhole) for manhole in manholes.itervalues())
+
+    saved_sewers = {}
+    sewer_codes = {}
+    for sewer in models.Sewer.objects.filter(sewerage=sewerage):
+        sewer.manhole1 = manholes[sewer.manhole1_id]
+        sewer.manhole2 = manholes[sewer.manhole2_id]
+        saved_sewers[sewer.code] = sewer
+        sewer_codes[sewer.pk] = sewer.code
+
+    measurements_dict = dict((code, []) for code in saved_sewers)
+    for measurement in models.SewerMeasurement.objects.filter(
+        sewer__sewerage=sewerage):
+        measurements_dict[sewer_codes[measurement.sewer_id]].append(
+            measurement)
+
+    return saved_puts, saved_sewers, measurements_dict
+
+
+def recompute_water_levels(
+    saved_puts, saved_sewers, measurements_dict, replaced):
+    """Compute water levels and flooded percentages after the
+    measurements of some sewers were replaced; `replaced` maps their
+    ids to the old, saved measurements. Only the part of the graph that
+    can be affected is recomputed (see lost_capacity.update_water_level).
+    Returns a list of (sewer_id, measurement) of the saved measurements
+    of the other sewers whose results changed."""
+    G, sink_nodes = lost_capacity.create_graph(
+        saved_puts, saved_sewers, measurements_dict)
+    unknown = lost_capacity.restore_water_level(
+        G, saved_puts, measurements_dict)
+
+    changed = set(
+        ("measurement", sewer_id, measurement.dist)
+        for sewer_id in replaced
+        for measurement in measurements_dict[sewer_id])
+    level = min(
+        measurement.bob for measurement in chain(
+            chain(*replaced.values()),
+            chain(*[measurements_dict[sewer_id] for sewer_id in replaced])))
+    region = lost_capacity.update_water_level(
+        G, sink_nodes, changed, unknown, level)
+
+    updated = []
+    for sewer_id, measurements in measurements_dict.iteritems():
+        sewer = saved_sewers[sewer_id]
+        for measurement in measurements:
+            node = ("measurement", sewer_id, measurement.dist)
+            if node not in region:
+                continue
+            before = (measurement.water_level, measurement.flooded_pct,
+                      measurement.sink_code)
+            measurement.set_water_level(G.node[node]['waterlevel'])
+            measurement.compute_flooded_pct(use_sewer=sewer)
+            measurement.sink_code = lost_capacity.sink_code(G, node)
+            if (sewer_id not in replaced and
+                (measurement.water_level, measurement.flooded_pct,
+                 measurement.sink_code) != before):
+                updated.append((sewer_id, measurement))
+    return updated
+
+
+def revise(sewerage, rmb_upload, progress=None):
+    """Process a revised RMB file of a sewerage. Like
+    protected_file_processing, meant to be run in a transaction, and
+    records errors in the upload. Returns the number of changed sewers,
+    the number of other measurements whose results changed, and the
+    list of stored files the revision replaced."""
+    if progress is None:
+        progress = Progress()
+
+    progress.stage('parsing')
+    if not (sewerage.rib and os.path.exists(sewerage.rib) and
+            sewerage.rmb and os.path.exists(sewerage.rmb)):
+        rmb_upload.record_error(
+            "De opgeslagen bestanden van stelsel '{name}' ontbreken, "
+            "verwijder het en verwerk het opnieuw.".format(
+                name=sewerage.name))
+        rmb_upload.set_unsuccessful()
+        return 0, 0, []
+
+    ribinstance, _ = parse_cache.parse(sewerage.rib, sewerage.rib_hash)
+    old_rmbinstance, _ = parse_cache.parse(sewerage.rmb, sewerage.rmb_hash)
+    new_rmbinstance, rmberrors = parse_cache.parse(
+        rmb_upload.full_path, rmb_upload.content_hash)
+
+    progress.stage('validation')
+    if new_rmbinstance:
+        putdict, sewerdict, changed = changed_mrios(
+            ribinstance, old_rmbinstance, new_rmbinstance, rmberrors)
+    if rmberrors or not new_rmbinstance:
+        rmb_upload.record_errors(rmberrors)
+        rmb_upload.set_unsuccessful()
+        return 0, 0, []
+
+    updated = []
+    if changed:
+        progress.stage('geometry', total=len(changed))
+        saved_puts, saved_sewers, measurements_dict = load_network(sewerage)
+        replaced = {}
+        for sewer_id, mrios in changed.iteritems():
+            replaced[sewer_id] = measurements_dict[sewer_id]
+            measurements_dict[sewer_id] = (
+                save_uploaded_data.build_sewer_measurements(
+                    saved_sewers[sewer_id], mrios))
+            progress.advance()
+
+        progress.stage('lost_capacity')
+        updated = recompute_water_levels(
+            saved_puts, saved_sewers, measurements_dict, replaced)
+
+        progress.stage('saving')
+        save_revision(saved_sewers, measurements_dict, changed, updated)
+
+    # The stored files are only replaced in the database; they are
+    # still needed if the transaction is rolled back.
+    replaced_files = [
+        path for path in (sewerage.rmb, sewerage.generated_rib) if path]
+    directory = revision_directory(sewerage, rmb_upload)
+    os.makedirs(directory)
+    rmb_path = os.path.join(directory, rmb_upload.filename)
+    shutil.move(rmb_upload.full_path, rmb_path)
+    sewerage.rmb = rmb_path
+    sewerage.rmb_hash = rmb_upload.content_hash
+    sewerage.save()
+
+    progress.stage('rib_generation')
+    sewerage.generate_rib(directory)
+
+    rmb_upload.set_successful()
+    logger.info("Revised %s: %d sewers changed, %d other measurements",
+                sewerage, len(changed), len(updated))
+    return len(changed), len(updated), replaced_files
+
+
+def save_revision(saved_sewers, measurements_dict, changed, updated):
+    """Replace the measurements of the changed sewers, update those of
+    other sewers whose results changed, and redo the lost capacity
+    summaries of all of them."""
+    changed_pks = [saved_sewers[sewer_id].pk for sewer_id in changed]
+    models.SewerMeasurement.objects.filter(sewer__in=changed_pks).delete()
+    models.SewerMeasurement.objects.bulk_create(list(chain(
+                *[measurements_dict[sewer_id] for sewer_id in changed])))
+    for sewer_id in changed:
+        saved_sewers[sewer_id].save()  # Quality may have changed
+
+    for _, measurement in updated:
+        models.SewerMeasurement.objects.filter(pk=measurement.pk).update(
+            water_level=measurement.water_level,
+            flooded_pct=measurement.flooded_pct,
+            sink_code=measurement.sink_code)
+
+    affected = set(changed) | set(sewer_id for sewer_id, _ in updated)
+    models.LostCapacitySegment.objects.filter(
+        sewer__in=[saved_sewers[sewer_id].pk for sewer_id in affected]
+        ).delete()
+    save_uploaded_data.save_lost_capacity_summaries(
+        dict((sewer_id, saved_sewers[sewer_id]) for sewer_id in affected),
+        dict((sewer_id, measurements_dict[sewer_id])
+             for sewer_id in affected))
+
+
+def remove_files(paths):
+    """Remove files and directories of revisions, after the transaction
+    that replaced them. A revision directory that is left empty is
+    removed too."""
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Already gone
+        directory = os.path.dirname(path)
+        if os.path.basename(directory).startswith(REVISION_PREFIX):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # Not empty
+
+
+def invalidate_caches(sewerage_id):
+    "Forget everything cached about a sewerage that was revised."
+    spatial_index.forget_sewerage(sewerage_id)
+    tiles.invalidate(sewerage_id)
+    vector_tiles.invalidate(sewerage_id)
@@ -2,31 +2,37 @@
 
 import math
 import os.path
+from collections import defaultdict
 from itertools import chain, count
 
 from django.contrib.gis.geos import LineString, Point
 
-from lizard_map.coordinates import RD
-
-from sufriblib import parsers
 from sufriblib.errors import Error
 from sufriblib import util
 
 from . import lost_capacity
 from . import models
+from . import parse_cache
+from .progress import Progress
 
 
-def protected_file_processing(rib_upload, rmb_upload):
+def protected_file_processing(rib_upload, rmb_upload, progress=None):
     """Called from tasks.py, and wrapped there in a
     transaction.commit_on_success; in case of an exception in here,
-    nothing is committed."""
+    nothing is committed. Stages are reported to progress, if given."""
+    if progress is None:
+        progress = Progress()
 
     # Initial parse of RIB and RMB file
-    ribinstance, riberrors = parsers.parse(rib_upload.full_path)
-    rmbinstance, rmberrors = parsers.parse(rmb_upload.full_path)
+    progress.stage('parsing')
+    ribinstance, riberrors = parse_cache.parse(
+        rib_upload.full_path, rib_upload.content_hash)
+    rmbinstance, rmberrors = parse_cache.parse(
+        rmb_upload.full_path, rmb_upload.content_hash)
 
     putdict = None
     sewerdict = None
+    progress.stage('validation')
     if ribinstance:
         # Get PUT data from the RIB and put it in a dictionary
         putdict = get_puts(ribinstance, riberrors)
@@ -37,6 +43,7 @@ def protected_file_processing(rib_upload, rmb_upload):
         if rmbinstance:
             # Add MRIO information from the RMB to the sewerdict
             lines = mrio_lines_by_sewer_id(rmbinstance)
+            progress.set_total(len(sewerdict))
             for sewer in sewerdict:
                 sewerdict[sewer]['measurements'] = (
                     get_mrio(
@@ -44,6 +51,7 @@ def protected_file_processing(rib_upload, rmb_upload):
                         putdict,
                         sewerdict[sewer],
                         rmberrors))
+                progress.advance()
 
     if putdict and sewerdict and not riberrors and not rmberrors:
         # From here on, no more errors are added, we assume all the
@@ -53,7 +61,9 @@ def protected_file_processing(rib_upload, rmb_upload):
         # Save everything into the database
         save_into_database(
             rib_upload.full_path, rmb_upload.full_path,
-            putdict, sewerdict, rmberrors)
+            putdict, sewerdict, rmberrors, progress,
+            rib_hash=rib_upload.content_hash,
+            rmb_hash=rmb_upload.content_hash)
         rib_upload.set_successful()
         rmb_upload.set_successful()
     else:
@@ -89,7 +99,7 @@ def get_puts(ribfile, riberrors):
     """
 
     putdict = dict()
-    found_first_sink = False
+    found_sink = False
 
     for putline in ribfile.lines_of_type("*PUT"):
         putid = putline.putid  # Existence is already checked in sufriblib
@@ -104,16 +114,7 @@ def get_puts(ribfile, riberrors):
             continue
 
         is_sink = putline.is_sink
-
-        if is_sink:
-            if found_first_sink:
-                riberrors.append(Error(
-                        line_number=putline.line_number,
-                        message=(
-                            "Er is meer dan een put als gemaal gemarkeerd!")))
-                continue
-            else:
-                found_first_sink = True
+        found_sink = found_sink or is_sink
 
         # putline.CCU is not a required field, but if it's there, it
         # must be a float. Otherwise we'll try to compute the surface
@@ -140,7 +141,7 @@ def get_puts(ribfile, riberrors):
             'surface_level': surface_level
             }
 
-    if not found_first_sink:
+    if not found_sink:
         riberrors.append(Error(
                 line_number=0,
                 message="Markeer minstens 1 put als gemaal!"))
@@ -413,6 +414,59 @@ def get_mrio(lines, putdict, sewerinfo, rmberrors):
     return mrios
 
 
+def build_sewer_measurements(sewer, measurements):
+    """Return the unsaved SewerMeasurements of a sewer, given the MRIO
+    measurements returned by get_mrio. These are corrected and get a
+    virtual measurement at each end; without MRIO measurements, virtual
+    ones are made every 30cm. Also judges the quality of the sewer, but
+    doesn't save it."""
+    if not measurements:
+        # Create "virtual measurements"
+        sewer.quality = models.Sewer.QUALITY_UNKNOWN
+        return list(virtual_measurements(sewer))
+
+    sewer_measurements = [
+        # Create the SewerMeasurement objects, but don't save
+        # them yet!
+        models.SewerMeasurement(
+            sewer=sewer,
+            dist=m['dist'],
+            virtual=False,
+            water_level=None,
+            flooded_pct=None,
+            bob=m['bob'],
+            obb=m['bob'] + sewer.diameter,
+            the_geom=Point(*m['coordinate']))
+        for m in measurements]
+
+    # Quality
+    sewer.judge_quality(sewer_measurements)
+
+    # BOB correction ("sawtooth" phenomenon)
+    correct_bob_values(sewer, sewer_measurements)
+
+    # Create two virtual sewer measurements for the start and
+    # end of the sewer
+    virtual_start = models.SewerMeasurement(
+        sewer=sewer, dist=0, virtual=True, water_level=None,
+        flooded_pct=None, bob=sewer.bob1,
+        obb=sewer.bob1 + sewer.diameter,
+        the_geom=sewer.manhole1.the_geom)
+    virtual_end = models.SewerMeasurement(
+        sewer=sewer, dist=sewer.the_geom_length,
+        virtual=True, water_level=None,
+        flooded_pct=None, bob=sewer.bob2,
+        obb=sewer.bob2 + sewer.diameter,
+        the_geom=sewer.manhole2.the_geom)
+
+    # Note: we MUST add those two virtual points only after
+    # doing the sawtooth correction, otherwise the sawtooth
+    # correction will think that everything is fine already
+    # since the first and end points would be equal to the
+    # bobs of the sewer...
+    return [virtual_start] + sewer_measurements + [virtual_end]
+
+
 def virtual_measurements(sewer):
     startx = sewer.manhole1.the_geom.x  # These are WGS84
     starty = sewer.manhole1.the_geom.y
@@ -506,7 +560,11 @@ def set_geoms_dists(
             mrio['dist'] = horizontal_distance - mrio['dist']
 
 
-def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors):
+def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors,
+                       progress=None, rib_hash='', rmb_hash=''):
+    if progress is None:
+        progress = Progress()
+
     # Get sewerage name, try to create sewerage
     # If it exists, return with an error
     sewerage_name = os.path.basename(rmb_path)[:-4]  # Minus ".RMB"
@@ -519,12 +577,20 @@ def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors):
                  "een andere naam.").format(name=sewerage_name)))
         return
 
+    progress.stage('geometry', total=len(putdict) + 2 * len(sewerdict))
+
     # Files are copied only at the end
-    sewerage = models.Sewerage.objects.create(
+    sewerage = models.Sewerage(
         name=sewerage_name,
         rib=None,  # Filled in later
         rmb=None,
+        rib_hash=rib_hash,
+        rmb_hash=rmb_hash,
         active=True)
+    sewerage.set_extent(
+        [putinfo['coordinate'] for putinfo in putdict.values()],
+        [putinfo['rd_coordinate'] for putinfo in putdict.values()])
+    sewerage.save()
 
     # Save the puts, keep a dictionary
     saved_puts = dict()
@@ -534,16 +600,18 @@ def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors):
             code=put_id,
             sink=int(putinfo['is_sink']),
             ground_level=putinfo['surface_level'],
-            the_geom=Point(*putinfo['coordinate']))
+            the_geom=Point(*putinfo['coordinate']),
+            the_geom_rd=Point(*putinfo['rd_coordinate'],
+                              srid=models.RDNEW))
+        progress.advance()
 
     # Save the sewers, use the dictionary
     saved_sewers = dict()
     for sewer_id, sewerinfo in sewerdict.items():
         manhole1 = saved_puts[sewerinfo['manhole_code_1']]
         manhole2 = saved_puts[sewerinfo['manhole_code_2']]
-        sewer_line_rd = LineString(manhole1.the_geom, manhole2.the_geom)
-        sewer_line_rd.set_srid(4326)
-        sewer_line_rd.transform(RD)
+        sewer_line_rd = LineString(
+            manhole1.the_geom_rd, manhole2.the_geom_rd, srid=models.RDNEW)
 
         saved_sewers[sewer_id] = models.Sewer.objects.create(
             sewerage=sewerage,
@@ -555,79 +623,64 @@ def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors):
             bob1=sewerinfo['bob_1'],
             bob2=sewerinfo['bob_2'],
             the_geom=LineString(manhole1.the_geom, manhole2.the_geom),
+            the_geom_rd=sewer_line_rd,
             the_geom_length=sewer_line_rd.length)
+        progress.advance()
 
     # Save the measurements
     sewer_measurements_dict = dict()
     for sewer_id, sewerinfo in sewerdict.items():
-        measurements = sewerinfo['measurements']
         sewer = saved_sewers[sewer_id]
-
-        if measurements:
-            sewer_measurements = [
-                # Create the SewerMeasurement objects, but don't save
-                # them yet!
-                models.SewerMeasurement(
-                    sewer=sewer,
-                    dist=m['dist'],
-                    virtual=False,
-                    water_level=None,
-                    flooded_pct=None,
-                    bob=m['bob'],
-                    obb=m['bob'] + sewerinfo['diameter'],
-                    the_geom=Point(*m['coordinate']))
-                for m in measurements]
-
-            # Quality
-            sewer.judge_quality(sewer_measurements)
-            sewer.save()
-
-            # BOB correction ("sawtooth" phenomenon)
-            correct_bob_values(sewer, sewer_measurements)
-
-            # Create two virtual sewer measurements for the start and
-            # end of the sewer
-            virtual_start = models.SewerMeasurement(
-                sewer=sewer, dist=0, virtual=True, water_level=None,
-                flooded_pct=None, bob=sewer.bob1,
-                obb=sewer.bob1 + sewerinfo['diameter'],
-                the_geom=sewer.manhole1.the_geom)
-            virtual_end = models.SewerMeasurement(
-                sewer=sewer, dist=sewer.the_geom_length,
-                virtual=True, water_level=None,
-                flooded_pct=None, bob=sewer.bob2,
-                obb=sewer.bob2 + sewerinfo['diameter'],
-                the_geom=sewer.manhole2.the_geom)
-
-            # Note: we MUST add those two virtual points only after
-            # doing the sawtooth correction, otherwise the sawtooth
-            # correction will think that everything is fine already
-            # since the first and end points would be equal to the
-            # bobs of the sewer...
-            sewer_measurements = (
-                [virtual_start] + sewer_measurements + [virtual_end])
-            sewer_measurements_dict[sewer_id] = sewer_measurements
-        else:
-            # Create "virtual measurements"
-            sewer_measurements_dict[sewer_id] = list(
-                virtual_measurements(sewer))
-            sewer.quality = models.Sewer.QUALITY_UNKNOWN
-            sewer.save()
+        sewer_measurements_dict[sewer_id] = build_sewer_measurements(
+            sewer, sewerinfo['measurements'])
+        sewer.save()
+        progress.advance()
 
     # Actually compute the lost capacity, the point of this app
+    progress.stage('lost_capacity')
     lost_capacity.compute_lost_capacity(
         saved_puts, saved_sewers, sewer_measurements_dict)
+    number_of_measurements = sum(
+        len(measurements)
+        for measurements in sewer_measurements_dict.itervalues())
+    progress.advance(number_of_measurements)
+
+    progress.stage('saving', total=number_of_measurements)
+
+    # Summarize the lost capacity per sewer, for drawing at coarser scales
+    save_lost_capacity_summaries(saved_sewers, sewer_measurements_dict)
 
     # Save all the SewerMeasurement objects to the database. Since
     # there are thousands of them, it is essential to use bulk_create.
     models.SewerMeasurement.objects.bulk_create(list(chain(
                 *sewer_measurements_dict.values())))
+    progress.advance(number_of_measurements)
 
     # Success -- copy files
     sewerage.move_files(rib_path, rmb_path)
 
     # The clap on the fireworks
+    progress.stage('rib_generation')
     sewerage.generate_rib()
+    progress.advance(len(saved_sewers))
+
+
+def save_lost_capacity_summaries(saved_sewers, sewer_measurements_dict):
+    """Save the worst lost capacity class of each sewer, with one query
+    per class, and its class-change segments."""
+    segments = []
+    sewers_by_class = defaultdict(list)
+
+    for sewer_id, measurements in sewer_measurements_dict.iteritems():
+        sewer = saved_sewers[sewer_id]
+        segments.extend(sewer.summarize_lost_capacity(measurements))
+        sewers_by_class[sewer.worst_class].append(sewer.pk)
+
+    for klasse, sewer_pks in sewers_by_class.iteritems():
+        models.Sewer.objects.filter(pk__in=sewer_pks).update(
+            worst_class=klasse)
+
+    models.LostCapacitySegment.objects.bulk_create(segments)
 
 
 class Line(object):
@@ -0,0 +1,313 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""What-if scenarios for lost capacity.
+
+Asset managers want to know how much capacity a sewerage would lose
+with other levels at the sinks (e.g. a different pump setting), or
+with some sewers cleaned or relined. A Network is built once from a
+sewerage: the graph of lost_capacity.create_graph, which is handed to
+worker processes. `evaluate` runs many Scenarios against it and
+returns the lost volume of each sewer in each scenario. Nothing is
+written to the database.
+
+The levels of the current situation are computed once, with
+lost_capacity.priority_flood. The level of a node is the highest bob
+on the lowest path to it from a sink, so with all sinks at the same
+level L it is just the larger of L and its current level: scenarios
+that only differ in such a sink level need no flooding at all.
+Scenarios that change bobs are grouped by their changes, and each
+group only floods again the part of the network the changes can
+affect, with lost_capacity.update_water_level. Scenarios with a level
+per sink are flooded completely. Groups are spread over worker
+processes.
+"""
+
+from collections import OrderedDict
+from collections import defaultdict
+from collections import namedtuple
+from itertools import chain
+import logging
+import math
+import multiprocessing
+
+from lizard_riool import lost_capacity
+from lizard_riool import models
+from lizard_riool import revisions
+
+logger = logging.getLogger(__name__)
+
+
+class Scenario(namedtuple('Scenario', 'name sink_level cleaned relined')):
+    """A what-if scenario.
+
+    - sink_level: the water level at all sinks, a dictionary {manhole
+      code: level} with the levels of some sinks, or None to keep the
+      sinks at their bobs like the real computation does. A sink is
+      never below its bob;
+    - cleaned: ids of sewers whose measured bobs are replaced by the
+      straight line between their bob1 and bob2, as if sediment and
+      sags were removed;
+    - relined: {sewer_id: thickness} of sewers that get a liner, which
+      raises their bob and lowers their obb by its thickness (m).
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, sink_level=None, cleaned=(), relined=None):
+        if isinstance(sink_level, dict):
+            sink_level = dict(sink_level)
+        return super(Scenario, cls).__new__(
+            cls, name, sink_level, frozenset(cleaned), dict(relined or {}))
+
+    @property
+    def changes(self):
+        "Scenarios with the same changes have the same bobs."
+        return self.cleaned, tuple(sorted(self.relined.iteritems()))
+
+    @property
+    def sink_levels(self):
+        """The levels of the sinks as lost_capacity.priority_flood
+        takes them, or None if all sinks are at the same level."""
+        if not isinstance(self.sink_level, dict):
+            return None
+        return dict((("put", code), level)
+                    for code, level in self.sink_level.iteritems())
+
+
+# The nodes of a sewer in the graph of a Network. Measurements are
+# tuples (node, dist, obb - bob), sorted by dist.
+SewerNodes = namedtuple(
+    'SewerNodes',
+    'rectangular length end1 end2 put1 put2 measurements')
+
+
+class Network(object):
+    """The graph of lost_capacity.create_graph and its sinks. `bobs`
+    and water levels are dictionaries keyed by node, `sewers` maps
+    sewer ids to their SewerNodes."""
+
+    def __init__(self, G, sinks, sewers):
+        self.G = G
+        self.bobs = dict((node, G.node[node]['bob']) for node in G)
+        self.sinks = list(sinks)
+        self.sewers = sewers
+
+        self.put_ends = defaultdict(list)
+        for sewer in sewers.itervalues():
+            self.put_ends[sewer.put1].append(sewer.end1)
+            self.put_ends[sewer.put2].append(sewer.end2)
+
+    @classmethod
+    def from_sewerage(cls, sewerage):
+        return cls.from_network(*revisions.load_network(sewerage))
+
+    @classmethod
+    def from_network(cls, saved_puts, saved_sewers, measurements_dict):
+        """Build a Network from model instances, as
+        lost_capacity.create_graph takes them. Raises ValueError if
+        there is no sink."""
+        G, sink_nodes = lost_capacity.create_graph(
+            saved_puts, saved_sewers, measurements_dict)
+        if G is None:
+            raise ValueError("Het stelsel heeft geen gemaal.")
+
+        sewers = {}
+        for sewer_id, measurements in measurements_dict.iteritems():
+            sewer = saved_sewers[sewer_id]
+            # Measurements at the same dist are one node in the graph
+            points = dict(
+                (measurement.dist,
+                 (("measurement", sewer_id, measurement.dist),
+                  measurement.dist, measurement.obb - measurement.bob))
+                for measurement in measurements)
+            sewers[sewer_id] = SewerNodes(
+                rectangular=sewer.is_rectangular,
+                length=sewer.the_geom_length,
+                end1=("sewer_end", sewer_id, "1"),
+                end2=("sewer_end", sewer_id, "2"),
+                put1=("put", sewer.manhole1.code),
+                put2=("put", sewer.manhole2.code),
+                measurements=tuple(
+                    points[dist] for dist in sorted(points)))
+
+        return cls(G, sink_nodes, sewers)
+
+    def graph(self, bobs=None, levels=None):
+        "Return a copy of the graph with other bobs and water levels."
+        G = self.G.copy()
+        for node, bob in (bobs or {}).iteritems():
+            G.node[node]['bob'] = bob
+        for node, level in (levels or {}).iteritems():
+            G.node[node]['waterlevel'] = level
+        return G
+
+    def flood(self, bobs=None, sink_levels=None):
+        """Return the water level of each node, None if it can't be
+        reached from a sink (see lost_capacity.priority_flood)."""
+        G = self.graph(bobs)
+        lost_capacity.priority_flood(G, self.sinks, sink_levels)
+        return water_levels(G)
+
+    def reflood(self, bobs, levels, changed):
+        """Return the water levels after the bobs of the nodes in
+        `changed` became those in `bobs`, given the `levels` before.
+        Only the nodes that can be affected are flooded again (see
+        lost_capacity.update_water_level)."""
+        G = self.graph(dict((node, bobs[node]) for node in changed), levels)
+        level = min(min(self.bobs[node], bobs[node]) for node in changed)
+        lost_capacity.update_water_level(G, self.sinks, changed, (), level)
+        return water_levels(G)
+
+    def changed_bobs(self, scenario):
+        """Return a copy of the bobs with the changes of a scenario, and
+        the nodes whose bob changed."""
+        bobs = dict(self.bobs)
+        puts = set()
+
+        for sewer_id in scenario.cleaned | set(scenario.relined):
+            sewer = self.sewers[sewer_id]
+            thickness = scenario.relined.get(sewer_id, 0)
+            bob1 = self.bobs[sewer.end1]
+            bob2 = self.bobs[sewer.end2]
+            for node, dist, _ in sewer.measurements:
+                if sewer_id in scenario.cleaned and sewer.length:
+                    bobs[node] = bob1 + (bob2 - bob1) * dist / sewer.length
+                bobs[node] += thickness
+            bobs[sewer.end1] = bob1 + thickness
+            bobs[sewer.end2] = bob2 + thickness
+            puts.update((sewer.put1, sewer.put2))
+
+        # A manhole is as low as the lowest sewer in it
+        for put in puts:
+            bobs[put] = min(bobs[end] for end in self.put_ends[put])
+
+        changed = [node for node, bob in bobs.iteritems()
+                   if bob != self.bobs[node]]
+        return bobs, changed
+
+    def lost_volumes(self, bobs, levels, scenario):
+        """Return {sewer_id: lost volume (m3)} in a scenario, given its
+        bobs and its levels, without a sink level that is the same for
+        all sinks. Sewers that can't be reached from a sink get None."""
+        uniform_level = None
+        if scenario.sink_levels is None:
+            uniform_level = scenario.sink_level
+        volumes = {}
+
+        for sewer_id, sewer in self.sewers.iteritems():
+            lining = 2 * scenario.relined.get(sewer_id, 0)
+            volume = 0.0
+            previous = None
+            for node, dist, height in sewer.measurements:
+                water_level = levels[node]
+                if water_level is None:
+                    volume = None
+                    break
+                if uniform_level is not None:
+                    water_level = max(water_level, uniform_level)
+
+                height -= lining
+                area = cross_section(height, sewer.rectangular) * (
+                    models.flooded_fraction(
+                        water_level, bobs[node], bobs[node] + height,
+                        sewer.rectangular))
+                if previous is not None:
+                    volume += (dist - previous[0]) * (area + previous[1]) / 2
+                previous = (dist, area)
+            volumes[sewer_id] = volume
+
+        return volumes
+
+
+def water_levels(G):
+    "Return the water levels in G as a dictionary {node: level}."
+    return dict((node, G.node[node]['waterlevel']) for node in G)
+
+
+def cross_section(height, rectangular):
+    """Return the area (m2) of the cross section of a sewer. Only the
+    height of rectangular sewers is known; they are taken to be
+    square."""
+    if rectangular:
+        return height ** 2
+    return math.pi * ((height / 2) ** 2)
+
+
+def evaluate_group(network, levels, scenarios):
+    """Return a list of (name, lost volumes) of scenarios that have the
+    same changes, given the levels of the current situation."""
+    bobs, changed = network.changed_bobs(scenarios[0])
+    if changed:
+        levels = network.reflood(bobs, levels, changed)
+
+    results = []
+    for scenario in scenarios:
+        scenario_levels = levels
+        if scenario.sink_levels is not None:
+            scenario_levels = network.flood(bobs, scenario.sink_levels)
+        results.append((scenario.name, network.lost_volumes(
+                    bobs, scenario_levels, scenario)))
+    return results
+
+
+# The network and its levels in a worker process, see init_worker.
+_worker = {}
+
+
+def init_worker(network, levels):
+    _worker['network'] = network
+    _worker['levels'] = levels
+
+
+def evaluate_in_worker(scenarios):
+    return evaluate_group(_worker['network'], _worker['levels'], scenarios)
+
+
+def evaluate(network, scenarios, processes=None):
+    """Return an OrderedDict {scenario name: {sewer_id: lost volume}},
+    in the order of the scenarios. Groups of scenarios with the same
+    changes are evaluated in `processes` worker processes (default: one
+    per CPU); with processes=1 everything runs in this process. Raises
+    ValueError for scenarios with the same name, unknown sewers or
+    unknown sinks."""
+    names = [scenario.name for scenario in scenarios]
+    if len(set(names)) != len(names):
+        raise ValueError("Scenario names must be unique.")
+    unknown = set(chain(*[
+                scenario.cleaned | set(scenario.relined)
+                for scenario in scenarios])) - set(network.sewers)
+    if unknown:
+        raise ValueError("Onbekende strengen: {0}".format(
+                ", ".join(sorted(unknown))))
+    unknown = set(chain(*[
+                scenario.sink_levels for scenario in scenarios
+                if scenario.sink_levels is not None])) - set(network.sinks)
+    if unknown:
+        raise ValueError("Onbekende gemalen: {0}".format(
+                ", ".join(sorted(code for _, code in unknown))))
+
+    levels = network.flood()
+
+    groups = OrderedDict()
+    for scenario in scenarios:
+        groups.setdefault(scenario.changes, []).append(scenario)
+    groups = groups.values()
+
+    processes = min(processes or multiprocessing.cpu_count(), len(groups))
+    if processes <= 1:
+        results = [evaluate_group(network, levels, group)
+                   for group in groups]
+    else:
+        pool = multiprocessing.Pool(
+            processes, initializer=init_worker,
+            initargs=(network, levels))
+        try:
+            results = pool.map(evaluate_in_worker, groups)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    volumes = dict(chain(*results))
+    logger.info("Evaluated %d scenarios in %d groups",
+                len(scenarios), len(groups))
+    return OrderedDict((name, volumes[name]) for name in names)
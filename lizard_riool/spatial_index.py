@@ -0,0 +1,304 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""In-process spatial indexes for nearest neighbour lookups.
+
+Hovering over and clicking on the map both ask "what is the nearest
+object to this point?". A sewerage doesn't change after it has been
+uploaded, so instead of asking PostGIS to filter and sort candidates
+on every request, we load its points once into a uniform grid and
+answer the question from memory.
+
+A sewerage does change when a revised RMB file is processed (see
+revisions.py), in a worker process. forget_sewerage therefore also
+stores a new version of the sewerage in the Django cache, and indexes
+of an older version are rebuilt in every process.
+"""
+
+from collections import OrderedDict
+from collections import defaultdict
+import logging
+import math
+import threading
+import time
+
+from django.contrib.gis.geos import MultiPoint
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+
+from lizard_map.coordinates import RD
+
+from lizard_riool.models import Manhole
+from lizard_riool.models import RDNEW
+from lizard_riool.models import Sewerage
+from lizard_riool.models import SewerMeasurement
+
+logger = logging.getLogger(__name__)
+
+GOOGLE = 3857  # aka 900913
+
+# Radius of the sphere of the Google projection (m).
+GOOGLE_RADIUS = 6378137.0
+
+# Measurements are roughly 0.3 - 1 m apart, so a cell of this size
+# (in Google projection units) holds a few dozen of them per sewer.
+DEFAULT_CELL_SIZE = 25.0
+
+# Maximum number of indexes kept in memory per process.
+MAX_CACHED_INDEXES = 20
+
+# How long versions of sewerages are kept in the Django cache. If one
+# expires, indexes of that sewerage are just built once more.
+VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+
+def version_key(sewerage_id):
+    return 'lizard_riool_sewerage_version_{0}'.format(sewerage_id)
+
+
+def sewerage_version(sewerage_id):
+    return cache.get(version_key(sewerage_id), 0)
+
+
+class PointIndex(object):
+    """A uniform grid over points.
+
+    Points are (x, y, item) tuples; `nearest` returns the item of the
+    point closest to a given location. The search starts in the cell
+    that contains the location and visits rings of cells around it,
+    stopping as soon as no unvisited cell can contain a closer point,
+    so the cost doesn't depend on the search radius.
+    """
+
+    def __init__(self, points, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = float(cell_size)
+
+        cells = defaultdict(list)
+        for x, y, item in points:
+            cells[self._cell(x, y)].append((x, y, item))
+        self.cells = dict(cells)
+
+        if self.cells:
+            self.min_i = min(i for i, _ in self.cells)
+            self.max_i = max(i for i, _ in self.cells)
+            self.min_j = min(j for _, j in self.cells)
+            self.max_j = max(j for _, j in self.cells)
+
+    def __len__(self):
+        return sum(len(points) for points in self.cells.itervalues())
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def _ring(self, ci, cj, r):
+        "Yield the cells at Chebyshev distance r from cell (ci, cj)."
+        if r == 0:
+            yield ci, cj
+            return
+        for i in xrange(ci - r, ci + r + 1):
+            yield i, cj - r
+            yield i, cj + r
+        for j in xrange(cj - r + 1, cj + r):
+            yield ci - r, j
+            yield ci + r, j
+
+    def nearest(self, x, y, radius=None):
+        """Return (distance, item) of the point nearest to (x, y), or
+        None if there is no point within radius."""
+        if not self.cells:
+            return None
+
+        ci, cj = self._cell(x, y)
+
+        # Rings closer than this don't contain any cells.
+        r = max(0, self.min_i - ci, ci - self.max_i,
+                self.min_j - cj, cj - self.max_j)
+        # Once a ring reaches this far, all cells have been seen.
+        r_max = max(ci - self.min_i, self.max_i - ci,
+                    cj - self.min_j, self.max_j - cj)
+
+        best_distance, best_item = None, None
+
+        while r <= r_max:
+            # Points in ring r are at least (r - 1) cells away.
+            min_possible = (r - 1) * self.cell_size
+            if best_distance is not None and best_distance <= min_possible:
+                break
+            if radius is not None and radius < min_possible:
+                break
+
+            for cell in self._ring(ci, cj, r):
+                for px, py, item in self.cells.get(cell, ()):
+                    d = math.hypot(px - x, py - y)
+                    if best_distance is None or d < best_distance:
+                        best_distance, best_item = d, item
+            r += 1
+
+        if best_distance is None:
+            return None
+        if radius is not None and best_distance > radius:
+            return None
+        return best_distance, best_item
+
+
+class IndexCache(object):
+    """A small, thread safe LRU cache of indexes, built on first use.
+    The first element of a key is a sewerage id; indexes of an older
+    version of the sewerage are built again."""
+
+    def __init__(self, build, max_size=MAX_CACHED_INDEXES):
+        self.build = build
+        self.max_size = max_size
+        self.indexes = OrderedDict()  # key: (version, index)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        version = sewerage_version(key[0])
+        with self.lock:
+            entry = self.indexes.pop(key, None)
+            if entry is not None and entry[0] == version:
+                self.indexes[key] = entry  # Most recently used
+                return entry[1]
+
+        # Build outside the lock, it hits the database.
+        index = self.build(*key)
+
+        with self.lock:
+            self.indexes[key] = (version, index)
+            while len(self.indexes) > self.max_size:
+                self.indexes.popitem(last=False)
+        return index
+
+    def forget(self, sewerage_id):
+        "Drop all indexes of a sewerage."
+        with self.lock:
+            for key in list(self.indexes):
+                if key[0] == sewerage_id:
+                    del self.indexes[key]
+
+
+def build_measurement_index(sewerage_id):
+    """Index all measurements of a sewerage in Google projection. Items
+    are (pk, flooded_pct, sewer code) tuples."""
+    measurements = (
+        SewerMeasurement.objects.
+        filter(sewer__sewerage__pk=sewerage_id).
+        transform(GOOGLE).
+        values_list('pk', 'flooded_pct', 'sewer__code', 'the_geom')
+    )
+
+    index = PointIndex(
+        (the_geom.x, the_geom.y, (pk, flooded_pct, code))
+        for pk, flooded_pct, code, the_geom in measurements.iterator())
+
+    logger.debug("Indexed %d measurements of sewerage %d",
+                 len(index), sewerage_id)
+    return index
+
+
+MEASUREMENT_INDEXES = IndexCache(build_measurement_index)
+
+
+def transform_points(points, srid):
+    """Transform a list of WGS84 Points to srid in one go, return a list
+    of (x, y) tuples. Like views.transform(), use our own definition of
+    RD because the one in the database lacks the towgs84 parameter."""
+    if not points:
+        return []
+    multipoint = MultiPoint(points, srid=4326)
+    multipoint.transform(RD if srid == RDNEW else srid)
+    return [point.coords for point in multipoint]
+
+
+def build_manhole_index(sewerage_id, srid):
+    """Index all manholes of a sewerage in the given projection. Items
+    are (sewerage id, manhole code, x, y) tuples."""
+    manholes = Manhole.objects.filter(sewerage__pk=sewerage_id)
+
+    if srid == RDNEW:
+        # Stored at ingest, no need to transform.
+        manholes = list(manholes.values_list('code', 'the_geom_rd'))
+        coords = [the_geom_rd.coords for _, the_geom_rd in manholes]
+    else:
+        manholes = list(manholes.values_list('code', 'the_geom'))
+        coords = transform_points(
+            [Point(the_geom.x, the_geom.y) for _, the_geom in manholes],
+            srid)
+
+    index = PointIndex(
+        (x, y, (sewerage_id, code, x, y))
+        for (code, _), (x, y) in zip(manholes, coords))
+
+    logger.debug("Indexed %d manholes of sewerage %d in EPSG:%d",
+                 len(index), sewerage_id, srid)
+    return index
+
+
+MANHOLE_INDEXES = IndexCache(build_manhole_index)
+
+
+def google_to_metres(distance, y):
+    """Convert a short distance in Google projection units near a point
+    with Google y coordinate y to metres. The projection stretches
+    distances by 1 / cos(latitude), about 1.6 in the Netherlands."""
+    latitude = math.atan(math.sinh(y / GOOGLE_RADIUS))
+    return distance * math.cos(latitude)
+
+
+# Extents stored per projection, so that the database needn't
+# transform. It would use its own definition of RD, see transform_points.
+EXTENT_FIELDS = {
+    RDNEW: 'extent_rd',
+    GOOGLE: 'extent_google',
+    4326: 'extent',
+    }
+
+
+def sewerages_near(sewerages, x, y, srid, radius=None):
+    """Return the ids of the sewerages in a queryset whose stored extent
+    is within radius of point (x, y) in projection srid, in one query.
+    Searching several sewerages should only look in their indexes,
+    there may be more sewerages than fit in the cache."""
+    area = Point(x, y, srid=srid)
+    if radius:
+        area = area.buffer(radius)
+    if srid not in EXTENT_FIELDS:
+        area.transform(4326)
+        srid = 4326
+    lookup = '{0}__intersects'.format(EXTENT_FIELDS[srid])
+    return list(sewerages.filter(**{lookup: area}).values_list(
+            'pk', flat=True))
+
+
+def nearest_measurement(sewerage_id, x, y, radius=None):
+    """Return (distance, (pk, flooded_pct, sewer code)) of the measurement
+    nearest to Google projection point (x, y), or None. The radius is in
+    Google projection units, the returned distance in metres."""
+    found = MEASUREMENT_INDEXES.get((sewerage_id,)).nearest(x, y, radius)
+    if found is None:
+        return None
+    distance, item = found
+    return google_to_metres(distance, y), item
+
+
+def nearest_manhole(sewerage_ids, x, y, srid, radius=None):
+    """Return (distance, (sewerage id, code, x, y)) of the manhole nearest
+    to point (x, y) in projection srid over several sewerages, or None.
+    The returned coordinates are in the same projection."""
+    nearest = None
+    for sewerage_id in sewerages_near(
+        Sewerage.objects.filter(pk__in=list(sewerage_ids)),
+        x, y, srid, radius):
+        found = MANHOLE_INDEXES.get((sewerage_id, srid)).nearest(
+            x, y, radius)
+        if found is not None and (nearest is None or found < nearest):
+            nearest = found
+    return nearest
+
+
+def forget_sewerage(sewerage_id):
+    """Drop cached indexes of a sewerage, e.g. because it was deleted or
+    revised, in this process and (see sewerage_version) all others."""
+    cache.set(version_key(sewerage_id), time.time(), VERSION_TIMEOUT)
+    MEASUREMENT_INDEXES.forget(sewerage_id)
+    MANHOLE_INDEXES.forget(sewerage_id)
@@ -0,0 +1,260 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Synthetic sewerages, for testing how processing scales.
+
+The sample files in data/ have at most some 14000 lines, real networks
+can be much bigger. `generate` writes a RIB/RMB pair of a network of
+any size, laid out on a grid in RD coordinates:
+
+- a tree draining to one or more sinks (manholes marked as "gemaal"),
+  optionally with loops: extra sewers between neighbouring manholes;
+- BOBs that fall towards the sinks, with sags in the sewers so that
+  there is lost capacity to compute;
+- *MRIO measurements every `spacing` meters, as C+B (deviation from the
+  ideal line), A+E (slope in degrees) or A+F (slope in percent),
+  measured from either end of the sewer.
+
+Records use the same fixed field widths as the sample files. The number
+of measurements is roughly pipes * PIPE_LENGTH / spacing, e.g. 25000
+pipes with a spacing of 1 m give about a million.
+"""
+
+from collections import deque
+import math
+import os
+import random
+
+PIPE_LENGTH = 40.0  # Distance between neighbouring manholes, m
+ORIGIN = (140000.0, 484000.0)  # RD, somewhere in Almere
+
+SINK_BOB = -8.0  # m NAP
+SLOPE = 0.002  # BOBs rise this much per m away from the sink
+COVER = 2.5  # Surface level above the BOB, m
+DIAMETER = 315  # mm
+
+MAX_SAG = 0.08  # Largest sag in a sewer, m
+
+VARIANTS = ('CB', 'AE', 'AF')
+
+# Field widths of the records, without the record type.
+ALGE_WIDTHS = (15, 30, 30, 15, 1, 60, 15, 15, 1, 60, 64)
+PUT_WIDTHS = (
+    30, 19, 30, 2, 30, 30, 30, 2, 30, 1, 1, 10, 5, 1, 1, 1, 15, 15, 1,
+    4, 4, 2, 4, 1, 30, 1, 9, 1, 2, 4, 4, 1, 1, 1, 4, 1, 1, 120, 6)
+RIOO_WIDTHS = (
+    30, 30, 19, 30, 19, 30, 19, 6, 2, 30, 1, 2, 30, 30, 1, 30, 1, 10, 5,
+    1, 1, 1, 15, 15, 7, 2, 4, 4, 2, 1, 2, 5, 6, 6, 1, 1, 30, 1, 9, 1, 2,
+    2, 1, 4, 1, 120, 6, 6)
+MRIO_WIDTHS = (8, 1, 30, 2, 2, 6, 6, 5, 10, 11, 1, 1, 10, 3, 30, 30, 30,
+               30, 30)
+
+# Indexes of the fields we fill in.
+PUT_ID, PUT_COORDINATES, PUT_SINK, PUT_CCU = 0, 1, 7, 38
+(RIOO_ID, RIOO_MANHOLE1, RIOO_COORDINATES1, RIOO_MANHOLE2,
+ RIOO_COORDINATES2) = 0, 3, 4, 5, 6
+RIOO_LENGTH, RIOO_ACA, RIOO_ACB, RIOO_ACC = 24, 25, 26, 27
+RIOO_ACR, RIOO_ACS = 46, 47
+(MRIO_DISTANCE, MRIO_ZYB, MRIO_SEWER, MRIO_DATE, MRIO_ZYR, MRIO_ZYS,
+ MRIO_VALUE, MRIO_EXPONENT) = 0, 1, 2, 8, 10, 11, 12, 13
+
+SINK = 'Xs'
+DATE = '2013-01-01'
+
+
+def record(record_type, widths, values, right=()):
+    """Return a record with the given values ({index: string}), padded
+    to the field widths. Fields in `right` are right justified."""
+    fields = [record_type]
+    for index, width in enumerate(widths):
+        value = values.get(index, '')
+        if index in right:
+            fields.append(value.rjust(width))
+        else:
+            fields.append(value.ljust(width))
+    return '|'.join(fields)
+
+
+def coordinates(point):
+    return "{0:.2f}/{1:.2f}".format(*point)
+
+
+def alge_record(name):
+    return record('*ALGE', ALGE_WIDTHS, {
+            0: 'SUFRIB2.1', 1: 'Synthetisch', 2: 'Synthetisch',
+            4: 'B', 7: name[:15], 8: 'C'})
+
+
+def build_network(pipes, topology='tree', loops=0.1, sinks=1, rng=random):
+    """Return (positions, bobs, sink codes, sewers). Positions are RD
+    coordinates and bobs levels per manhole code; sewers is a list of
+    (code, manhole code 1, manhole code 2), in random direction.
+
+    A tree has exactly `pipes` sewers. A looped network has a fraction
+    `loops` of them between neighbouring manholes that are not
+    connected in the tree yet."""
+    if topology == 'looped':
+        tree_pipes = int(round(pipes / (1.0 + loops)))
+    else:
+        tree_pipes = pipes
+    number_of_manholes = tree_pipes + sinks
+
+    side = int(math.ceil(math.sqrt(number_of_manholes)))
+    cells = [(i, j) for i in xrange(side) for j in xrange(side)]
+
+    def neighbours(cell):
+        i, j = cell
+        for neighbour in ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1)):
+            if 0 <= neighbour[0] < side and 0 <= neighbour[1] < side:
+                yield neighbour
+
+    # Grow trees from the sinks at the same time, in random order, until
+    # there are enough manholes. Each manhole is connected to the one it
+    # was reached from, which is closer to its sink.
+    sink_cells = rng.sample(cells, sinks)
+    hops = dict((cell, 0) for cell in sink_cells)
+    parent = {}
+    frontier = deque(sink_cells)
+    while frontier and len(hops) < number_of_manholes:
+        cell = frontier.popleft()
+        candidates = [n for n in neighbours(cell) if n not in hops]
+        rng.shuffle(candidates)
+        for neighbour in candidates:
+            if len(hops) == number_of_manholes:
+                break
+            hops[neighbour] = hops[cell] + 1
+            parent[neighbour] = cell
+            frontier.append(neighbour)
+
+    codes = dict(
+        (cell, 'P{0:07d}'.format(n)) for n, cell in enumerate(sorted(hops)))
+    positions = dict(
+        (codes[cell], (ORIGIN[0] + cell[0] * PIPE_LENGTH,
+                       ORIGIN[1] + cell[1] * PIPE_LENGTH))
+        for cell in hops)
+    bobs = dict(
+        (codes[cell], SINK_BOB + SLOPE * PIPE_LENGTH * hops[cell] +
+         rng.uniform(0, 0.02))
+        for cell in hops)
+
+    connections = [(cell, parent[cell]) for cell in sorted(parent)]
+    if topology == 'looped':
+        connected = set(tuple(sorted(c)) for c in connections)
+        extra = sorted(set(
+                tuple(sorted((cell, neighbour)))
+                for cell in hops for neighbour in neighbours(cell)
+                if neighbour in hops) - connected)
+        rng.shuffle(extra)
+        connections.extend(extra[:pipes - len(connections)])
+
+    sewers = []
+    for n, (cell1, cell2) in enumerate(connections):
+        if rng.random() < 0.5:
+            cell1, cell2 = cell2, cell1
+        sewers.append(('R{0:07d}'.format(n), codes[cell1], codes[cell2]))
+
+    return positions, bobs, [codes[cell] for cell in sink_cells], sewers
+
+
+def profile(bob_from, bob_to, length, spacing, rng=random):
+    """Return [(distance, bob, ideal bob)] every `spacing` m along a
+    sewer, starting at the reference end. The sewer sags somewhere in
+    the middle."""
+    count = max(2, int(length / spacing) + 1)
+    sag_at = rng.uniform(0.2, 0.8) * length
+    sag_width = rng.uniform(0.1, 0.3) * length
+    sag_depth = rng.uniform(0, MAX_SAG)
+
+    points = []
+    for n in xrange(count):
+        distance = min(length, n * spacing)
+        ideal = bob_from + (bob_to - bob_from) * distance / length
+        sag = sag_depth * math.exp(-((distance - sag_at) / sag_width) ** 2)
+        points.append((distance, ideal - sag, ideal))
+    return points
+
+
+def mrio_records(sewer_code, reference, points, variant):
+    """Return the *MRIO records of a sewer for one of the VARIANTS."""
+    records = []
+    for n, (distance, bob, ideal) in enumerate(points):
+        if n == 0:
+            continue  # The reference manhole itself isn't measured
+        if variant == 'CB':
+            # Deviation from the ideal line, in mm
+            value, exponent = "{0:.2f}".format((bob - ideal) * 1000), '-3'
+        else:
+            previous_distance, previous_bob, _ = points[n - 1]
+            slope = (bob - previous_bob) / (distance - previous_distance)
+            if variant == 'AE':
+                value = "{0:.3f}".format(math.degrees(math.atan(slope)))
+            else:
+                value = "{0:.3f}".format(slope * 100)
+            exponent = ''
+
+        records.append(record('*MRIO', MRIO_WIDTHS, {
+                    MRIO_DISTANCE: "{0:.2f}".format(distance),
+                    MRIO_ZYB: reference,
+                    MRIO_SEWER: sewer_code,
+                    MRIO_DATE: DATE,
+                    MRIO_ZYR: variant[0],
+                    MRIO_ZYS: variant[1],
+                    MRIO_VALUE: value,
+                    MRIO_EXPONENT: exponent,
+                    }, right=(MRIO_VALUE,)))
+    return records
+
+
+def generate(directory, name, pipes, spacing=1.0, topology='tree',
+             loops=0.1, sinks=1, variants=VARIANTS, seed=None):
+    """Write <name>.RIB and <name>.RMB in directory. Returns their paths
+    and the number of measurements written."""
+    rng = random.Random(seed)
+    positions, bobs, sink_codes, sewers = build_network(
+        pipes, topology=topology, loops=loops, sinks=sinks, rng=rng)
+
+    rib_path = os.path.join(directory, name + '.RIB')
+    rmb_path = os.path.join(directory, name + '.RMB')
+    measurements = 0
+
+    with open(rib_path, 'w') as rib, open(rmb_path, 'w') as rmb:
+        rib.write(alge_record(name) + '\r\n')
+        rmb.write(alge_record(name) + '\r\n')
+
+        for code in sorted(positions):
+            rib.write(record('*PUT', PUT_WIDTHS, {
+                        PUT_ID: code,
+                        PUT_COORDINATES: coordinates(positions[code]),
+                        PUT_SINK: SINK if code in sink_codes else '',
+                        PUT_CCU: "{0:.2f}".format(bobs[code] + COVER),
+                        }, right=(PUT_CCU,)) + '\r\n')
+
+        for code, manhole1, manhole2 in sewers:
+            rioo = record('*RIOO', RIOO_WIDTHS, {
+                    RIOO_ID: code,
+                    RIOO_MANHOLE1: manhole1,
+                    RIOO_COORDINATES1: coordinates(positions[manhole1]),
+                    RIOO_MANHOLE2: manhole2,
+                    RIOO_COORDINATES2: coordinates(positions[manhole2]),
+                    RIOO_LENGTH: "{0:.2f}".format(PIPE_LENGTH),
+                    RIOO_ACA: 'A',
+                    RIOO_ACB: str(DIAMETER),
+                    RIOO_ACC: str(DIAMETER),
+                    RIOO_ACR: "{0:.2f}".format(bobs[manhole1]),
+                    RIOO_ACS: "{0:.2f}".format(bobs[manhole2]),
+                    }, right=(RIOO_LENGTH, RIOO_ACA, RIOO_ACR, RIOO_ACS))
+            rib.write(rioo + '\r\n')
+            rmb.write(rioo + '\r\n')
+
+            # Measure from a random end
+            reference = rng.choice('12')
+            if reference == '1':
+                bob_from, bob_to = bobs[manhole1], bobs[manhole2]
+            else:
+                bob_from, bob_to = bobs[manhole2], bobs[manhole1]
+            points = profile(bob_from, bob_to, PIPE_LENGTH, spacing, rng)
+            for line in mrio_records(
+                code, reference, points, rng.choice(variants)):
+                rmb.write(line + '\r\n')
+                measurements += 1
+
+    return rib_path, rmb_path, measurements
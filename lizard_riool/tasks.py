@@ -5,10 +5,16 @@ import traceback
 
 from celery.task import task
 
+from django.conf import settings
 from django.db import transaction
 
+from lizard_riool import batches
 from lizard_riool import models
+from lizard_riool import profiling
+from lizard_riool import progress
+from lizard_riool import revisions
 from lizard_riool import save_uploaded_data
+from lizard_riool import tiles
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +32,9 @@ DURATION = 60 * 60  # If something happens, we want computing to be
 
 MAX_RETRIES = 5
 
+# Render the map tiles of a new sewerage in advance?
+SEED_TILES = getattr(settings, 'LIZARD_RIOOL_SEED_TILES', False)
+
 
 @task
 def process_uploaded_file_when_ready(upload_id, retries=MAX_RETRIES):
@@ -65,14 +74,77 @@ def process_uploaded_file(upload):
     rib = upload.find_relevant_rib()
 
     if not rib:
+        # An RMB for an existing sewerage is a revision of it
+        sewerage = revisions.revised_sewerage(upload)
+        if sewerage is not None:
+            process_revision(sewerage, upload)
+            return
+
         upload.record_error("Bijbehorende RIB file niet gevonden.")
         upload.set_unsuccessful()
         return
 
     rib.set_being_processed()
 
+    if check_upload_pair(rib, upload):
+        process_upload_pair(rib, upload)
+
+
+@task
+def process_batch(batch_id):
+    """Extract the ZIP file of an UploadBatch and process its RIB/RMB
+    pairs in parallel, one task per pair."""
+    batch = models.UploadBatch.objects.get(pk=batch_id)
+
+    try:
+        uploads = batches.extract(batch)
+    except Exception as e:
+        # E.g. a damaged member or a full disk, possibly halfway: the
+        # uploads extracted so far will never be processed.
+        logger.exception("Could not extract %s", batch)
+        message = "Kon het ZIP bestand niet uitpakken: {0}".format(e)
+        for upload in batch.uploads.filter(
+            status=models.Upload.BEING_PROCESSED):
+            upload.record_error(message)
+            upload.set_unsuccessful()
+        batch.set_unsuccessful(message)
+        return
+
+    pairs = batches.pair(uploads)
+    batch.status = models.UploadBatch.EXTRACTED
+    batch.save()
+
+    for rib, rmb in pairs:
+        process_batch_pair.delay(rib.pk, rmb.pk)
+
+
+@task
+def process_batch_pair(rib_id, upload_id):
+    rib = models.Upload.objects.get(pk=rib_id)
+    upload = models.Upload.objects.get(pk=upload_id)
+
+    if check_upload_pair(rib, upload):
+        process_upload_pair(rib, upload)
+
+
+def check_upload_pair(rib, upload):
+    """Return True if a RIB/RMB pair can be processed: it wasn't
+    processed before, there is no sewerage with its name yet, and no
+    other file with its name is being processed. Otherwise, both
+    uploads are rejected."""
     sewerage_name = os.path.basename(upload.the_file)[:-4]  # Minus ".RMB"
 
+    identical = find_identical_sewerage(rib, upload)
+    if identical is not None:
+        message = (
+            "Deze bestanden zijn al eerder verwerkt, als stelsel "
+            "'{name}'.").format(name=identical.name)
+        upload.record_error(message)
+        rib.record_error(message)
+        upload.set_unsuccessful()
+        rib.set_unsuccessful()
+        return False
+
     if models.Sewerage.objects.filter(name=sewerage_name).exists():
         upload.record_error(
             ("Er bestaat al een stelsel met de naam '{name}'. "
@@ -80,7 +152,7 @@ def process_uploaded_file(upload):
              "een andere naam.").format(name=sewerage_name))
         upload.set_unsuccessful()
         rib.set_unsuccessful()
-        return
+        return False
 
     for other_upload in models.Upload.objects.filter(
         status=models.Upload.BEING_PROCESSED):
@@ -92,12 +164,40 @@ def process_uploaded_file(upload):
                  ).format(name=upload.filename))
             upload.set_unsuccessful()
             rib.set_unsuccessful()
-            return
+            return False
+
+    return True
+
+
+def find_identical_sewerage(rib, upload):
+    """Return a sewerage made from files with the same contents as this
+    RIB/RMB pair, or None."""
+    if not rib.content_hash or not upload.content_hash:
+        return None
+    sewerages = models.Sewerage.objects.filter(
+        rib_hash=rib.content_hash, rmb_hash=upload.content_hash)
+    return sewerages[0] if sewerages else None
+
+
+def process_upload_pair(rib, upload):
+    """Process a RIB upload and its RMB upload, both already marked as
+    being processed. Errors end up in the uploads, the resources used
+    in their stage timings. Returns the progress.Progress of the run.
+
+    Also used outside of Celery, see bulk_import.py."""
+    sewerage_name = os.path.basename(upload.the_file)[:-4]  # Minus ".RMB"
+    upload_progress = progress.Progress(rib.pk, upload.pk)
 
     try:
         with transaction.commit_on_success():
             # All the actual processing
-            save_uploaded_data.protected_file_processing(rib, upload)
+            if profiling.should_profile(rib, upload):
+                profiling.profiled_call(
+                    upload, save_uploaded_data.protected_file_processing,
+                    rib, upload, upload_progress)
+            else:
+                save_uploaded_data.protected_file_processing(
+                    rib, upload, upload_progress)
 
     except Exception as e:
         # Record whatever happened
@@ -108,3 +208,57 @@ def process_uploaded_file(upload):
         rib.record_error(error_message)
         upload.set_unsuccessful()
         rib.set_unsuccessful()
+    finally:
+        upload_progress.finish()
+        save_stage_timings(upload, upload_progress)
+
+    if SEED_TILES and upload.status == models.Upload.SUCCESSFUL:
+        for sewerage_id in models.Sewerage.objects.filter(
+            name=sewerage_name).values_list('pk', flat=True):
+            seed_tiles.delay(sewerage_id)
+
+    return upload_progress
+
+
+def process_revision(sewerage, upload):
+    """Process a revised RMB file of an existing sewerage, see
+    revisions.py."""
+    upload_progress = progress.Progress(upload.pk)
+    replaced_files = []
+
+    try:
+        with transaction.commit_on_success():
+            _, _, replaced_files = revisions.revise(
+                sewerage, upload, upload_progress)
+    except Exception as e:
+        error_message = (
+            "Exception: {e} {t}"
+            .format(e=e, t=traceback.format_exc()[-250:]))
+        upload.record_error(error_message)
+        upload.set_unsuccessful()
+    finally:
+        upload_progress.finish()
+        save_stage_timings(upload, upload_progress)
+
+    # Only now that the transaction is over, files can be removed
+    if upload.status == models.Upload.SUCCESSFUL:
+        revisions.remove_files(replaced_files)
+        revisions.invalidate_caches(sewerage.pk)
+        if SEED_TILES:
+            seed_tiles.delay(sewerage.pk)
+    else:
+        revisions.remove_files(
+            [revisions.revision_directory(sewerage, upload)])
+
+
+def save_stage_timings(upload, upload_progress):
+    "Store the resources used by each processing stage of an upload."
+    models.UploadStageTiming.objects.filter(upload=upload).delete()
+    models.UploadStageTiming.objects.bulk_create([
+            models.UploadStageTiming(upload=upload, **timing)
+            for timing in upload_progress.timings])
+
+
+@task
+def seed_tiles(sewerage_id):
+    tiles.seed(sewerage_id)
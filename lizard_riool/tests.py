@@ -1,9 +1,128 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 
+import random
+
 from django.test import TestCase
+import networkx as nx
+
+from lizard_riool import lost_capacity
 
 
 class ExampleTest(TestCase):
 
     def test_something(self):
         self.assertEqual(1, 1)
+
+
+def random_graph(rng, size):
+    """Return a random connected graph like lost_capacity.create_graph
+    makes, with nodes 0 to size - 1: a tree with some extra edges, so
+    that there are loops."""
+    G = nx.Graph()
+    for node in range(size):
+        # Rounded, so that there are nodes with the same bob
+        G.add_node(node, bob=round(rng.uniform(0, 5), 1),
+                   waterlevel=None, sink=None)
+    for node in range(1, size):
+        G.add_edge(node, rng.randrange(node))
+    for _ in range(size // 10):
+        node1, node2 = rng.randrange(size), rng.randrange(size)
+        if node1 != node2:
+            G.add_edge(node1, node2)
+    return G
+
+
+def water_levels(G):
+    return dict((node, G.node[node]['waterlevel']) for node in G)
+
+
+class WaterLevelTest(TestCase):
+    """The water level algorithms of lost_capacity must agree with each
+    other on random networks."""
+
+    TRIALS = 300
+
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def random_case(self):
+        "Return a random graph and its sinks, lowest first."
+        size = self.rng.randrange(4, 60)
+        G = random_graph(self.rng, size)
+        sinks = sorted(
+            self.rng.sample(range(size), self.rng.randrange(1, 4)),
+            key=lambda node: G.node[node]['bob'])
+        return G, sinks
+
+    def test_priority_flood_equals_compute_water_level(self):
+        for _ in range(self.TRIALS):
+            G, sinks = self.random_case()
+            expected = G.copy()
+            lost_capacity.compute_water_level(expected, sinks)
+            lost_capacity.priority_flood(G, sinks)
+            self.assertEqual(water_levels(G), water_levels(expected))
+
+    def test_sinks_flood_like_connected_sinks(self):
+        # Several sinks flood as if an extra pipe connected them all to
+        # the lowest one, and each node gets the level its own sink
+        # would give it on its own.
+        for _ in range(self.TRIALS):
+            G, sinks = self.random_case()
+            connected = G.copy()
+            for sink in sinks[1:]:
+                connected.add_edge(sinks[0], sink)
+            lost_capacity.priority_flood(connected, sinks[:1])
+            flooded = G.copy()
+            lost_capacity.priority_flood(flooded, sinks)
+            self.assertEqual(water_levels(flooded), water_levels(connected))
+
+            for node in G:
+                single = G.copy()
+                lost_capacity.priority_flood(
+                    single, [flooded.node[node]['sink']])
+                self.assertEqual(single.node[node]['waterlevel'],
+                                 flooded.node[node]['waterlevel'])
+
+    def test_sink_levels_flood_like_pipes_at_that_level(self):
+        # A sink at a level above its bob floods as if it were connected
+        # to a lower, virtual sink by a pipe at that level.
+        for _ in range(self.TRIALS):
+            G, sinks = self.random_case()
+            sink_levels = dict(
+                (sink, self.rng.uniform(0, 6)) for sink in sinks)
+            virtual = G.copy()
+            virtual.add_node('sink', bob=-100, waterlevel=None, sink=None)
+            for sink in sinks:
+                virtual.add_node(('pipe', sink), bob=sink_levels[sink],
+                                 waterlevel=None, sink=None)
+                virtual.add_edge('sink', ('pipe', sink))
+                virtual.add_edge(('pipe', sink), sink)
+            lost_capacity.priority_flood(virtual, ['sink'])
+            lost_capacity.priority_flood(G, sinks, sink_levels)
+            for node in G:
+                self.assertEqual(G.node[node]['waterlevel'],
+                                 virtual.node[node]['waterlevel'])
+
+    def test_update_water_level_equals_full_flood(self):
+        for _ in range(self.TRIALS):
+            G, sinks = self.random_case()
+            lost_capacity.priority_flood(G, sinks)
+
+            changed = self.rng.sample(G.nodes(), self.rng.randrange(1, 4))
+            bobs = [G.node[node]['bob'] for node in changed]
+            for node in changed:
+                G.node[node]['bob'] = round(self.rng.uniform(0, 5), 1)
+            bobs.extend(G.node[node]['bob'] for node in changed)
+            unknown = self.rng.sample(G.nodes(), self.rng.randrange(0, 3))
+            for node in unknown:
+                G.node[node]['waterlevel'] = None
+
+            expected = G.copy()
+            lost_capacity.priority_flood(expected, sinks)
+            region = lost_capacity.update_water_level(
+                G, sinks, changed, unknown, min(bobs))
+            for node in G:
+                if node in unknown and node not in region:
+                    continue  # Can't be affected, stays unknown
+                self.assertEqual(G.node[node]['waterlevel'],
+                                 expected.node[node]['waterlevel'])
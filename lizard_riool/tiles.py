@@ -0,0 +1,231 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Pre-rendered map tiles of sewerages.
+
+The data of a sewerage doesn't change after it has been uploaded, so
+its map tiles only need to be rendered once. Tiles use the usual
+z/x/y scheme in spherical mercator and are stored in a size-bounded
+disk cache, keyed by sewerage, zoom and tile coordinates. The cache
+of a sewerage is invalidated when it is deleted or deactivated.
+
+Tiles are served by their own URL (see views.sewerage_tile_view), and
+also used for the WMS of a SewerageAdapter: when the map asks for an
+area at the resolution of a zoom level, raster_layers draws the cached
+tiles instead of querying the database.
+"""
+
+import logging
+import math
+import os
+import tempfile
+import time
+
+from django.conf import settings
+import mapnik
+
+from lizard_map.coordinates import GOOGLE
+
+from lizard_riool.disk_cache import DiskCache
+from lizard_riool.layers import SewerageAdapter
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_SRID = 3857  # aka 900913
+TILE_SIZE = 256  # Pixels
+
+# Half the circumference of the earth in spherical mercator.
+ORIGIN_SHIFT = math.pi * 6378137
+
+MAX_ZOOM = 22
+
+# A WMS request is drawn from tiles only if it needs at most this many,
+# otherwise rendering them all at once would take too long.
+MAX_TILES_PER_REQUEST = 64
+
+TILE_CACHE = DiskCache(
+    directory=getattr(
+        settings, 'LIZARD_RIOOL_TILE_CACHE_DIR',
+        os.path.join(settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'tiles')),
+    max_size=getattr(
+        settings, 'LIZARD_RIOOL_TILE_CACHE_SIZE', 500 * 1024 * 1024),
+    suffix='.png')
+
+# Mapnik only reads the tiles drawn in a WMS response when the map is
+# rendered, by then the cache may have evicted them. They are copied to
+# this directory, and removed when they are older than WMS_TILE_LIFETIME
+# seconds.
+WMS_TILE_DIR = getattr(
+    settings, 'LIZARD_RIOOL_WMS_TILE_DIR',
+    os.path.join(settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'wms_tiles'))
+WMS_TILE_LIFETIME = 10 * 60
+
+# Zoom levels rendered in advance after a sewerage was uploaded,
+# if LIZARD_RIOOL_SEED_TILES is set.
+SEED_ZOOM_LEVELS = getattr(
+    settings, 'LIZARD_RIOOL_SEED_ZOOM_LEVELS', range(12, 18))
+
+
+def valid_tile(zoom, x, y):
+    "Return True if tile x, y exists at zoom."
+    return (0 <= zoom <= MAX_ZOOM and
+            0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom)
+
+
+def tile_resolution(zoom):
+    "Return the size of a pixel of a tile at zoom, in map units."
+    return 2 * ORIGIN_SHIFT / (TILE_SIZE * 2 ** zoom)
+
+
+def zoom_for_resolution(resolution):
+    """Return the zoom level whose tiles have the given resolution, or
+    None if there is none."""
+    for zoom in range(MAX_ZOOM + 1):
+        if abs(tile_resolution(zoom) - resolution) < 0.001 * resolution:
+            return zoom
+    return None
+
+
+def tile_bounds(zoom, x, y):
+    """Return (west, south, east, north) of a tile in spherical mercator.
+    Like Google, y runs from north to south."""
+    size = 2 * ORIGIN_SHIFT / (2 ** zoom)
+    west = -ORIGIN_SHIFT + x * size
+    north = ORIGIN_SHIFT - y * size
+    return west, north - size, west + size, north
+
+
+def tiles_covering(extent, zoom):
+    """Yield the (x, y) of all tiles at zoom that cover an extent as
+    returned by SewerageAdapter.extent()."""
+    size = 2 * ORIGIN_SHIFT / (2 ** zoom)
+    max_index = 2 ** zoom - 1
+
+    def index(coordinate):
+        return min(max_index, max(0, int(
+                    math.floor((coordinate + ORIGIN_SHIFT) / size))))
+
+    x_min = index(extent['west'])
+    x_max = index(extent['east'])
+    y_min = max_index - index(extent['north'])
+    y_max = max_index - index(extent['south'])
+
+    for x in xrange(x_min, x_max + 1):
+        for y in xrange(y_min, y_max + 1):
+            yield x, y
+
+
+def render_tile(sewerage_id, zoom, x, y):
+    "Render a tile with Mapnik, return it as PNG data."
+    adapter = SewerageAdapter(None, layer_arguments={'id': sewerage_id})
+    layers, styles = adapter.vector_layers()
+
+    mapnik_map = mapnik.Map(TILE_SIZE, TILE_SIZE)
+    mapnik_map.srs = GOOGLE
+    for name, style in styles.items():
+        mapnik_map.append_style(name, style)
+    for layer in layers:
+        mapnik_map.layers.append(layer)
+
+    box = getattr(mapnik, 'Box2d', None) or mapnik.Envelope
+    mapnik_map.zoom_to_box(box(*tile_bounds(zoom, x, y)))
+
+    image = mapnik.Image(TILE_SIZE, TILE_SIZE)
+    mapnik.render(mapnik_map, image)
+    return image.tostring('png')
+
+
+def get_tile(sewerage_id, zoom, x, y):
+    "Return a tile as PNG data, from the cache if possible."
+    key = (sewerage_id, zoom, x, y)
+    data = TILE_CACHE.get(key)
+    if data is None:
+        data = render_tile(sewerage_id, zoom, x, y)
+        TILE_CACHE.put(key, data)
+    return data
+
+
+def raster_layers(sewerage_id, bbox, width):
+    """Return Mapnik layers and styles that draw the tiles of a sewerage
+    covering bbox (west, south, east, north), rendering those that
+    aren't cached yet. Returns None if the resolution of a map of this
+    width isn't that of a zoom level, or too many tiles are needed."""
+    west, south, east, north = bbox
+    zoom = zoom_for_resolution((east - west) / width)
+    if zoom is None:
+        return None
+
+    covering = list(tiles_covering(
+            {'west': west, 'south': south, 'east': east, 'north': north},
+            zoom))
+    if len(covering) > MAX_TILES_PER_REQUEST:
+        return None
+
+    remove_old_wms_tiles()
+    layers = []
+    for x, y in covering:
+        path = wms_tile_file(get_tile(sewerage_id, zoom, x, y))
+        tile_west, tile_south, tile_east, tile_north = tile_bounds(
+            zoom, x, y)
+        layer = mapnik.Layer('tileLayer')
+        layer.srs = GOOGLE
+        layer.datasource = mapnik.Raster(
+            file=path,
+            lox=tile_west, loy=tile_south, hix=tile_east, hiy=tile_north)
+        layer.styles.append('tileStyle')
+        layers.append(layer)
+
+    rule = mapnik.Rule()
+    rule.symbols.append(mapnik.RasterSymbolizer())
+    style = mapnik.Style()
+    style.rules.append(rule)
+    return layers, {'tileStyle': style}
+
+
+def wms_tile_file(data):
+    """Write tile data to a new file in WMS_TILE_DIR, which the cache
+    can't evict, and return its path."""
+    if not os.path.exists(WMS_TILE_DIR):
+        try:
+            os.makedirs(WMS_TILE_DIR)
+        except OSError:
+            pass  # Created by another process.
+
+    fd, path = tempfile.mkstemp(suffix='.png', dir=WMS_TILE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def remove_old_wms_tiles():
+    "Remove the files of wms_tile_file that no render needs anymore."
+    if not os.path.exists(WMS_TILE_DIR):
+        return
+    too_old = time.time() - WMS_TILE_LIFETIME
+    for filename in os.listdir(WMS_TILE_DIR):
+        path = os.path.join(WMS_TILE_DIR, filename)
+        try:
+            if os.path.getmtime(path) < too_old:
+                os.remove(path)
+        except OSError:
+            pass  # Removed by another process.
+
+
+def seed(sewerage_id, zoom_levels=SEED_ZOOM_LEVELS):
+    "Render all tiles covering a sewerage in advance."
+    adapter = SewerageAdapter(None, layer_arguments={'id': sewerage_id})
+    extent = adapter.extent()
+    if not extent or extent.get('west') is None:
+        return  # No manholes
+
+    count = 0
+    for zoom in zoom_levels:
+        for x, y in tiles_covering(extent, zoom):
+            get_tile(sewerage_id, zoom, x, y)
+            count += 1
+
+    logger.info("Seeded %d tiles of sewerage %d", count, sewerage_id)
+
+
+def invalidate(sewerage_id):
+    "Forget all cached tiles of a sewerage."
+    TILE_CACHE.invalidate((sewerage_id,))
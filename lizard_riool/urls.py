@@ -21,6 +21,16 @@ urlpatterns = patterns(
     url('^beheer/uploads/files/uploaded-file-(?P<upload_id>\d+)/errors/$',
         login_required(views.UploadedFileErrorsView.as_view()),
         name='lizard_riool_uploaded_file_error_view'),
+    url('^beheer/uploads/files/uploaded-file-(?P<upload_id>\d+)/progress/$',
+        login_required(views.upload_progress_view),
+        name='lizard_riool_upload_progress'),
+    url('^beheer/uploads/files/uploaded-file-(?P<upload_id>\d+)/profile/'
+        '(?P<filename>[\w.]+)$',
+        login_required(views.upload_profile_view),
+        name='lizard_riool_upload_profile'),
+    url('^beheer/uploads/batches/batch-(?P<batch_id>\d+)/$',
+        login_required(views.upload_batch_view),
+        name='lizard_riool_upload_batch'),
 
     # Stelsels, profielen
     (r'^stelsels/$', login_required(views.SewerageView.as_view())),
@@ -41,6 +51,15 @@ urlpatterns = patterns(
     url(r'^stelsels/(?P<sewerage_id>\d+)/$',
         login_required(views.activate_sewerage_view),
         name='lizard_riool_activate_sewerage'),
+    # Map tiles
+    url(r'^stelsels/(?P<sewerage_id>\d+)/tiles/'
+        r'(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$',
+        login_required(views.sewerage_tile_view),
+        name='lizard_riool_sewerage_tile'),
+    url(r'^stelsels/(?P<sewerage_id>\d+)/tiles/'
+        r'(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$',
+        login_required(views.sewerage_vector_tile_view),
+        name='lizard_riool_sewerage_vector_tile'),
     # Download originals
     url(r'^stelsels/(?P<sewerage_id>\d+)/(?P<filename>.+)$',
         login_required(views.download_original_view),
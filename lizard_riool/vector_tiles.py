@@ -0,0 +1,153 @@
+# (c) Nelen & Schuurmans. GPL licensed, see LICENSE.txt.
+
+"""Mapbox Vector Tiles of sewerages.
+
+Instead of a rendered image, a vector tile contains the geometries
+and attributes of the manholes, sewers and lost capacity stretches
+within it, so the browser can draw (and restyle) them itself.
+Geometries are clipped to the tile and simplified to its resolution.
+Like the PNG tiles, vector tiles are kept in a disk cache.
+"""
+
+import logging
+import os
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+import mapbox_vector_tile
+
+from lizard_riool.disk_cache import DiskCache
+from lizard_riool.models import LostCapacitySegment
+from lizard_riool.models import Manhole
+from lizard_riool.models import Sewer
+from lizard_riool.tiles import GOOGLE_SRID
+from lizard_riool.tiles import TILE_SIZE
+from lizard_riool.tiles import tile_bounds
+
+logger = logging.getLogger(__name__)
+
+EXTENT = 4096  # Coordinate resolution within a tile
+
+# Only include layers from this zoom level on.
+MIN_ZOOM = {
+    'sewers': 0,
+    'lost_capacity': 14,
+    'manholes': 15,
+}
+
+# Clip to the tile plus this many pixels, so that lines continue
+# smoothly into the neighbouring tile.
+BUFFER_PIXELS = 4
+
+VECTOR_TILE_CACHE = DiskCache(
+    directory=getattr(
+        settings, 'LIZARD_RIOOL_VECTOR_TILE_CACHE_DIR',
+        os.path.join(settings.BUILDOUT_DIR, 'var', 'lizard_riool',
+                     'vector_tiles')),
+    max_size=getattr(
+        settings, 'LIZARD_RIOOL_VECTOR_TILE_CACHE_SIZE', 500 * 1024 * 1024),
+    suffix='.pbf')
+
+
+def _features(queryset, clip_box, tolerance, properties):
+    """Return features for all objects in queryset, whose geometries
+    must be in Google projection."""
+    features = []
+    for obj in queryset:
+        geometry = obj.the_geom
+        if geometry.geom_type != 'Point':
+            geometry = geometry.intersection(clip_box)
+            if geometry.empty:
+                continue
+            geometry = geometry.simplify(tolerance, preserve_topology=True)
+        features.append({
+            'geometry': geometry.wkt,
+            'properties': properties(obj),
+        })
+    return features
+
+
+def render_vector_tile(sewerage_id, zoom, x, y):
+    "Return the vector tile as protobuf data."
+    west, south, east, north = tile_bounds(zoom, x, y)
+    pixel = (east - west) / TILE_SIZE
+    buffer = BUFFER_PIXELS * pixel
+
+    clip_box = Polygon.from_bbox(
+        (west - buffer, south - buffer, east + buffer, north + buffer))
+    clip_box.srid = GOOGLE_SRID
+
+    # Objects are stored in WGS84, select them with the same box.
+    query_box = clip_box.transform(4326, clone=True)
+
+    tolerance = pixel / 2
+
+    layers = []
+
+    if zoom >= MIN_ZOOM['sewers']:
+        sewers = (
+            Sewer.objects.
+            filter(sewerage__pk=sewerage_id).
+            filter(the_geom__bboverlaps=query_box).
+            only('code', 'quality', 'worst_class', 'the_geom').
+            transform(GOOGLE_SRID)
+        )
+        layers.append({
+            'name': 'sewers',
+            'features': _features(
+                sewers, clip_box, tolerance, lambda sewer: {
+                    'code': sewer.code,
+                    'quality': sewer.quality,
+                    'worst_class': sewer.worst_class,
+                }),
+        })
+
+    if zoom >= MIN_ZOOM['lost_capacity']:
+        segments = (
+            LostCapacitySegment.objects.
+            filter(sewer__sewerage__pk=sewerage_id).
+            filter(the_geom__bboverlaps=query_box).
+            transform(GOOGLE_SRID)
+        )
+        layers.append({
+            'name': 'lost_capacity',
+            'features': _features(
+                segments, clip_box, tolerance, lambda segment: {
+                    'klasse': segment.klasse,
+                }),
+        })
+
+    if zoom >= MIN_ZOOM['manholes']:
+        manholes = (
+            Manhole.objects.
+            filter(sewerage__pk=sewerage_id).
+            filter(the_geom__bboverlaps=query_box).
+            only('code', 'sink', 'the_geom').
+            transform(GOOGLE_SRID)
+        )
+        layers.append({
+            'name': 'manholes',
+            'features': _features(
+                manholes, clip_box, tolerance, lambda manhole: {
+                    'code': manhole.code,
+                    'sink': manhole.sink,
+                }),
+        })
+
+    return mapbox_vector_tile.encode(
+        layers, quantize_bounds=(west, south, east, north), extents=EXTENT)
+
+
+def get_vector_tile(sewerage_id, zoom, x, y):
+    "Return a vector tile, from the cache if possible."
+    key = (sewerage_id, zoom, x, y)
+    data = VECTOR_TILE_CACHE.get(key)
+    if data is None:
+        data = render_vector_tile(sewerage_id, zoom, x, y)
+        VECTOR_TILE_CACHE.put(key, data)
+    return data
+
+
+def invalidate(sewerage_id):
+    "Forget all cached vector tiles of a sewerage."
+    VECTOR_TILE_CACHE.invalidate((sewerage_id,))
@@ -2,18 +2,22 @@
 
 from __future__ import division
 
+import datetime
 import logging
 import os.path
 import tempfile
 import urllib
 
 from django.conf import settings
-from django.contrib.gis.geos import Point
 from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
+from django.db.models import Count
+from django.db.models import Max
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.utils import simplejson as json
+from django.views.decorators.http import condition
 from django.views.decorators.http import require_http_methods
 from django.views.generic import TemplateView, View
 from django.views.static import serve
@@ -30,9 +34,13 @@ from lizard_ui.views import ViewContextMixin
 
 from sufriblib.parsers import enumerate_file
 
-from lizard_riool import tasks
+from lizard_riool import batches
 from lizard_riool import models
-from lizard_riool.layers import SewerageAdapter
+from lizard_riool import progress
+from lizard_riool import spatial_index
+from lizard_riool import tasks
+from lizard_riool import tiles
+from lizard_riool import vector_tiles
 from lizard_riool.models import Upload
 from lizard_riool.models import Sewer
 from lizard_riool.models import Sewerage
@@ -41,6 +49,21 @@ from lizard_riool.waar import WAAR
 
 logger = logging.getLogger(__name__)
 
+# Names of the lizard_map.adapter_class entry points, see setup.py.
+SEWERAGE_ADAPTER_CLASS = 'lizard_riool_sewerage_adapter'
+SEWERAGE_OVERVIEW_ADAPTER_CLASS = 'lizard_riool_sewerage_overview_adapter'
+
+# Cursors of the upload feed are the time of the last change.
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Uploads are timestamped when they are saved, not when the transaction
+# commits; send uploads that changed shortly before the cursor again.
+CURSOR_OVERLAP = datetime.timedelta(seconds=10)
+
+# Browsers may use a map tile this long (s) before they ask whether it
+# changed, e.g. because its sewerage was revised.
+TILE_MAX_AGE = 300
+
 
 def transform(the_geom, srid):
     """Perform an in-place geometry transformation.
@@ -298,16 +321,31 @@ class UploadView(TemplateView):
         # Start a new file or append the next chunk.
         # NB: Django manages its own chunking.
 
+        # A file sent in one request is hashed while it is written; of
+        # a file sent in parts, move_file hashes the result.
+        hasher = models.content_hasher() if chunks == 1 else None
+
         with open(fullpath, 'wb' if chunk == 0 else 'ab') as f:
             for b in request.FILES['file'].chunks():
                 f.write(b)
+                if hasher:
+                    hasher.update(b)
 
         # On successful parsing, store the uploaded file in its permanent
         # location. Some information will be stored into the database as
         # well for convenience and performance. Roll back on any error.
 
         if chunk == chunks - 1:
-            upload = Upload()
+            if batches.is_batch(filename):
+                # A ZIP file of many pairs, extracted by the task
+                batch = models.UploadBatch()
+                batch.move_file(fullpath)
+                tasks.process_batch.delay(batch.pk)
+                return {'batch_url': reverse(
+                        'lizard_riool_upload_batch',
+                        kwargs={'batch_id': batch.pk})}
+
+            upload = Upload(content_hash=hasher.hexdigest() if hasher else '')
             upload.move_file(fullpath)
             tasks.process_uploaded_file.delay(upload)
 
@@ -319,12 +357,10 @@ class UploadView(TemplateView):
         but the only way to show custom error messages when using Plupload.
         """
         try:
-            cls.process(request)
+            result = cls.process(request) or {}
         except Exception, e:
             logger.error(e)
             result = {'error': {'details': str(e)}}
-        else:
-            result = {}
 
         return HttpResponse(json.dumps(result), mimetype="application/json")
 
@@ -336,7 +372,11 @@ class JSONResponseMixin(object):
 
 
 class ManholeFinder(View, JSONResponseMixin):
-    "Find the nearest manhole within a certain radius around a point."
+    """Find the nearest manhole within a certain radius around a point.
+
+    Manholes are looked up in the in-memory indexes of spatial_index.py.
+
+    """
 
     def get(self, request, *args, **kwargs):
 
@@ -348,19 +388,28 @@ class ManholeFinder(View, JSONResponseMixin):
         srs = request.GET.get('srs')  # e.g. EPSG:28992
         workspace_id = int(request.GET.get('workspace_id'))
 
-        # Which sewerages are we looking at?
+        # Which sewerages are we looking at? Read their ids from the
+        # layer arguments; no need to instantiate the adapters.
 
-        sewerage_pks = []
+        sewerage_pks = set()
 
         workspace_items = (
             WorkspaceEditItem.objects.
             filter(workspace__pk=workspace_id).
-            filter(visible=True)
+            filter(visible=True).
+            filter(adapter_class__in=[
+                    SEWERAGE_ADAPTER_CLASS, SEWERAGE_OVERVIEW_ADAPTER_CLASS])
         )
 
         for workspace_item in workspace_items:
-            if isinstance(workspace_item.adapter, SewerageAdapter):
-                sewerage_pks.append(workspace_item.adapter.id)
+            if workspace_item.adapter_class == SEWERAGE_OVERVIEW_ADAPTER_CLASS:
+                sewerage_pks.update(
+                    Sewerage.objects.filter(active=True).
+                    values_list('pk', flat=True))
+            else:
+                layer_arguments = json.loads(
+                    workspace_item.adapter_layer_json)
+                sewerage_pks.add(int(layer_arguments['id']))
 
         if not sewerage_pks:
             return self.render_to_response()
@@ -368,27 +417,20 @@ class ManholeFinder(View, JSONResponseMixin):
         # What is the nearest manhole?
 
         srid = int(srs.split(':')[1])  # e.g. 28992
-        pnt = Point(x, y, srid=srid)
 
-        manholes = (
-            models.Manhole.objects.
-            filter(sewerage__pk__in=sewerage_pks).
-            filter(the_geom__distance_lte=(pnt, radius)).
-            distance(pnt).order_by('distance')
-        )
+        found = spatial_index.nearest_manhole(
+            sewerage_pks, x, y, srid, radius)
 
-        try:
-            manhole = manholes[0]  # SELECT ... LIMIT 1;
-        except:
+        if found is None:
             return self.render_to_response()
 
-        transform(manhole.the_geom, srid)
+        _, (sewerage_pk, code, manhole_x, manhole_y) = found
 
         context = {
-            'x': manhole.the_geom.x,
-            'y': manhole.the_geom.y,
-            'put': manhole.code,
-            'upload_id': manhole.sewerage.pk,
+            'x': manhole_x,
+            'y': manhole_y,
+            'put': code,
+            'upload_id': sewerage_pk,
         }
 
         return self.render_to_response(context)
@@ -419,11 +461,17 @@ class PathFinder(View, JSONResponseMixin):
             select_related('manhole1', 'manhole2')
         )
 
+        # RD geometries are stored, other projections are transformed.
+
         for sewer in sewers:
             manhole1, manhole2 = sewer.manhole1, sewer.manhole2
             G.add_edge(manhole1.code, manhole2.code, streng=sewer.code)
-            G.node[manhole1.code]['location'] = manhole1.the_geom
-            G.node[manhole2.code]['location'] = manhole2.the_geom
+            if srid == models.RDNEW:
+                G.node[manhole1.code]['location'] = manhole1.the_geom_rd
+                G.node[manhole2.code]['location'] = manhole2.the_geom_rd
+            else:
+                G.node[manhole1.code]['location'] = manhole1.the_geom
+                G.node[manhole2.code]['location'] = manhole2.the_geom
 
         try:
             path = nx.shortest_path(G, source, target)
@@ -442,7 +490,8 @@ class PathFinder(View, JSONResponseMixin):
 
         for put in path:
             location = G.node[put]['location']
-            transform(location, srid)
+            if srid != models.RDNEW:
+                transform(location, srid)
             put = {'put': put, 'x': location.x, 'y': location.y}
             putten.append(put)
 
@@ -456,22 +505,106 @@ class UploadsView(AppView):
     javascript_click_handler = ''
 
 
+def parse_cursor(cursor):
+    "Return the datetime in an upload feed cursor, or None."
+    if not cursor:
+        return None
+    return datetime.datetime.strptime(cursor, CURSOR_FORMAT)
+
+
+def upload_feed_etag(request):
+    """Changes whenever an upload is added, saved or deleted, so that
+    polling an unchanged feed is answered with 304 Not Modified."""
+    aggregate = Upload.objects.aggregate(
+        last_change=Max('the_time'), count=Count('pk'))
+    return "{0}-{1}".format(aggregate['last_change'], aggregate['count'])
+
+
+@condition(etag_func=upload_feed_etag)
 def uploaded_file_list(request):
-    return HttpResponse(json.dumps([
-                {
-                    "id": "uploaded-file-{0}".format(upload.pk),
-                    "name": upload.filename,
-                    "status": upload.status_string(),
-                    "error_description": upload.error_description(),
-                    "error_url": reverse(
-                        "lizard_riool_uploaded_file_error_view",
-                        kwargs={"upload_id": upload.id}),
-                    "delete_url": reverse(
-                        "lizard_riool_delete_uploaded_file",
-                        kwargs={"upload_id": upload.id})
-                    }
-                for upload in Upload.objects.all()
-                ]), mimetype="application/json")
+    """Return the uploads that changed since the cursor in the `since`
+    parameter, plus the cursor to use next time.
+
+    Without a cursor, only uploads that are still waiting or being
+    processed are returned, or all uploads if `all` is given. Deleted
+    uploads are not reported, the page removes those itself.
+
+    """
+    try:
+        since = parse_cursor(request.GET.get('since'))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+
+    # Determine the new cursor first, uploads saved while we're
+    # busy will be sent next time.
+    last_change = Upload.objects.aggregate(Max('the_time'))['the_time__max']
+    if last_change is not None:
+        cursor = last_change.strftime(CURSOR_FORMAT)
+    else:
+        cursor = request.GET.get('since')
+
+    uploads = Upload.objects.annotate(
+        error_count=Count('uploadedfileerror')).order_by('pk')
+    if since is not None:
+        uploads = uploads.filter(the_time__gte=since - CURSOR_OVERLAP)
+    elif not request.GET.get('all'):
+        uploads = uploads.exclude(
+            status__in=(Upload.UNSUCCESSFUL, Upload.SUCCESSFUL))
+
+    return HttpResponse(json.dumps({
+                "cursor": cursor,
+                "uploads": [
+                    {
+                        "id": "uploaded-file-{0}".format(upload.pk),
+                        "name": upload.filename,
+                        "status": upload.status_string(),
+                        "error_description": upload.error_description(
+                            error_count=upload.error_count),
+                        "error_url": reverse(
+                            "lizard_riool_uploaded_file_error_view",
+                            kwargs={"upload_id": upload.id}),
+                        "delete_url": reverse(
+                            "lizard_riool_delete_uploaded_file",
+                            kwargs={"upload_id": upload.id}),
+                        "progress_url": reverse(
+                            "lizard_riool_upload_progress",
+                            kwargs={"upload_id": upload.id})
+                        }
+                    for upload in uploads
+                    ]}), mimetype="application/json")
+
+
+def upload_progress_view(request, upload_id):
+    """Return the progress of an upload being processed, as JSON. Answers
+    at once; waiting for changes would keep a web worker busy for every
+    file being processed."""
+    state = progress.get(upload_id)
+
+    response = HttpResponse(
+        json.dumps(state or {'version': 0}), mimetype="application/json")
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def upload_batch_view(request, batch_id):
+    """Return the status of an uploaded ZIP file as JSON: whether it
+    was extracted, and the number of its uploads per status."""
+    try:
+        batch = models.UploadBatch.objects.get(pk=batch_id)
+    except models.UploadBatch.DoesNotExist:
+        raise Http404
+
+    counts = batch.status_counts()
+    response = HttpResponse(json.dumps({
+                "name": batch.filename,
+                "status": batch.get_status_display(),
+                "error": batch.error_message or None,
+                "uploads": counts,
+                "total": sum(counts.values()),
+                "finished": batch.finished(),
+                }), mimetype="application/json")
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 class UploadedFileErrorsView(ViewContextMixin, TemplateView):
@@ -527,6 +660,22 @@ class UploadedFileErrorsView(ViewContextMixin, TemplateView):
         return lines
 
 
+def upload_profile_view(request, upload_id, filename):
+    "Download a profiling report of an upload."
+    try:
+        upload = Upload.objects.get(pk=upload_id)
+    except Upload.DoesNotExist:
+        raise Http404
+
+    if filename not in upload.profile_files():
+        raise Http404
+
+    response = serve(request, filename, upload.directory)
+    response['Content-Disposition'] = (
+            'attachment; filename="{filename}"'.format(filename=filename))
+    return response
+
+
 def delete_uploaded_file(request, upload_id):
     if request.method != "DELETE":
         return
@@ -590,6 +739,9 @@ def activate_sewerage_view(request, sewerage_id):
                 sewerage.save()
             except Sewerage.DoesNotExist:
                 pass
+            if not active:
+                tiles.invalidate(int(sewerage_id))
+                vector_tiles.invalidate(int(sewerage_id))
 
     if request.method == "DELETE":
         try:
@@ -597,10 +749,57 @@ def activate_sewerage_view(request, sewerage_id):
             sewerage.delete()
         except Sewerage.DoesNotExist:
             pass
+        spatial_index.forget_sewerage(int(sewerage_id))
+        tiles.invalidate(int(sewerage_id))
+        vector_tiles.invalidate(int(sewerage_id))
 
     return HttpResponse()
 
 
+def sewerage_tile_etag(request, sewerage_id, zoom, x, y):
+    """Changes when a sewerage is revised, see revisions.py, so that
+    browsers don't keep showing its old tiles."""
+    rmb_hashes = Sewerage.objects.filter(pk=sewerage_id).values_list(
+        'rmb_hash', flat=True)
+    if not rmb_hashes:
+        return None
+    return "{0}-{1}".format(sewerage_id, rmb_hashes[0])
+
+
+@condition(etag_func=sewerage_tile_etag)
+def sewerage_tile_view(request, sewerage_id, zoom, x, y):
+    """Return a map tile of a sewerage as PNG. Tiles are rendered once
+    and then served from a disk cache, see tiles.py."""
+    zoom, x, y = int(zoom), int(x), int(y)
+    if not tiles.valid_tile(zoom, x, y):
+        raise Http404
+    if not Sewerage.objects.filter(pk=sewerage_id).exists():
+        raise Http404
+
+    data = tiles.get_tile(int(sewerage_id), zoom, x, y)
+
+    response = HttpResponse(data, content_type='image/png')
+    response['Cache-Control'] = 'max-age={0}'.format(TILE_MAX_AGE)
+    return response
+
+
+@condition(etag_func=sewerage_tile_etag)
+def sewerage_vector_tile_view(request, sewerage_id, zoom, x, y):
+    """Return a Mapbox Vector Tile of a sewerage, with layers 'sewers',
+    'lost_capacity' and 'manholes', see vector_tiles.py."""
+    zoom, x, y = int(zoom), int(x), int(y)
+    if not tiles.valid_tile(zoom, x, y):
+        raise Http404
+    if not Sewerage.objects.filter(pk=sewerage_id).exists():
+        raise Http404
+
+    data = vector_tiles.get_vector_tile(int(sewerage_id), zoom, x, y)
+
+    response = HttpResponse(data, content_type='application/x-protobuf')
+    response['Cache-Control'] = 'max-age={0}'.format(TILE_MAX_AGE)
+    return response
+
+
 def download_original_view(request, sewerage_id, filename):
     try:
         sewerage = Sewerage.objects.get(pk=sewerage_id)
@@ -624,10 +823,11 @@ def download_original_view(request, sewerage_id, filename):
         # XXX
         return serve(request, path, '/')
 
+    # Revised files are in a subdirectory of the sewerage's directory
     response = HttpResponse()
     response['X-Accel-Redirect'] = (
-        '/riolering/stelsels/nginx_download/{sewerage_id}/{filename}'
-        .format(sewerage_id=sewerage.id, filename=filename))
+        '/riolering/stelsels/nginx_download/{path}'
+        .format(path=os.path.relpath(path, Sewerage.BASE_PATH)))
     response['Content-Disposition'] = (
             'attachment; filename="{filename}"'.format(filename=filename))
     # content-type is set in nginx.
@@ -19,6 +19,7 @@ install_requires = [
     'django-nose',
     'lizard-map >= 4.0, < 5.0',
     'lizard-ui >= 4.0, < 5.0',
+    'mapbox-vector-tile',
     'pkginfo',
     'networkx',
     'sufriblib',
@@ -50,6 +51,8 @@ setup(name='lizard-riool',
         'console_scripts': [],
         'lizard_map.adapter_class': [
           'lizard_riool_sewerage_adapter = lizard_riool.layers:SewerageAdapter',
+          'lizard_riool_sewerage_overview_adapter = '
+          'lizard_riool.layers:SewerageOverviewAdapter',
         ]
       },
 )